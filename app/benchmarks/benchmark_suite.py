@@ -0,0 +1,434 @@
+"""
+Reproducible benchmarks of preprocessing, vectorization, inference and the service on synthetic corpus
+(see synthetic_corpus.py). Results are written as json and can be compared with results of another run:
+
+    python benchmark_suite.py --output new.json --baseline old.json
+
+Exit code is 1 if any metric of baseline got worse by more than --threshold
+"""
+import argparse
+import collections
+import http.client
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Collection, Dict, List, Optional, Tuple
+
+import numpy as np
+
+APP_PATH = Path(os.path.dirname(os.path.abspath(__file__))).parent
+sys.path.append(str(APP_PATH))
+
+from benchmarks.synthetic_corpus import generate_corpus, SIGNATURES
+from preprocessor import language_detector as lang
+from trainer.models import build_lstm, build_embed_model, build_cnn
+from trainer.train import create_dictionary
+from utils import text_utils
+from utils.sequence_utils import prep_bag_of_words
+from utils.stop_words_utils import StopWordsCleaner
+from utils.vocabulary import Vocabulary
+
+DOCS = 2000
+SEED = 42
+REPEATS = 3
+MAX_SEQUENCE_LENGTH = 100
+NUM_WORDS = 20000
+BATCH_SIZE = 32
+PREDICTIONS = 200
+REQUESTS = 1000
+THREADS = 4
+THRESHOLD = 0.1
+DEFAULT_STOP_WORDS = 100
+CUSTOM_STOP_WORDS = 5000
+# Options of clean_text, every combination is measured
+CLEANING_OPTIONS = ["signatures", "html", "emails", "urls", "numbers", "stop_words", "lemmatize"]
+# Parameters that change measured work, results are comparable only if they are the same
+COMPARED_PARAMETERS = ["docs", "seed", "default_stop_words", "custom_stop_words", "max_sequence_length", "num_words",
+                       "batch_size", "requests", "threads"]
+# Builders of trainer.models
+MODELS = {"lstm": build_lstm, "embed": build_embed_model, "cnn": build_cnn}
+
+
+def measure_throughput(function: Callable, items: list, repeats: int) -> float:
+    """
+    Call function with every item 'repeats' times after one warm up pass
+
+    :return: items per second of the fastest pass
+    """
+    for item in items:
+        function(item)
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return len(items) / best
+
+
+def latency_stats(latencies_ms: List[float], prefix: str) -> Dict[str, float]:
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {f'{prefix}p50_ms': p50, f'{prefix}p95_ms': p95, f'{prefix}p99_ms': p99}
+
+
+def lemmatization_available() -> bool:
+    return os.path.exists(lang.PRETRAINED_LANG_MODEL)
+
+
+def write_stop_words(texts: List[str], directory: str, default_words: int, custom_words: int,
+                     seed: int) -> Tuple[str, str]:
+    """
+    Stop words files made of corpus words: the most frequent words as default stop words and random words
+    and word pairs of corpus (completed with generated words) as custom stop words
+
+    :return: path to default stop words file and path to directory of custom stop words
+    """
+    tokens = [text_to_tokens(text) for text in texts]
+    frequencies = collections.Counter(itertools.chain.from_iterable(tokens))
+    words = sorted(frequencies)
+    pairs = sorted({" ".join(pair) for text_tokens in tokens for pair in zip(text_tokens, text_tokens[1:])})
+    rng = random.Random(seed)
+    keywords = rng.sample(words, min(len(words), custom_words // 2))
+    keywords += rng.sample(pairs, min(len(pairs), custom_words - len(keywords)))
+    keywords += [f'stopword{i}' for i in range(custom_words - len(keywords))]
+
+    default_path = os.path.join(directory, "default_stop_words.txt")
+    with open(default_path, "w", encoding="utf-8") as file:
+        file.write("\n".join(word for word, _ in frequencies.most_common(default_words)) + "\n")
+    custom_path = os.path.join(directory, "custom")
+    os.makedirs(custom_path)
+    with open(os.path.join(custom_path, "stop_words.txt"), "w", encoding="utf-8") as file:
+        file.write("\n".join(f'{keyword}=>_EMPTY_' for keyword in keywords) + "\n")
+    return default_path, custom_path
+
+
+def text_to_tokens(text: str) -> List[str]:
+    return [token for token in text_utils.clean_html_tags(text).lower().translate(text_utils.TOKEN_TABLE).split(" ")
+            if token]
+
+
+def benchmark_fit_text(default_path: str, custom_path: str, repeats: int) -> Tuple[dict, StopWordsCleaner]:
+    """
+    :return: the fastest of 'repeats' builds of StopWordsCleaner (after one warm up build) and the last built cleaner
+    """
+    times = []
+    cleaner = None
+    for _ in range(repeats + 1):
+        cleaner = StopWordsCleaner(load_uk=False, load_ru=False, alt_stop_words_file=default_path,
+                                   custom_path=custom_path)
+        start = time.perf_counter()
+        cleaner.fit_text()
+        times.append(time.perf_counter() - start)
+    return {"build_seconds": min(times[1:]), "default_words": len(cleaner.default_stop_words),
+            "custom_keywords": len(cleaner.processor)}, cleaner
+
+
+def cleaning_options(enabled: Collection[str], cleaner: StopWordsCleaner) -> dict:
+    """
+    :param enabled: names of enabled CLEANING_OPTIONS
+    :return: clean_text arguments
+    """
+    return {"email_signatures": SIGNATURES if "signatures" in enabled else "", "clean_html": "html" in enabled,
+            "clean_email_address": "emails" in enabled, "clean_urls": "urls" in enabled,
+            "clean_numbers": "numbers" in enabled,
+            "custom_stop_words": cleaner.processor if "stop_words" in enabled else None,
+            "default_stop_words": cleaner.default_stop_words if "stop_words" in enabled else None,
+            "min_word_len": 2, "max_word_len": 30, "lemmatize_russian": "lemmatize" in enabled,
+            "lemmatize_ukrainian": "lemmatize" in enabled}
+
+
+def benchmark_clean_text(texts: List[str], cleaner: StopWordsCleaner, repeats: int, lemmatize: bool) -> dict:
+    """
+    Throughput of clean_text with every combination of CLEANING_OPTIONS. Lemmatization is measured with
+    lemma cache filled by warm up pass, as in the service
+
+    :param lemmatize: measure combinations with lemmatization
+    """
+    results = {}
+    for flags in itertools.product([False, True], repeat=len(CLEANING_OPTIONS)):
+        enabled = [option for option, flag in zip(CLEANING_OPTIONS, flags) if flag]
+        if "lemmatize" in enabled and not lemmatize:
+            continue
+        name = "+".join(enabled) or "none"
+        options = cleaning_options(enabled, cleaner)
+        results[name] = {"docs_per_second": measure_throughput(lambda text: text_utils.clean_text(text, **options),
+                                                               texts, repeats)}
+    return results
+
+
+def benchmark_bag_of_words(texts: List[str], max_sequence_length: int, num_words: int,
+                           repeats: int) -> Tuple[dict, np.ndarray, int]:
+    """
+    Dictionary fit time and throughput of prep_bag_of_words with Keras Tokenizer and Vocabulary
+
+    :return: results, padded sequences of texts and dictionary size
+    """
+    start = time.perf_counter()
+    tokenizer = create_dictionary(texts, num_words)
+    results = {"dictionary_seconds": time.perf_counter() - start}
+    vocabulary = Vocabulary.from_tokenizer(tokenizer)
+    # Batches of texts, as in training and batch prediction
+    batches = [texts[i:i + 1000] for i in range(0, len(texts), 1000)]
+    for name, dictionary in [("tokenizer", tokenizer), ("vocabulary", vocabulary)]:
+        batches_per_second = measure_throughput(lambda batch: prep_bag_of_words(batch, dictionary,
+                                                                                max_sequence_length),
+                                                batches, repeats)
+        results[name] = {"docs_per_second": batches_per_second * len(texts) / len(batches)}
+    dictionary_size = num_words or len(tokenizer.word_index) + 1
+    return results, prep_bag_of_words(texts, tokenizer, max_sequence_length), dictionary_size
+
+
+def benchmark_models(x: np.ndarray, num_classes: int, num_words: int, batch_size: int, predictions: int) -> dict:
+    """
+    Latency of prediction of one text and of batch of texts by every model of trainer.models (not trained,
+    weights do not change latency)
+    """
+    import tensorflow as tf
+    results = {}
+    for name, build in MODELS.items():
+        tf.random.set_seed(SEED)
+        model = build(x.shape[1], num_classes, name, num_words)
+        model.predict_on_batch(x[:batch_size])
+        model.predict_on_batch(x[:1])
+        single, batch = [], []
+        for i in range(predictions):
+            start = time.perf_counter()
+            model.predict_on_batch(x[i % len(x)][None])
+            single.append((time.perf_counter() - start) * 1000)
+            offset = (i * batch_size) % max(1, len(x) - batch_size)
+            start = time.perf_counter()
+            model.predict_on_batch(x[offset:offset + batch_size])
+            batch.append((time.perf_counter() - start) * 1000)
+        results[name] = {**latency_stats(single, "single_"), **latency_stats(batch, "batch_"),
+                         "batch_docs_per_second": batch_size * 1000 / np.median(batch)}
+        tf.keras.backend.clear_session()
+    return results
+
+
+def start_local_server(setting_path: str, port: int, timeout: float = 300) -> subprocess.Popen:
+    """
+    Start Flask service with setting in subprocess and wait until it is ready
+    """
+    environment = {**os.environ, "SERVER_PORT": str(port),
+                   "PYTHONPATH": os.pathsep.join([str(APP_PATH), os.environ.get("PYTHONPATH", "")])}
+    server = subprocess.Popen([sys.executable, str(APP_PATH / "service" / "ml_service.py"), setting_path],
+                              env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Service exited with code {server.returncode}')
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/health")
+            if connection.getresponse().status == 200:
+                return server
+        except OSError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise TimeoutError(f'Service is not ready in {timeout} s')
+
+
+def benchmark_http(url: str, texts: List[str], requests: int, threads: int) -> dict:
+    """
+    Throughput and latency of /predict of running service. Every client thread keeps one connection
+    """
+    address = urllib.parse.urlsplit(url)
+    latencies = []
+    errors = []
+
+    def run(offset: int) -> None:
+        connection = http.client.HTTPConnection(address.hostname, address.port or 80, timeout=60)
+        for i in range(offset, requests, threads):
+            body = json.dumps({"text": texts[i % len(texts)]})
+            start = time.perf_counter()
+            connection.request("POST", address.path.rstrip("/") + "/predict", body=body,
+                               headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status != 200:
+                errors.append(response.status)
+        connection.close()
+
+    clients = [threading.Thread(target=run, args=(offset,)) for offset in range(threads)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    return {"requests_per_second": requests / elapsed, **latency_stats(latencies, ""), "errors": len(errors)}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=APP_PATH, stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run_suite(args: argparse.Namespace) -> dict:
+    corpus = generate_corpus(args.docs, args.seed)
+    texts = corpus['text'].tolist()
+    lemmatize = lemmatization_available()
+    results = {}
+    print(f'Corpus: {len(texts)} tickets, seed {args.seed}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        default_path, custom_path = write_stop_words(texts, directory, args.default_stop_words,
+                                                     args.custom_stop_words, args.seed)
+        results["fit_text"], cleaner = benchmark_fit_text(default_path, custom_path, args.repeats)
+    print(f'fit_text: {results["fit_text"]["build_seconds"]:.3f} s')
+
+    if not lemmatize:
+        print(f'Language model {lang.PRETRAINED_LANG_MODEL} is not found, lemmatization is not measured')
+    results["clean_text"] = benchmark_clean_text(texts, cleaner, args.repeats, lemmatize)
+    for name, values in results["clean_text"].items():
+        print(f'clean_text {name:<55} {values["docs_per_second"]:>10.0f} docs/s')
+
+    options = cleaning_options([option for option in CLEANING_OPTIONS if option != "lemmatize"], cleaner)
+    cleaned = [text_utils.clean_text(text, **options) for text in texts]
+    results["prep_bag_of_words"], x, num_words = benchmark_bag_of_words(cleaned, args.max_sequence_length,
+                                                                        args.num_words, args.repeats)
+    for name in ["tokenizer", "vocabulary"]:
+        print(f'prep_bag_of_words {name:<10} {results["prep_bag_of_words"][name]["docs_per_second"]:>10.0f} docs/s')
+
+    if not args.skip_models:
+        results["models"] = benchmark_models(x, corpus['class_id'].nunique(), num_words, args.batch_size,
+                                             args.predictions)
+        for name, values in results["models"].items():
+            print(f'model {name:<6} single p50 {values["single_p50_ms"]:.2f} ms, '
+                  f'batch of {args.batch_size} p50 {values["batch_p50_ms"]:.2f} ms')
+
+    url, server = args.url, None
+    if url is None and args.service_setting is not None:
+        server = start_local_server(args.service_setting, args.port)
+        url = f'http://127.0.0.1:{args.port}'
+    if url is not None:
+        try:
+            results["http"] = benchmark_http(url, texts, args.requests, args.threads)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        print(f'http {results["http"]["requests_per_second"]:.0f} requests/s, '
+              f'p50 {results["http"]["p50_ms"]:.2f} ms, p99 {results["http"]["p99_ms"]:.2f} ms, '
+              f'errors {results["http"]["errors"]}')
+
+    parameters = {key: value for key, value in vars(args).items() if key not in ["output", "baseline"]}
+    return {"meta": {"created": datetime.now().isoformat(timespec="seconds"), "commit": git_commit(),
+                     "python": platform.python_version(), "platform": platform.platform(),
+                     "cpu_count": os.cpu_count(), "numpy": np.__version__, "lemmatization": lemmatize,
+                     "parameters": parameters},
+            "results": results}
+
+
+def flatten(results: dict, prefix="") -> Dict[str, float]:
+    """
+    :return: {'section/case/metric': value} of numeric results
+    """
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{prefix}{key}/'))
+        elif isinstance(value, (int, float)):
+            values[prefix + key] = value
+    return values
+
+
+def change(metric: str, value: float, baseline: float) -> Optional[float]:
+    """
+    :return: relative improvement of metric (negative if it got worse), None if metric is not a speed or a time
+    """
+    if baseline == 0:
+        return None
+    if metric.endswith("per_second"):
+        return value / baseline - 1
+    if metric.endswith("_ms") or metric.endswith("_seconds"):
+        return baseline / value - 1 if value > 0 else None
+    return None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Print changes of metrics present in both results
+
+    :return: metrics that got worse by more than threshold
+    """
+    current, previous = flatten(results["results"]), flatten(baseline["results"])
+    regressions = []
+    print(f'\nBaseline: {baseline["meta"].get("created", "")} {baseline["meta"].get("commit", "")[:12]}')
+    parameters, baseline_parameters = results["meta"]["parameters"], baseline["meta"].get("parameters", {})
+    different = [key for key in COMPARED_PARAMETERS if parameters.get(key) != baseline_parameters.get(key)]
+    if len(different) > 0:
+        print(f'Warning: results are measured with different parameters: {", ".join(different)}')
+    for key in ["cpu_count", "lemmatization"]:
+        if results["meta"][key] != baseline["meta"].get(key):
+            print(f'Warning: different {key}: {baseline["meta"].get(key)} -> {results["meta"][key]}')
+    print(f'{"metric":<70} {"baseline":>12} {"current":>12} {"change":>8}')
+    for metric in sorted(current.keys() & previous.keys()):
+        relative = change(metric, current[metric], previous[metric])
+        if relative is None:
+            continue
+        mark = ""
+        if relative < -threshold:
+            regressions.append(metric)
+            mark = " worse"
+        elif relative > threshold:
+            mark = " better"
+        print(f'{metric:<70} {previous[metric]:>12.4g} {current[metric]:>12.4g} {relative:>+8.1%}{mark}')
+    for metric in sorted(previous.keys() - current.keys()):
+        print(f'{metric:<70} is not measured')
+    return regressions
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmarks of preprocessing, vectorization, inference and service")
+    parser.add_argument("--docs", type=int, default=DOCS, help="number of synthetic tickets")
+    parser.add_argument("--seed", type=int, default=SEED, help="random seed of corpus")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="timed passes, the fastest is reported")
+    parser.add_argument("--default-stop-words", type=int, default=DEFAULT_STOP_WORDS)
+    parser.add_argument("--custom-stop-words", type=int, default=CUSTOM_STOP_WORDS)
+    parser.add_argument("--max-sequence-length", type=int, default=MAX_SEQUENCE_LENGTH)
+    parser.add_argument("--num-words", type=int, default=NUM_WORDS, help="dictionary size, 0 - all words")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--predictions", type=int, default=PREDICTIONS, help="predictions of every model")
+    parser.add_argument("--skip-models", action="store_true", help="do not measure models")
+    parser.add_argument("--service-setting", help="start service with this setting and measure /predict")
+    parser.add_argument("--port", type=int, default=5099, help="port of service started with --service-setting")
+    parser.add_argument("--url", help="measure /predict of running service, e.g. http://127.0.0.1:5000")
+    parser.add_argument("--requests", type=int, default=REQUESTS, help="/predict requests")
+    parser.add_argument("--threads", type=int, default=THREADS, help="concurrent clients")
+    parser.add_argument("--output", help="json file for results")
+    parser.add_argument("--baseline", help="json file of previous results to compare with")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="relative change counted as regression")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    logging.disable(logging.INFO)
+    suite_results = run_suite(arguments)
+    if arguments.output is not None:
+        with open(arguments.output, "w", encoding="utf-8") as output:
+            json.dump(suite_results, output, indent=2, ensure_ascii=False)
+        print(f'Results saved to: {arguments.output}')
+    if arguments.baseline is not None:
+        with open(arguments.baseline, encoding="utf-8") as baseline_file:
+            worse = compare(suite_results, json.load(baseline_file), arguments.threshold)
+        if len(worse) > 0:
+            print(f'{len(worse)} metric(s) got worse by more than {arguments.threshold:.0%}')
+            sys.exit(1)
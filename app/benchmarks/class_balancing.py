@@ -0,0 +1,93 @@
+import contextlib
+import io
+import logging
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from preprocessor.preprocess import process_duplicates
+from trainer.data_balancer import trim_minor_classes, get_sample_ratio
+
+CLASS_COUNTS = [10, 100, 800]
+ROWS = 200000
+
+
+def legacy_trim_minor_classes(data: pd.DataFrame, min_class_data: int) -> pd.DataFrame:
+    classes = data['class_id'].unique()
+    for class_id in classes:
+        class_shape = data[data['class_id'] == class_id].shape[0]
+        if class_shape < min_class_data:
+            print(f'Deleting under shape class [{class_id}]')
+            data = data.drop(data[data['class_id'] == class_id].index)
+            data.reset_index(drop=True)
+    return data
+
+
+def legacy_get_sample_ratio(y: pd.Series, sample_value: int) -> dict:
+    ratio = {}
+    for clazz in y.unique():
+        if y[y.values == clazz].count() < sample_value:
+            ratio[int(clazz)] = sample_value
+    return ratio
+
+
+def legacy_process_duplicates(data: pd.DataFrame, group_column: str) -> pd.DataFrame:
+    for class_id in data[group_column].unique():
+        duplicates = data[data[group_column] == class_id]['text'].duplicated(keep="first")
+        data = data.drop(duplicates[duplicates.values].index)
+    return data
+
+
+def generate_data(rows: int, classes: int, seed=42) -> pd.DataFrame:
+    """
+    Dataset with skewed class sizes and ~30% duplicated texts
+    """
+    random = np.random.default_rng(seed)
+    class_ids = (random.zipf(1.3, rows) % classes) + 1000
+    texts = random.integers(0, int(rows * 0.7), rows).astype(str)
+    return pd.DataFrame({'class_id': class_ids, 'text': np.char.add('text ', texts)})
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_class_balancing(rows: int = ROWS, class_counts=None) -> None:
+    """
+    Compare loop per class and vectorized implementations on synthetic datasets with different number of classes.
+    Results of both must be identical
+    """
+    logging.disable(logging.INFO)
+    print(f'{"stage":<20} {"classes":>8} {"legacy, s":>10} {"vectorized, s":>14} {"speedup":>8}')
+    for classes in class_counts or CLASS_COUNTS:
+        data = generate_data(rows, classes)
+        min_class_data = int(data['class_id'].value_counts().median())
+        stages = [
+            ("trim_minor_classes", (legacy_trim_minor_classes, data, min_class_data),
+             (trim_minor_classes, data, min_class_data)),
+            ("get_sample_ratio", (legacy_get_sample_ratio, data['class_id'], min_class_data),
+             (get_sample_ratio, data['class_id'], min_class_data, "oversample")),
+            ("process_duplicates", (legacy_process_duplicates, data, 'class_id'),
+             (process_duplicates, data, 'class_id')),
+        ]
+        for name, legacy, vectorized in stages:
+            expected, legacy_time = measure(*legacy)
+            actual, vectorized_time = measure(*vectorized)
+            if isinstance(expected, pd.DataFrame):
+                pd.testing.assert_frame_equal(expected, actual)
+            elif expected != actual:
+                raise AssertionError(f'Different results of {name}')
+            print(f'{name:<20} {classes:>8} {legacy_time:>10.3f} {vectorized_time:>14.3f} '
+                  f'{legacy_time / vectorized_time:>7.1f}x')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: class_balancing.py [rows]. Exit...")
+    else:
+        benchmark_class_balancing(int(sys.argv[1]) if len(sys.argv) == 2 else ROWS)
@@ -0,0 +1,42 @@
+import sys
+import time
+
+from settings import get_setting, SettingType
+from utils import text_utils
+from utils.file_utils import read_dataset
+
+
+def benchmark_html_cleaning(file_path: str, rows: int = None) -> None:
+    """
+    Compare BeautifulSoup and tiered html cleaning on texts of dataset (e.g. raw email bodies):
+    outputs must be identical, prints throughput of both and number of texts cleaned by every tier
+    """
+    texts = [text for text in read_dataset(file_path)['text'].tolist()[:rows] if isinstance(text, str)]
+    plain = sum(1 for text in texts if '<' not in text and '&' not in text)
+    simple = sum(1 for text in texts if ('<' in text or '&' in text) and text_utils.strip_simple_html(text) is not None)
+
+    start = time.perf_counter()
+    expected = [text_utils.clean_html_tags_bs4(text) for text in texts]
+    bs4_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [text_utils.clean_html_tags(text) for text in texts]
+    tiered_time = time.perf_counter() - start
+
+    mismatches = [i for i, (a, b) in enumerate(zip(expected, actual)) if a != b]
+    print(f'Texts: {len(texts)} (plain: {plain}, simple html: {simple}, BeautifulSoup: {len(texts) - plain - simple})')
+    print(f'BeautifulSoup: {bs4_time:.3f} s ({len(texts) / bs4_time:.0f} texts/s)')
+    print(f'Tiered:        {tiered_time:.3f} s ({len(texts) / tiered_time:.0f} texts/s)')
+    print(f'Speedup: {bs4_time / tiered_time:.2f}x')
+    if len(mismatches) > 0:
+        print(f'Different output for {len(mismatches)} text(s). First text: {texts[mismatches[0]]!r}\n'
+              f'BeautifulSoup: {expected[mismatches[0]]!r}\nTiered:        {actual[mismatches[0]]!r}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: html_cleaning.py preprocessor_config.json [rows]. Exit...")
+    else:
+        benchmark_html_cleaning(get_setting(str(sys.argv[1]), SettingType.cleaner).input_data_path,
+                                int(sys.argv[2]) if len(sys.argv) == 3 else None)
@@ -0,0 +1,88 @@
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+# ml_service imports service modules without package prefix
+sys.path.append(str(Path(os.path.dirname(os.path.abspath(__file__))).parent / "service"))
+
+from utils import logger_utils
+from utils.file_utils import read_dataset
+
+REQUESTS = 2000
+THREADS = 4
+
+
+def measure_latency(client_factory, texts: list, requests: int, threads: int) -> np.ndarray:
+    """
+    Send 'requests' /predict requests from 'threads' concurrent clients
+
+    :return: latency of every request, ms
+    """
+    latencies = []
+
+    def run(offset: int) -> None:
+        client = client_factory()
+        for i in range(offset, requests, threads):
+            start = time.perf_counter()
+            response = client.post('/predict', json={"text": texts[i % len(texts)]})
+            response.get_data()
+            response.close()
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                raise AssertionError(f'/predict responded {response.status_code}')
+
+    workers = [threading.Thread(target=run, args=(offset,)) for offset in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return np.array(latencies)
+
+
+def benchmark_service_latency(setting_path: str, requests: int = REQUESTS, threads: int = THREADS) -> None:
+    """
+    Latency of /predict with synchronous and async (queue) logging, with and without payload logging.
+    Texts are taken from input dataset of the service preprocessor setting
+    """
+    os.environ["ML_SERVICE_SETTINGS"] = setting_path
+    # ml_service takes setting path from the only command line argument
+    sys.argv = sys.argv[:1]
+    import ml_service
+    ml_service.init_thread.join()
+    if ml_service.service_state != ml_service.STATE_UP:
+        raise RuntimeError(f'Service is not started: {ml_service.service_state}')
+    setting = ml_service.service_settings
+    texts = read_dataset(ml_service.preprocessor_settings.input_data_path)['text'].dropna().tolist()[:requests]
+    log_file = os.path.join(setting.log_path, setting.name)
+    payload_sampler = logger_utils.PayloadSampler(setting.payload_logging_setting.sample_rate,
+                                                  setting.payload_logging_setting.max_length)
+
+    # Printed after logging is stopped, so results are not mixed with console logs
+    results = [f'Requests: {requests}, threads: {threads}',
+               f'{"logging":<8} {"payloads":<9} {"mean, ms":>9} {"p50, ms":>8} {"p95, ms":>8} {"p99, ms":>8} '
+               f'{"requests/s":>11}']
+    for use_queue in [False, True]:
+        for log_payloads in [False, True]:
+            logger_utils.init_logging(log_file, use_queue=use_queue,
+                                      queue_size=setting.async_logging_setting.queue_size)
+            ml_service.payload_sampler = payload_sampler if log_payloads else None
+            start = time.perf_counter()
+            latencies = measure_latency(ml_service.app.test_client, texts, requests, threads)
+            elapsed = time.perf_counter() - start
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            results.append(f'{"async" if use_queue else "sync":<8} {"on" if log_payloads else "off":<9} '
+                           f'{latencies.mean():>9.2f} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f} {requests / elapsed:>11.0f}')
+    logger_utils.stop_logging()
+    print("\n".join(results))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print("Usage: service_latency.py path/to/service_config.json [requests] [threads]. Exit...")
+    else:
+        benchmark_service_latency(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else REQUESTS,
+                                  int(sys.argv[3]) if len(sys.argv) > 3 else THREADS)
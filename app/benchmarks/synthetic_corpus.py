@@ -0,0 +1,129 @@
+import os
+import random
+import sys
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+
+sys.path.append(str(Path(os.path.dirname(os.path.abspath(__file__))).parent))
+
+from utils.file_utils import save_dataset
+
+DOCS = 10000
+SEED = 42
+# Signatures of generated tickets as in 'email_setting'|'signatures'. Cleaner finds them in text in lower case only,
+# so half of generated signatures are written in lower case
+SIGNATURES = ["з повагою", "с уважением", "best regards"]
+
+LANGUAGES = {
+    "uk": {
+        "greetings": ["Добрий день!", "Доброго ранку.", "Вітаю,", "Шановна підтримко,", ""],
+        "subjects": ["принтер", "поштова скринька", "доступ до мережі", "обліковий запис", "ноутбук", "VPN",
+                     "телефон", "сервер звітів", "база даних", "програма обліку"],
+        "problems": ["не працює з ранку", "постійно видає помилку", "дуже повільно відкривається",
+                     "перестав підключатися після оновлення", "вимагає пароль кожні п'ять хвилин",
+                     "не друкує документи", "зависає під час запуску", "не синхронізується з сервером"],
+        "requests": ["Прошу перевірити та виправити якнайшвидше.", "Допоможіть, будь ласка, вирішити проблему.",
+                     "Потрібно надати доступ новому співробітнику.", "Просимо замінити обладнання.",
+                     "Чекаю на відповідь сьогодні.", "Заявку створено повторно, попередню закрили без рішення."],
+        "details": ["Номер кабінету {number}.", "Інвентарний номер {number}.", "Помилка з кодом {number}.",
+                    "Користувач працює у відділі продажів.", "Скріншот помилки додаю до листа."],
+        "names": ["Олена Петренко", "Іван Коваленко", "Марія Шевченко", "Андрій Бондаренко"],
+        "signature": "З повагою,",
+    },
+    "ru": {
+        "greetings": ["Добрый день!", "Здравствуйте,", "Коллеги, привет.", "Уважаемая поддержка,", ""],
+        "subjects": ["принтер", "почтовый ящик", "доступ к сети", "учетная запись", "ноутбук", "VPN", "телефон",
+                     "сервер отчетов", "база данных", "программа учета"],
+        "problems": ["не работает с утра", "постоянно выдает ошибку", "очень медленно открывается",
+                     "перестал подключаться после обновления", "требует пароль каждые пять минут",
+                     "не печатает документы", "зависает при запуске", "не синхронизируется с сервером"],
+        "requests": ["Прошу проверить и исправить как можно скорее.", "Помогите, пожалуйста, решить проблему.",
+                     "Нужно предоставить доступ новому сотруднику.", "Просим заменить оборудование.",
+                     "Жду ответа сегодня.", "Заявка создана повторно, предыдущую закрыли без решения."],
+        "details": ["Номер кабинета {number}.", "Инвентарный номер {number}.", "Ошибка с кодом {number}.",
+                    "Пользователь работает в отделе продаж.", "Скриншот ошибки прикладываю к письму."],
+        "names": ["Елена Петренко", "Иван Коваленко", "Мария Шевченко", "Андрей Бондаренко"],
+        "signature": "С уважением,",
+    },
+    "en": {
+        "greetings": ["Hello,", "Good morning!", "Hi team,", "Dear support,", ""],
+        "subjects": ["printer", "mailbox", "network access", "user account", "laptop", "VPN", "phone",
+                     "report server", "database", "accounting software"],
+        "problems": ["does not work since morning", "keeps showing an error", "opens very slowly",
+                     "stopped connecting after the update", "asks for password every five minutes",
+                     "does not print documents", "freezes on startup", "does not sync with the server"],
+        "requests": ["Please check and fix it as soon as possible.", "Could you please help to solve the issue?",
+                     "Please grant access to a new employee.", "Please replace the equipment.",
+                     "I expect an answer today.", "The ticket is created again, the previous one was closed."],
+        "details": ["Room number {number}.", "Inventory number {number}.", "Error code {number}.",
+                    "The user works in the sales department.", "The screenshot of the error is attached."],
+        "names": ["Olena Petrenko", "Ivan Kovalenko", "Maria Shevchenko", "Andrii Bondarenko"],
+        "signature": "Best regards,",
+    },
+}
+HTML_TEMPLATES = [
+    # Simple markup, cleaned without parser
+    "<p>{body}</p>",
+    "<div>{body}</div><br/>",
+    # Document with head, styles and tables, cleaned by BeautifulSoup
+    "<html><head><style>p {{margin: 0;}}</style></head><body><table><tr><td>{body}</td></tr></table>"
+    "<p>&nbsp;</p></body></html>",
+]
+
+
+def generate_ticket(rng: random.Random, language: str, subject: int, html_share=0.3, email_share=0.4,
+                    signature_share=0.6, url_share=0.2) -> str:
+    """
+    Support ticket (email body) in language about subject with optional html markup, email addresses, urls,
+    signature and quoted previous message
+    """
+    words = LANGUAGES[language]
+    lines = [rng.choice(words["greetings"]),
+             f'{words["subjects"][subject].capitalize()} {rng.choice(words["problems"])}.',
+             rng.choice(words["requests"])]
+    lines += [rng.choice(words["details"]).format(number=rng.randint(1, 99999)) for _ in range(rng.randint(0, 3))]
+    if rng.random() < email_share:
+        lines.append(f'Contact: user.{rng.randint(1, 9999)}@company.example, copy to helpdesk@company.example')
+    if rng.random() < url_share:
+        lines.append(f'https://intranet.company.example/tickets/{rng.randint(1, 99999)}?lang={language}')
+    if rng.random() < signature_share:
+        signature = words["signature"] if rng.random() < 0.5 else words["signature"].lower()
+        phone = f'+380 {rng.randint(10, 99)} {rng.randint(100, 999)} {rng.randint(10, 99)} {rng.randint(10, 99)}'
+        lines += [signature, rng.choice(words["names"]), phone]
+        if rng.random() < 0.3:
+            lines += ["-----Original Message-----", f'{rng.choice(words["problems"]).capitalize()}.']
+    lines = [line for line in lines if line != ""]
+    if rng.random() < html_share:
+        return rng.choice(HTML_TEMPLATES).format(body="<br>".join(lines))
+    return "\n".join(lines)
+
+
+def generate_corpus(docs: int = DOCS, seed: int = SEED, languages=("uk", "ru", "en"), **kwargs) -> pd.DataFrame:
+    """
+    Synthetic multilingual support tickets. The same docs and seed give the same corpus.
+    Class of ticket is its subject (the same for all languages)
+
+    :param docs: number of tickets
+    :param seed: random seed
+    :param languages: languages of tickets, chosen uniformly
+    :param kwargs: shares of tickets with html, emails, signatures and urls (see generate_ticket)
+    :return: DataFrame with 'class_id' and 'text' columns
+    """
+    rng = random.Random(seed)
+    class_ids: List[int] = []
+    texts: List[str] = []
+    for _ in range(docs):
+        subject = rng.randrange(len(LANGUAGES["en"]["subjects"]))
+        class_ids.append(subject + 1)
+        texts.append(generate_ticket(rng, rng.choice(languages), subject, **kwargs))
+    return pd.DataFrame({'class_id': class_ids, 'text': texts})
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3, 4]:
+        print("Usage: synthetic_corpus.py path/to/dataset.csv|.parquet|.feather [docs] [seed]. Exit...")
+    else:
+        save_dataset(generate_corpus(int(sys.argv[2]) if len(sys.argv) > 2 else DOCS,
+                                     int(sys.argv[3]) if len(sys.argv) > 3 else SEED), sys.argv[1])
@@ -0,0 +1,49 @@
+import sys
+import time
+
+from preprocessor.preprocess import create_stop_words_cleaner
+from settings import PreprocessorSetting, get_setting, SettingType
+from utils import text_utils
+from utils.file_utils import read_dataset
+
+
+def benchmark_text_cleaning(setting: PreprocessorSetting, rows: int = None) -> None:
+    """
+    Compare clean_text and TextNormalizer on the first rows of preprocessor input dataset:
+    outputs must be identical, prints throughput of both
+    """
+    texts = read_dataset(setting.input_data_path)['text'].tolist()[:rows]
+    cleaner = create_stop_words_cleaner(setting)
+    if setting.use_words_lemmatization:
+        text_utils.init_lemma_cache(setting.words_lemmatization_setting)
+    normalizer = text_utils.TextNormalizer.from_setting(setting, cleaner.processor, cleaner.default_stop_words)
+    # Warm up lemma cache, so both functions are measured with the same cache state
+    expected = [text_utils.clean_text_with_setting(text, setting, cleaner.processor, cleaner.default_stop_words)
+                for text in texts]
+
+    start = time.perf_counter()
+    for text in texts:
+        text_utils.clean_text_with_setting(text, setting, cleaner.processor, cleaner.default_stop_words)
+    clean_text_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [normalizer(text) for text in texts]
+    normalizer_time = time.perf_counter() - start
+
+    mismatches = [i for i, (a, b) in enumerate(zip(expected, actual)) if a != b]
+    print(f'Texts: {len(texts)}')
+    print(f'clean_text:     {clean_text_time:.3f} s ({len(texts) / clean_text_time:.0f} texts/s)')
+    print(f'TextNormalizer: {normalizer_time:.3f} s ({len(texts) / normalizer_time:.0f} texts/s)')
+    print(f'Speedup: {clean_text_time / normalizer_time:.2f}x')
+    if len(mismatches) > 0:
+        print(f'Different output for {len(mismatches)} text(s). First row: {mismatches[0]}\n'
+              f'clean_text:     {expected[mismatches[0]]!r}\nTextNormalizer: {actual[mismatches[0]]!r}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: text_cleaning.py preprocessor_config.json [rows]. Exit...")
+    else:
+        benchmark_text_cleaning(get_setting(str(sys.argv[1]), SettingType.cleaner),
+                                int(sys.argv[2]) if len(sys.argv) == 3 else None)
@@ -1,13 +1,18 @@
 import os
-from pathlib import WindowsPath
+import threading
+from pathlib import Path
 
 import fasttext
 import pymorphy2
 
-current_file_path = WindowsPath(os.path.dirname(os.path.abspath(__file__)))
-PRETRAINED_LANG_MODEL = str(current_file_path.parent.parent) + "\\resources\\bin\\lid.176.bin"
-morph_ru = pymorphy2.MorphAnalyzer(lang="ru")
-morph_uk = pymorphy2.MorphAnalyzer(lang="uk")
+current_file_path = Path(os.path.dirname(os.path.abspath(__file__)))
+PRETRAINED_LANG_MODEL = str(current_file_path.parent.parent / "resources" / "bin" / "lid.176.bin")
+
+# Models are loaded on first use (or by load_models) and shared by all threads
+_language_lock = threading.Lock()
+_morph_lock = threading.Lock()
+_language = None
+_morph = {}
 
 
 def detect_language(text):
@@ -17,8 +22,9 @@ def detect_language(text):
     :param text: text
     :return: language code in ISO 639
     """
+    model = get_language_model()
     try:
-        labels, probs = LANGUAGE.predict_lang(text)
+        labels, probs = model.predict_lang(text)
         if len(labels) > 0:
             return labels[0][len("__label__"):]
         else:
@@ -36,4 +42,47 @@ class LanguageIdentification:
         return self.model.predict(text, threshold=0.7)
 
 
-LANGUAGE = LanguageIdentification()
+def get_language_model() -> LanguageIdentification:
+    global _language
+    if _language is None:
+        with _language_lock:
+            if _language is None:
+                _language = LanguageIdentification()
+    return _language
+
+
+def get_morph_analyzer(lang: str) -> pymorphy2.MorphAnalyzer:
+    """
+    :param lang: 'ru' or 'uk'
+    :return: pymorphy2 analyzer for the language
+    """
+    analyzer = _morph.get(lang)
+    if analyzer is None:
+        with _morph_lock:
+            analyzer = _morph.get(lang)
+            if analyzer is None:
+                analyzer = pymorphy2.MorphAnalyzer(lang=lang)
+                _morph[lang] = analyzer
+    return analyzer
+
+
+def load_models(russian=True, ukrainian=True) -> None:
+    """
+    Load language identification model and morph analyzers in advance
+    """
+    get_language_model()
+    if russian:
+        get_morph_analyzer("ru")
+    if ukrainian:
+        get_morph_analyzer("uk")
+
+
+def __getattr__(name):
+    # Backward compatibility for module attributes loaded on import before
+    if name == "LANGUAGE":
+        return get_language_model()
+    if name == "morph_ru":
+        return get_morph_analyzer("ru")
+    if name == "morph_uk":
+        return get_morph_analyzer("uk")
+    raise AttributeError(f'module {__name__} has no attribute {name}')
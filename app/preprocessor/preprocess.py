@@ -1,5 +1,8 @@
+import hashlib
 import json
 import logging
+import multiprocessing
+import os
 import sys
 
 import pandas as pd
@@ -8,10 +11,65 @@ from tqdm.auto import tqdm
 
 from settings import PreprocessorSetting, get_setting, SettingType
 from utils import logger_utils, text_utils
-from utils.file_utils import read_dataset, save_dataset
+from utils.corpus_cache import CorpusCache, file_digest, make_key
+from utils.file_utils import read_dataset, save_dataset, read_dataset_chunks, append_dataset, process_path
 from utils.stop_words_utils import StopWordsCleaner
 
 log = logging.getLogger("preprocess")
+CHECKPOINT_EXTENSION = ".progress"
+# Settings that do not change cleaned data, so they are not part of cache key
+CACHE_IGNORED_SETTINGS = ["name", "input_data_path", "output_data_path", "log_path", "cache_path",
+                          "use_parallel_cleaning", "parallel_cleaning_setting", "streaming_setting"]
+
+# Per worker process state for parallel cleaning. Initialized once in _init_worker
+_worker_setting: PreprocessorSetting = None
+_worker_cleaner: StopWordsCleaner = None
+_worker_normalizer: text_utils.TextNormalizer = None
+
+
+def execute_preprocessor(setting: PreprocessorSetting) -> None:
+    """
+    Clean input dataset. If 'cache_path' is set, cleaned data is restored from cache when input file,
+    stop words files and cleaning settings are the same as in one of the previous runs
+    """
+    cache, cache_key = None, None
+    if setting.cache_path != "":
+        cache = CorpusCache(setting.cache_path)
+        cache_key = cleaned_data_key(setting)
+        if cache.get_cleaned(cache_key, setting.output_data_path):
+            return
+    log.info("==> Start initialization")
+    if setting.use_words_lemmatization:
+        text_utils.init_lemma_cache(setting.words_lemmatization_setting)
+    cleaner = create_stop_words_cleaner(setting)
+    log.info("==> Preprocessor initialized")
+    if setting.use_streaming:
+        data_preprocess_streaming(setting=setting, custom_stop_words=cleaner.processor,
+                                  default_stop_words=cleaner.default_stop_words)
+    else:
+        data_preprocess(setting=setting, custom_stop_words=cleaner.processor,
+                        default_stop_words=cleaner.default_stop_words)
+    if cache is not None:
+        cache.put_cleaned(cache_key, setting.output_data_path)
+
+
+def cleaned_data_key(setting: PreprocessorSetting) -> str:
+    """
+    Cache key of cleaned data: hash of input file, stop words files and settings used by cleaning
+    """
+    stop_words_setting = setting.stop_words_settings
+    stop_words_files = {}
+    if setting.clean_stop_words:
+        for path in [stop_words_setting.alt_stop_words_file, stop_words_setting.custom_stop_words_path]:
+            if path != "":
+                stop_words_files[path] = file_digest(path)
+    cleaning_setting = {key: value for key, value in setting.__dict__.items() if key not in CACHE_IGNORED_SETTINGS}
+    # Lemmas cache size and warm up dictionary change speed of lemmatization only, not its result
+    lemmatization_setting = setting.words_lemmatization_setting
+    cleaning_setting["words_lemmatization_setting"] = {"russian": lemmatization_setting.russian,
+                                                       "ukrainian": lemmatization_setting.ukrainian}
+    return make_key(input_data=file_digest(setting.input_data_path), stop_words_files=stop_words_files,
+                    setting=cleaning_setting)
 
 
 @logger_utils.profile
@@ -22,17 +80,211 @@ def data_preprocess(setting: PreprocessorSetting, custom_stop_words: KeywordProc
         data = process_duplicates(data, "class_id", drop_all=setting.drop_all_duplicates,
                                   class_list=setting.drop_duplicates_class_list)
     log.info("Start text cleaning")
-    tqdm.pandas(desc="cleaning text", ncols=100, mininterval=1, unit="row", colour="green")
-    data["text"] = data["text"].progress_apply(text_utils.clean_text_with_setting,
-                                               args=(setting, custom_stop_words, default_stop_words))
+    if setting.use_parallel_cleaning:
+        data["text"] = clean_text_parallel(data["text"], setting)
+    else:
+        tqdm.pandas(desc="cleaning text", ncols=100, mininterval=1, unit="row", colour="green")
+        normalizer = text_utils.TextNormalizer.from_setting(setting, custom_stop_words, default_stop_words)
+        data["text"] = data["text"].progress_apply(normalizer)
     log.info(f'Drop {data[data["text"] == ""].shape[0]} row(s) after text cleaning')
     data = data[data['text'] != ""]
     data.reset_index(drop=True)
+    if setting.use_words_lemmatization and not setting.use_parallel_cleaning:
+        log.info(f'Lemma cache: {text_utils.LEMMA_CACHE.stats()}')
 
     log.info(f'Cleaning finished. Data shape: {data.shape}')
     save_dataset(data, setting.output_data_path)
 
 
+@logger_utils.profile
+def data_preprocess_streaming(setting: PreprocessorSetting, custom_stop_words: KeywordProcessor,
+                              default_stop_words: set) -> None:
+    """
+    Read input dataset by chunks, clean each chunk and append it to the output file.
+    Progress is saved to checkpoint file next to the output after every chunk,
+    so interrupted run continues from the last finished chunk (if 'resume' is enabled)
+    """
+    streaming_setting = setting.streaming_setting
+    output_path = process_path(setting.output_data_path, make_dirs=True, file_extension='.csv')
+    checkpoint_path = output_path + CHECKPOINT_EXTENSION
+    checkpoint = _checkpoint_state(setting)
+    done_chunks, output_size = 0, 0
+    if streaming_setting.resume:
+        done_chunks, output_size = _load_checkpoint(checkpoint_path, checkpoint)
+    # Drop everything written after the last finished chunk
+    with open(output_path, 'ab') as file:
+        file.truncate(output_size)
+    if done_chunks > 0:
+        log.info(f'Resume from chunk {done_chunks} ({output_size} bytes already written to {output_path})')
+
+    duplicates_filter = None
+    if setting.drop_all_duplicates or len(setting.drop_duplicates_class_list) > 0:
+        duplicates_filter = DuplicatesFilter("class_id", drop_all=setting.drop_all_duplicates,
+                                             class_list=setting.drop_duplicates_class_list)
+    pool = create_cleaning_pool(setting) if setting.use_parallel_cleaning else None
+    normalizer = text_utils.TextNormalizer.from_setting(setting, custom_stop_words, default_stop_words)
+    rows_read, rows_saved = 0, 0
+    log.info("Start text cleaning")
+    try:
+        with tqdm(desc="cleaning text", ncols=100, mininterval=1, unit="row", colour="green") as progress:
+            for number, data in enumerate(read_dataset_chunks(setting.input_data_path,
+                                                              streaming_setting.chunk_size)):
+                # Finished chunks are still filtered to restore seen duplicates
+                if duplicates_filter is not None:
+                    data = duplicates_filter.filter(data)
+                if number < done_chunks:
+                    continue
+                rows_read += data.shape[0]
+                if pool is not None:
+                    data["text"] = _clean_in_pool(pool, data["text"], setting.parallel_cleaning_setting.chunk_size,
+                                                  progress)
+                else:
+                    data["text"] = data["text"].apply(normalizer)
+                    progress.update(data.shape[0])
+                data = data[data['text'] != ""]
+                rows_saved += data.shape[0]
+                output_size = append_dataset(data, output_path)
+                checkpoint['chunks_done'] = number + 1
+                checkpoint['output_size'] = output_size
+                _save_checkpoint(checkpoint_path, checkpoint)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if duplicates_filter is not None:
+        log.info(f'Dropped {duplicates_filter.dropped} duplicate(s)')
+    log.info(f'Drop {rows_read - rows_saved} row(s) after text cleaning')
+    if setting.use_words_lemmatization and not setting.use_parallel_cleaning:
+        log.info(f'Lemma cache: {text_utils.LEMMA_CACHE.stats()}')
+    # No checkpoint is written if input has no chunks
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    log.info(f'Cleaning finished. Saved {rows_saved} row(s) to: {output_path}')
+
+
+class DuplicatesFilter:
+    """
+    Drops duplicated texts within class across all chunks of dataset.
+    Keeps hashes of (class_id, text) of all seen rows, so only the first occurrence is kept
+    """
+
+    def __init__(self, group_column: str, drop_all=True, class_list=None) -> None:
+        self.group_column = group_column
+        self.drop_all = drop_all
+        self.class_list = set() if class_list is None else set(class_list)
+        self.seen = set()
+        self.dropped = 0
+
+    def filter(self, data: pd.DataFrame) -> pd.DataFrame:
+        keep = []
+        for class_id, text in zip(data[self.group_column], data['text']):
+            if not self.drop_all and class_id not in self.class_list:
+                keep.append(True)
+                continue
+            key = hashlib.blake2b(f'{class_id}\x1f{text}'.encode('utf-8'), digest_size=8).digest()
+            if key in self.seen:
+                keep.append(False)
+            else:
+                self.seen.add(key)
+                keep.append(True)
+        self.dropped += len(keep) - sum(keep)
+        return data[keep]
+
+
+def _checkpoint_state(setting: PreprocessorSetting) -> dict:
+    input_path = process_path(setting.input_data_path)
+    return {
+        "input_data_path": input_path,
+        "input_size": os.path.getsize(input_path),
+        "input_mtime": os.path.getmtime(input_path),
+        "chunk_size": setting.streaming_setting.chunk_size,
+        "chunks_done": 0,
+        "output_size": 0
+    }
+
+
+def _load_checkpoint(checkpoint_path: str, state: dict) -> tuple:
+    """
+    :return: (finished chunks, output file size) from checkpoint if it matches current input and chunk size
+    """
+    if not os.path.exists(checkpoint_path):
+        return 0, 0
+    with open(checkpoint_path, "r", encoding="utf-8") as file:
+        checkpoint = json.load(file)
+    for key in ["input_data_path", "input_size", "input_mtime", "chunk_size"]:
+        if checkpoint.get(key) != state[key]:
+            log.warning(f'Checkpoint {checkpoint_path} does not match current run ({key}). Start from scratch')
+            return 0, 0
+    return checkpoint['chunks_done'], checkpoint['output_size']
+
+
+def _save_checkpoint(checkpoint_path: str, state: dict) -> None:
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(state, file)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def clean_text_parallel(texts: pd.Series, setting: PreprocessorSetting) -> pd.Series:
+    """
+    Clean texts in a pool of worker processes. Texts are split into chunks of 'chunk_size' rows.
+    Each worker builds stop words and language models once. Order of rows is preserved
+
+    :param texts: texts to clean
+    :param setting: preprocessor setting
+    :return: cleaned texts with the same index
+    """
+    with create_cleaning_pool(setting) as pool, \
+            tqdm(total=texts.shape[0], desc="cleaning text", ncols=100, mininterval=1, unit="row",
+                 colour="green") as progress:
+        return _clean_in_pool(pool, texts, setting.parallel_cleaning_setting.chunk_size, progress)
+
+
+def create_cleaning_pool(setting: PreprocessorSetting) -> multiprocessing.Pool:
+    parallel_setting = setting.parallel_cleaning_setting
+    workers = parallel_setting.workers if parallel_setting.workers > 0 else os.cpu_count()
+    log.info(f'Parallel cleaning with {workers} worker(s) by {parallel_setting.chunk_size} row(s)')
+    return multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(setting,))
+
+
+def _clean_in_pool(pool: multiprocessing.Pool, texts: pd.Series, chunk_size: int, progress: tqdm) -> pd.Series:
+    chunks = [texts.iloc[i:i + chunk_size].tolist() for i in range(0, texts.shape[0], chunk_size)]
+    cleaned = []
+    # imap returns results in the order of chunks
+    for chunk in pool.imap(_clean_chunk, chunks):
+        cleaned.extend(chunk)
+        progress.update(len(chunk))
+    return pd.Series(cleaned, index=texts.index, dtype=object)
+
+
+def _init_worker(setting: PreprocessorSetting) -> None:
+    global _worker_setting, _worker_cleaner, _worker_normalizer
+    _worker_setting = setting
+    if setting.use_words_lemmatization:
+        text_utils.init_lemma_cache(setting.words_lemmatization_setting)
+    _worker_cleaner = create_stop_words_cleaner(setting)
+    _worker_normalizer = text_utils.TextNormalizer.from_setting(setting, _worker_cleaner.processor,
+                                                                _worker_cleaner.default_stop_words)
+
+
+def _clean_chunk(texts: list) -> list:
+    return [_worker_normalizer(text) for text in texts]
+
+
+def create_stop_words_cleaner(setting: PreprocessorSetting) -> StopWordsCleaner:
+    stop_words_setting = setting.stop_words_settings
+    cleaner = StopWordsCleaner(load_uk=stop_words_setting.use_uk_stop_words,
+                               load_ru=stop_words_setting.use_ru_stop_words,
+                               alt_stop_words_file=stop_words_setting.alt_stop_words_file,
+                               custom_path=stop_words_setting.custom_stop_words_path,
+                               use_file_cleanup=stop_words_setting.use_file_cleanup,
+                               cleanup_function=text_utils.clean_text,
+                               lemmatize_russian=True, lemmatize_ukrainian=True)
+    if setting.clean_stop_words:
+        cleaner.fit_text()
+        log.info("Total stop words: {}".format(len(cleaner.default_stop_words) + len(cleaner.processor)))
+    return cleaner
+
+
 def process_duplicates(data: pd.DataFrame, group_column: str, drop_all=True, class_list=None) -> pd.DataFrame:
     if drop_all:
         classes = data[group_column].unique()
@@ -43,11 +295,17 @@ def process_duplicates(data: pd.DataFrame, group_column: str, drop_all=True, cla
     else:
         log.info(f'Drop duplicates processor skipped...')
         return data
+    # Text duplicates within every class in one pass. Rows without class are not compared
+    duplicates = data.duplicated(subset=[group_column, 'text'], keep="first") & data[group_column].notna()
+    if not drop_all:
+        duplicates &= data[group_column].isin(classes)
+    duplicates_count = data.loc[duplicates, group_column].value_counts()
+    logged = set()
     for class_id in classes:
-        duplicates = data[data[group_column] == class_id]['text'].duplicated(keep="first")
-        data = data.drop(duplicates[duplicates.values].index)
-        log.info(f'=> Drop {duplicates[duplicates.values].shape[0]} duplicate(s) of {group_column}: {class_id}')
-    return data
+        count = duplicates_count.get(class_id, 0) if class_id not in logged else 0
+        logged.add(class_id)
+        log.info(f'=> Drop {count} duplicate(s) of {group_column}: {class_id}')
+    return data[~duplicates]
 
 
 if __name__ == "__main__":
@@ -57,20 +315,6 @@ if __name__ == "__main__":
         preprocessor_settings: PreprocessorSetting = get_setting(str(sys.argv[1]), SettingType.cleaner)
         logger_utils.init_logging(preprocessor_settings.log_path + "\\" + preprocessor_settings.name)
         log.info(f'Using settings:\n{json.dumps(preprocessor_settings.__dict__, default=lambda x: x.__dict__)}')
-        log.info("==> Start initialization")
-        stop_words_setting = preprocessor_settings.stop_words_settings
-        cleaner = StopWordsCleaner(load_uk=stop_words_setting.use_uk_stop_words,
-                                   load_ru=stop_words_setting.use_ru_stop_words,
-                                   alt_stop_words_file=stop_words_setting.alt_stop_words_file,
-                                   custom_path=stop_words_setting.custom_stop_words_path,
-                                   use_file_cleanup=stop_words_setting.use_file_cleanup,
-                                   cleanup_function=text_utils.clean_text,
-                                   lemmatize_russian=True, lemmatize_ukrainian=True)
-        if preprocessor_settings.clean_stop_words:
-            cleaner.fit_text()
-            log.info("Total stop words: {}".format(len(cleaner.default_stop_words) + len(cleaner.processor)))
-        log.info("==> Preprocessor initialized")
-        data_preprocess(setting=preprocessor_settings, custom_stop_words=cleaner.processor,
-                        default_stop_words=cleaner.default_stop_words)
+        execute_preprocessor(preprocessor_settings)
     else:
         print("Unknown number of arguments! Exit...")
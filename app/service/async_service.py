@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio variant of ml_service (aiohttp). Preprocessing and inference run in a bounded thread pool, event loop only
+receives requests and sends responses. Requests over 'max_pending_requests' are rejected with 429, requests that
+are not served before their deadline are cancelled with 503. Both responses have Retry-After header.
+
+    python async_service.py path/to/service_config.json
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from aiohttp import web
+
+# add path to sources for production
+sys.path.append(str(Path(os.path.dirname(os.path.abspath(__file__))).parent))
+
+from serving_model import ModelRegistry, ServingModel, load_model, register_metrics
+from settings import get_setting, SettingType, ServiceSetting, DEFAULT_MODEL
+from utils import logger_utils, metrics
+
+log = logging.getLogger("async_service")
+
+SERVICE_CONFIG = "ML_SERVICE_SETTINGS"
+# Client can shorten deadline of request (milliseconds)
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout-Ms"
+MODEL_VERSION_HEADER = "X-Model-Version"
+EMPTY_PREDICTIONS = json.dumps({"predictions": None})
+STATE_STARTING = "STARTING"
+STATE_UP = "UP"
+STATE_DOWN = "DOWN"
+READINESS_FREE_PATHS = ['/', '/health', '/metrics']
+MODEL_CLOSE_TIMEOUT = 60
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class AsyncPredictionService:
+    """
+    Request handlers and state of the service: model registry, executor and number of pending requests
+    """
+
+    def __init__(self, service_setting: ServiceSetting) -> None:
+        self.service_setting = service_setting
+        self.setting = service_setting.async_service_setting
+        self.executor = ThreadPoolExecutor(max_workers=self.setting.executor_workers or os.cpu_count(),
+                                           thread_name_prefix="predict")
+        self.state = STATE_STARTING
+        # Requests admitted to prediction and not answered yet
+        self.pending = 0
+        self.model_settings = {name: service_setting.model_setting(name) for name in service_setting.model_names()}
+        self.registry = ModelRegistry(lambda name: load_model(self.model_settings[name]),
+                                      service_setting.model_names(), max_loaded=service_setting.max_loaded_models,
+                                      pinned=[DEFAULT_MODEL], close_timeout=MODEL_CLOSE_TIMEOUT)
+        register_metrics(self.registry)
+        metrics.REGISTRY.callback("pending_requests", metrics.GAUGE, "Prediction requests in progress and in queue",
+                                  lambda: [({}, self.pending)])
+        self.payload_sampler = None
+        if service_setting.use_payload_logging:
+            self.payload_sampler = logger_utils.PayloadSampler(service_setting.payload_logging_setting.sample_rate,
+                                                               service_setting.payload_logging_setting.max_length)
+        self._init_task: asyncio.Task = None
+
+    async def start(self, app: web.Application) -> None:
+        # Server accepts requests while models are loading: '/health' responds 503 with status STARTING
+        self._init_task = asyncio.ensure_future(self._init_models())
+
+    async def stop(self, app: web.Application) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.registry.close)
+        self.executor.shutdown(wait=False)
+        log.info("Application shout down!")
+
+    async def _init_models(self) -> None:
+        log.info("==> Start service initialization")
+        try:
+            for name in self.service_setting.model_names():
+                if 0 < self.service_setting.max_loaded_models <= len(self.registry.loaded()):
+                    break
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.registry.ensure_loaded, name)
+            self.state = STATE_UP
+            log.info(f'==> Service initialized. Loaded models: {self.registry.loaded()}')
+        except Exception as e:
+            self.state = STATE_DOWN
+            log.error(f'Service initialization failed: {e}', exc_info=True)
+
+    @web.middleware
+    async def handle_errors(self, request: web.Request, handler) -> web.StreamResponse:
+        try:
+            return await handler(request)
+        except web.HTTPException:
+            raise
+        except DeadlineExceeded:
+            return self.retry_later(web.Response(text='Request deadline exceeded', status=503))
+        except Exception as e:
+            log.error("Got exception: " + str(e), exc_info=True)
+            return web.Response(text=str(e), status=500)
+
+    @web.middleware
+    async def count_response(self, request: web.Request, handler) -> web.StreamResponse:
+        if not metrics.REGISTRY.enabled:
+            return await handler(request)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            resource = request.match_info.route.resource
+            endpoint = resource.canonical if resource is not None else "unknown"
+            metrics.REGISTRY.histogram("http_request_seconds", "Time of request handling, seconds",
+                                       endpoint=endpoint).observe(time.perf_counter() - start)
+            metrics.REGISTRY.counter("http_responses_total", "Responses by endpoint and status",
+                                     endpoint=endpoint, status=str(status)).inc()
+
+    @web.middleware
+    async def check_ready(self, request: web.Request, handler) -> web.StreamResponse:
+        if self.state != STATE_UP and request.path not in READINESS_FREE_PATHS:
+            return self.retry_later(web.Response(text=f'Service is not ready: {self.state}', status=503))
+        return await handler(request)
+
+    async def root_response(self, request: web.Request) -> web.Response:
+        return web.Response(text='Machine learning service')
+
+    async def check_health(self, request: web.Request) -> web.Response:
+        return web.json_response(f'status: {self.state}', status=200 if self.state == STATE_UP else 503)
+
+    async def export_metrics(self, request: web.Request) -> web.Response:
+        if not metrics.REGISTRY.enabled:
+            raise web.HTTPNotFound(text=json.dumps('Metrics are disabled'), content_type='application/json')
+        if request.query.get('format') == 'json':
+            return web.json_response(metrics.REGISTRY.snapshot())
+        return web.Response(body=metrics.REGISTRY.export().encode("utf-8"),
+                            headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    async def show_model(self, request: web.Request) -> web.Response:
+        serving_model = await self.acquire(self.model_name(request))
+        try:
+            if serving_model.predictor.model is None:
+                return web.Response(text='Model not loaded!')
+            summary = []
+            serving_model.predictor.model.summary(print_fn=summary.append)
+            return web.Response(text='\n'.join(summary), content_type='text/plain')
+        finally:
+            serving_model.release()
+
+    async def predict(self, request: web.Request) -> web.Response:
+        body = await json_body(request)
+        if not body or 'text' not in body:
+            return web.Response(text='Request does not contain json or "text" attribute', status=500)
+        deadline = self.deadline(request)
+        if self.pending >= self.setting.max_pending_requests:
+            return self.retry_later(web.Response(text='Too many requests', status=429))
+        self.pending += 1
+        try:
+            serving_model = await self.acquire(self.model_name(request, body))
+            try:
+                return self.versioned(await self._predict(serving_model, body['text'], deadline), serving_model)
+            finally:
+                serving_model.release()
+        finally:
+            self.pending -= 1
+
+    async def _predict(self, serving_model: ServingModel, text: str, deadline: Optional[float]) -> web.Response:
+        if text == "":
+            return web.Response(text=EMPTY_PREDICTIONS, content_type='application/json')
+        predictor = serving_model.predictor
+        top_n = serving_model.service_setting.top_n_predictions
+        log_payload = self.payload_sampler is not None and self.payload_sampler.sample()
+        if log_payload:
+            log.info(f'Body: {self.payload_sampler.truncate(text)}')
+        text = await self.run(deadline, predictor.preprocess_text, text, serving_model.preprocessor_setting)
+        if log_payload:
+            log.info(f'Preprocessed text: {self.payload_sampler.truncate(text)}')
+        if serving_model.batcher is not None:
+            predictions = predictor.get_cached_prediction(text, top_n)
+            if predictions is None:
+                # Cancelled request is skipped by batcher if it is still in queue
+                predictions = await self.wait(asyncio.wrap_future(serving_model.batcher.submit(text)), deadline)
+        else:
+            predictions = await self.run(deadline, predictor.get_prediction, text, top_n)
+        return web.Response(text=predictions, content_type='application/json')
+
+    async def acquire(self, name: str) -> ServingModel:
+        """
+        Take model for request. Not loaded model (or model evicted meanwhile) is loaded by executor,
+        event loop is never blocked by model loading
+        """
+        while True:
+            model = self.registry.try_acquire(name)
+            if model is not None:
+                return model
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.registry.ensure_loaded, name)
+
+    async def run(self, deadline: Optional[float], function: Callable, *args) -> Any:
+        """
+        Call function by executor. Function is not called if request deadline passed while it waited in queue
+        """
+
+        def call():
+            if deadline is not None and time.monotonic() > deadline:
+                raise DeadlineExceeded()
+            return function(*args)
+
+        return await self.wait(asyncio.get_running_loop().run_in_executor(self.executor, call), deadline)
+
+    @staticmethod
+    async def wait(future: asyncio.Future, deadline: Optional[float]) -> Any:
+        """
+        :raises DeadlineExceeded if future is not done before deadline (future is cancelled)
+        """
+        if deadline is None:
+            return await future
+        try:
+            return await asyncio.wait_for(future, max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded()
+
+    def deadline(self, request: web.Request) -> Optional[float]:
+        """
+        Monotonic time until request must be served: 'request_timeout_ms' or shorter timeout of request header.
+        None if there is no timeout
+
+        :raises HTTPBadRequest if header timeout is not a positive number
+        """
+        timeout_ms = self.setting.request_timeout_ms
+        if REQUEST_TIMEOUT_HEADER in request.headers:
+            try:
+                request_timeout_ms = float(request.headers[REQUEST_TIMEOUT_HEADER])
+            except ValueError:
+                request_timeout_ms = math.nan
+            # Header can only shorten the deadline: zero, negative or not finite timeout would remove it
+            if not (0 < request_timeout_ms < math.inf):
+                raise web.HTTPBadRequest(text=f'Invalid {REQUEST_TIMEOUT_HEADER} header')
+            timeout_ms = min(timeout_ms, request_timeout_ms) if timeout_ms > 0 else request_timeout_ms
+        return time.monotonic() + timeout_ms / 1000 if timeout_ms > 0 else None
+
+    def model_name(self, request: web.Request, body: dict = None) -> str:
+        """
+        Requested model: URL segment, 'model' query parameter or 'model' field of json body. Default model if not set
+
+        :raises HTTPNotFound if there is no such model
+        """
+        model = request.match_info.get('model') or request.query.get('model') or \
+            (body.get('model') if isinstance(body, dict) else None) or DEFAULT_MODEL
+        if model not in self.registry:
+            raise web.HTTPNotFound(text=json.dumps(f'Unknown model: {model}'), content_type='application/json')
+        return model
+
+    def retry_later(self, response: web.Response) -> web.Response:
+        response.headers['Retry-After'] = str(self.setting.retry_after_seconds)
+        return response
+
+    @staticmethod
+    def versioned(response: web.Response, model: ServingModel) -> web.Response:
+        response.headers[MODEL_VERSION_HEADER] = model.version
+        return response
+
+
+async def json_body(request: web.Request) -> Any:
+    """
+    Parsed json body or None if request is not json
+    """
+    if request.content_type != 'application/json' or not request.can_read_body:
+        return None
+    try:
+        return json.loads(await request.text())
+    except ValueError:
+        return None
+
+
+def create_app(service_setting: ServiceSetting) -> web.Application:
+    service = AsyncPredictionService(service_setting)
+    app = web.Application(middlewares=[service.count_response, service.handle_errors, service.check_ready])
+    app.add_routes([
+        web.get('/', service.root_response),
+        web.get('/health', service.check_health),
+        web.get('/metrics', service.export_metrics),
+        web.get('/show_model', service.show_model),
+        web.get('/models/{model}/show_model', service.show_model),
+        web.post('/predict', service.predict),
+        web.post('/models/{model}/predict', service.predict),
+    ])
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+    return app
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2:
+        setting_path = str(sys.argv[1])
+    elif os.getenv(SERVICE_CONFIG):
+        setting_path = os.getenv(SERVICE_CONFIG)
+    else:
+        raise ValueError('Can not find service setting')
+    service_settings: ServiceSetting = get_setting(setting_path, SettingType.service)
+    logger_utils.init_logging(os.path.join(service_settings.log_path, service_settings.name),
+                              use_queue=service_settings.use_async_logging,
+                              queue_size=service_settings.async_logging_setting.queue_size)
+    metrics.REGISTRY.enabled = service_settings.use_metrics
+    log.info(f'Using service:\n{json.dumps(service_settings.__dict__, default=lambda x: x.__dict__)}')
+    host, port = service_settings.server_setting.bind.rsplit(":", 1)
+    try:
+        web.run_app(create_app(service_settings), host=host, port=int(port))
+    finally:
+        logger_utils.stop_logging()
@@ -0,0 +1,57 @@
+"""
+Gunicorn settings of pre-fork serving (Linux hosts, gunicorn does not run on Windows):
+
+    ML_SERVICE_SETTINGS=path/to/service_config.json gunicorn -c app/service/gunicorn_config.py
+
+Worker and thread counts, recycling and timeouts are taken from 'server_setting' of the service settings.
+With 'preload' the master process loads models once and forks workers, which share dictionaries, stop words,
+language models and weights of TFLite and NumPy models copy-on-write. Keras model is loaded by every worker:
+TensorFlow runtime does not work in processes forked after it is started
+"""
+import gc
+import multiprocessing
+import os
+import sys
+
+service_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(service_path))
+
+from settings import get_setting, SettingType, ServiceSetting
+
+service_setting: ServiceSetting = get_setting(os.environ["ML_SERVICE_SETTINGS"], SettingType.service)
+server_setting = service_setting.server_setting
+
+wsgi_app = "ml_service:app"
+pythonpath = service_path
+bind = server_setting.bind
+worker_class = "gthread"
+workers = server_setting.workers or multiprocessing.cpu_count()
+threads = server_setting.threads
+preload_app = server_setting.preload
+# Worker is replaced after max_requests (+ random jitter, so workers are not restarted together) requests
+max_requests = server_setting.max_requests
+max_requests_jitter = server_setting.max_requests_jitter
+timeout = server_setting.timeout
+graceful_timeout = server_setting.graceful_timeout
+# ml_service.SERVER_WORKERS: every worker loads its own models, so POST /reload is refused if there are several
+os.environ["ML_SERVICE_WORKERS"] = str(workers)
+
+if preload_app:
+    # ml_service.PREFORK_SERVER: load models on import and do not start inference before fork
+    os.environ["ML_SERVICE_PREFORK"] = "1"
+    # Collector would touch every preloaded object in workers and copy shared memory pages
+    gc.disable()
+
+
+def when_ready(server) -> None:
+    if preload_app:
+        # Preloaded objects are never collected, so workers do not write to their pages
+        gc.freeze()
+        server.log.info(f'Frozen {gc.get_freeze_count()} preloaded objects')
+
+
+def post_fork(server, worker) -> None:
+    if preload_app:
+        gc.enable()
+        import ml_service
+        ml_service.after_fork()
@@ -5,32 +5,59 @@ import json
 import logging
 import os
 import sys
-from pathlib import WindowsPath
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Union, Tuple
 
 import werkzeug.exceptions
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, Response, jsonify, g
 
 # add path to sources for production
-sys.path.append(str(WindowsPath(os.path.dirname(os.path.abspath(__file__))).parent))
+sys.path.append(str(Path(os.path.dirname(os.path.abspath(__file__))).parent))
 
-from model_initializer import init_predictor, ServiceParameterPredictor
-from settings import get_setting, SettingType, PreprocessorSetting, ServiceSetting
-from utils import logger_utils
+from model_initializer import load_inference_backend
+from serving_model import ServingModel, ModelRegistry, load_model, register_metrics
+from settings import get_setting, SettingType, PreprocessorSetting, ServiceSetting, DEFAULT_MODEL
+from utils import logger_utils, metrics, text_utils
 
 os.environ['TF_XLA_FLAGS'] = '--tf_xla_enable_xla_devices'
 log = logging.getLogger("ml_service")
 
 SERVICE_CONFIG = "ML_SERVICE_SETTINGS"
 SERVER_PORT = "SERVER_PORT"
+# Set by pre-fork server (gunicorn_config.py): models are loaded on import, before workers are forked
+PREFORK_SERVER = "ML_SERVICE_PREFORK"
+# Set by pre-fork server to number of worker processes. Every worker has its own models
+SERVER_WORKERS = "ML_SERVICE_WORKERS"
+EMPTY_PREDICTIONS = json.dumps({"predictions": None})
+# Service state: STARTING -> UP (or DOWN if initialization failed)
+STATE_STARTING = "STARTING"
+STATE_UP = "UP"
+STATE_DOWN = "DOWN"
+READINESS_FREE_PATHS = ['/', '/health', '/metrics']
+MODEL_VERSION_HEADER = "X-Model-Version"
+# Max seconds to wait for requests of replaced or evicted model before its resources are released
+MODEL_CLOSE_TIMEOUT = 60
+service_state = STATE_STARTING
+setting_path = ""
 service_settings: ServiceSetting = None
 preprocessor_settings: PreprocessorSetting = None
-predictor: ServiceParameterPredictor = None
+# Serving models by name (predictor with its settings and request batcher). Created on initialization
+registry: ModelRegistry = None
+# Model name -> setting of the model. Updated by POST /reload
+model_settings = {}
+# Selects requests with logged payloads. None if payload logging is disabled
+payload_sampler: logger_utils.PayloadSampler = None
 
 app = Flask(__name__)
 
 
 def on_exit_app():
+    if registry is not None:
+        registry.close()
     log.info("Application shout down!")
+    logger_utils.stop_logging()
 
 
 @app.errorhandler(werkzeug.exceptions.NotFound)
@@ -47,16 +74,44 @@ def handle_invalid_usage(error) -> Response:
     return Response(response=str(error), status=500)
 
 
+@app.before_request
+def start_request_timer() -> None:
+    g.start_time = time.perf_counter()
+
+
 @app.before_request
 def log_request_info() -> None:
-    if request.json:
-        app.logger.info('Body: %s', request.get_json())
+    g.log_payload = payload_sampler is not None and payload_sampler.sample()
+    if g.log_payload and request.is_json:
+        body = request.get_json(silent=True)
+        if body:
+            log.info(f'Body: {payload_sampler.truncate(body)}')
+
+
+@app.before_request
+def check_service_ready() -> Union[Response, None]:
+    if service_state != STATE_UP and request.path not in READINESS_FREE_PATHS:
+        return Response(response=f'Service is not ready: {service_state}', status=503)
+    return None
+
+
+@app.after_request
+def count_response(response: Response) -> Response:
+    # Streamed response is measured until its first byte
+    if metrics.REGISTRY.enabled and 'start_time' in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unknown"
+        metrics.REGISTRY.histogram("http_request_seconds", "Time of request handling, seconds",
+                                   endpoint=endpoint).observe(time.perf_counter() - g.start_time)
+        metrics.REGISTRY.counter("http_responses_total", "Responses by endpoint and status",
+                                 endpoint=endpoint, status=str(response.status_code)).inc()
+    return response
 
 
 @app.after_request
 def log_response_info(response: Response) -> Response:
-    if response.json:
-        log.info(f'Response: \n {response.get_json()}')
+    # Streamed responses are not logged, their body is not generated yet
+    if g.get('log_payload') and response.is_json and not response.is_streamed:
+        log.info(f'Response: {payload_sampler.truncate(response.get_data(as_text=True))}')
     return response
 
 
@@ -67,41 +122,234 @@ def root_response() -> Response:
 
 @app.get('/health')
 def check_health() -> Response:
-    return jsonify('status: UP')
+    response = jsonify(f'status: {service_state}')
+    if service_state != STATE_UP:
+        response.status_code = 503
+    return response
+
+
+@app.get('/cache_stats')
+def cache_stats() -> Response:
+    model = registry.acquire(model_name())
+    try:
+        stats = {"lemma_cache": text_utils.LEMMA_CACHE.stats(), "loaded_models": registry.loaded()}
+        if model.predictor.prediction_cache is not None:
+            stats["prediction_cache"] = model.predictor.prediction_cache.stats()
+        return versioned(jsonify(stats), model)
+    finally:
+        model.release()
+
+
+@app.get('/metrics')
+def export_metrics() -> Response:
+    """
+    Metrics in Prometheus text format, with '?format=json' - counters and histogram quantiles as json
+    """
+    if not metrics.REGISTRY.enabled:
+        raise werkzeug.exceptions.NotFound('Metrics are disabled')
+    if request.args.get('format') == 'json':
+        return jsonify(metrics.REGISTRY.snapshot())
+    return Response(metrics.REGISTRY.export(), status=200, content_type=metrics.CONTENT_TYPE)
 
 
 @app.get('/show_model')
-def show_model() -> Response:
-    if predictor.model is not None:
-        summary = []
-        predictor.model.summary(print_fn=log.info)
-        predictor.model.summary(print_fn=lambda x: summary.append(x))
-        return Response(response='\n'.join(summary), status=200, mimetype='text/plain')
-    else:
-        return Response(response='Model not loaded!', status=200)
+@app.get('/models/<model>/show_model')
+def show_model(model: str = None) -> Response:
+    serving_model = registry.acquire(model_name(model))
+    try:
+        predictor = serving_model.predictor
+        if predictor.model is not None:
+            summary = []
+            predictor.model.summary(print_fn=log.info)
+            predictor.model.summary(print_fn=lambda x: summary.append(x))
+            return Response(response='\n'.join(summary), status=200, mimetype='text/plain')
+        else:
+            return Response(response='Model not loaded!', status=200)
+    finally:
+        serving_model.release()
 
 
 @app.post('/predict')
-def predict() -> Response:
+@app.post('/models/<model>/predict')
+def predict(model: str = None) -> Response:
     if not request.json or 'text' not in request.json:
         return Response(response=f'Request does not contain json or "text" attribute', status=500)
-    if request.json['text'] == "":
-        return Response(json.dumps({"predictions": None}), status=200, mimetype='application/json')
-    text = predictor.preprocess_text(request.json['text'], preprocessor_settings)
-    log.info(f'Preprocessed text: {text}')
-    predictions = predictor.get_prediction(text, service_settings.top_n_predictions)
-    if predictions.shape[0] == 0:
-        return Response(json.dumps({"predictions": None}), status=200, mimetype='application/json')
-    else:
-        return Response(json.dumps({"predictions": predictions.to_dict(orient="records")}), status=200,
-                        mimetype='application/json')
+    # The whole request is served by the same model, even if it is replaced by reload meanwhile
+    serving_model = registry.acquire(model_name(model))
+    try:
+        if request.json['text'] == "":
+            return versioned(Response(EMPTY_PREDICTIONS, status=200, mimetype='application/json'), serving_model)
+        predictor = serving_model.predictor
+        top_n = serving_model.service_setting.top_n_predictions
+        text = predictor.preprocess_text(request.json['text'], serving_model.preprocessor_setting)
+        if g.log_payload:
+            log.info(f'Preprocessed text: {payload_sampler.truncate(text)}')
+        if serving_model.batcher is not None:
+            predictions = predictor.get_cached_prediction(text, top_n)
+            if predictions is None:
+                predictions = serving_model.batcher.predict(text)
+        else:
+            predictions = predictor.get_prediction(text, top_n)
+        return versioned(Response(predictions, status=200, mimetype='application/json'), serving_model)
+    finally:
+        serving_model.release()
+
+
+@app.post('/predict_batch')
+@app.post('/models/<model>/predict_batch')
+def predict_batch(model: str = None) -> Response:
+    texts = request.json.get('texts') if request.json else None
+    # Every text is checked before the response stream starts: errors in the stream can not change its status
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return Response(response='Request does not contain json or "texts" array', status=500)
+    serving_model = registry.acquire(model_name(model))
+    predictor = serving_model.predictor
+    top_n = serving_model.service_setting.top_n_predictions
+    batch_size = serving_model.service_setting.predict_batch_size
+
+    def generate():
+        # One json line per text in the same order. Batches are predicted and sent one by one
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            preprocessed = [predictor.preprocess_text(text, serving_model.preprocessor_setting)
+                            for text in batch if text != ""]
+            predictions = iter(predictor.get_predictions(preprocessed, top_n) if len(preprocessed) > 0 else [])
+            lines = [(next(predictions) if text != "" else EMPTY_PREDICTIONS) + "\n" for text in batch]
+            yield "".join(lines)
+
+    response = versioned(Response(generate(), status=200, mimetype='application/x-ndjson'), serving_model)
+    # Model is released when the whole stream is sent (or the client disconnected)
+    response.call_on_close(serving_model.release)
+    return response
+
 
+@app.get('/reload')
+@app.get('/models/<model>/reload')
+def reload_status(model: str = None) -> Response:
+    slot = registry.slot(model_name(model))
+    current_version = slot.model.version if slot.model is not None else None
+    return jsonify({**slot.reload_status, "current_version": current_version})
 
-def init_service(service_setting: ServiceSetting, preprocessor_setting: PreprocessorSetting) -> None:
-    global predictor
+
+@app.post('/reload')
+@app.post('/models/<model>/reload')
+def reload(model: str = None) -> Response:
+    """
+    Load model files (and settings) of the service settings file in background and replace the current model.
+    Only the settings file the service was started with is reloaded: model files are unpickled, so their paths
+    are never taken from the request. Optional json body: {"model": model name}
+    """
+    name = model_name(model)
+    if int(os.getenv(SERVER_WORKERS, "1")) > 1:
+        # Request reaches only one worker, other workers would keep serving the old model
+        return Response(response='Reload is not supported by pre-fork server with several workers, '
+                                 'restart the server instead', status=501)
+
+    def load() -> ServingModel:
+        model_setting = get_setting(setting_path, SettingType.service).model_setting(name)
+        serving_model = load_model(model_setting)
+        model_settings[name] = model_setting
+        return serving_model
+
+    if not registry.reload(name, load):
+        return Response(response='Reload is already in progress', status=409)
+    log.info(f'Reload of model "{name}" started from: {setting_path}')
+    return jsonify(registry.slot(name).reload_status), 202
+
+
+def model_name(model: str = None) -> str:
+    """
+    Requested model: URL segment, 'model' query parameter or 'model' field of json body. Default model if not set
+
+    :raises NotFound if there is no such model
+    """
+    if model is None:
+        body = request.get_json(silent=True)
+        model = request.args.get('model') or (body.get('model') if isinstance(body, dict) else None) or DEFAULT_MODEL
+    if model not in registry:
+        raise werkzeug.exceptions.NotFound(f'Unknown model: {model}')
+    return model
+
+
+def versioned(response: Response, model: ServingModel) -> Response:
+    response.headers[MODEL_VERSION_HEADER] = model.version
+    return response
+
+
+def load_settings(path: str) -> Tuple[ServiceSetting, PreprocessorSetting]:
+    service_setting: ServiceSetting = get_setting(path, SettingType.service)
+    preprocessor_setting: PreprocessorSetting = get_setting(service_setting.preprocessor_settings_path,
+                                                            SettingType.cleaner)
+    return service_setting, preprocessor_setting
+
+
+def init_service(service_setting: ServiceSetting, before_fork=False) -> None:
+    """
+    Create model registry and load models: default model first, then others while number of loaded models is
+    less than 'max_loaded_models'
+
+    :param before_fork: models are loaded by pre-fork server master process (see load_model)
+    """
+    global registry
     log.info("==> Start service initialization")
-    predictor = init_predictor(service_setting, preprocessor_setting)
-    log.info("==> Service initialized")
+    model_settings.update({name: service_setting.model_setting(name) for name in service_setting.model_names()})
+    registry = ModelRegistry(lambda name: load_model(model_settings[name], before_fork), service_setting.model_names(),
+                             max_loaded=service_setting.max_loaded_models, pinned=[DEFAULT_MODEL],
+                             close_timeout=MODEL_CLOSE_TIMEOUT)
+    register_metrics(registry)
+    for name in service_setting.model_names():
+        if 0 < service_setting.max_loaded_models <= len(registry.loaded()):
+            break
+        registry.ensure_loaded(name)
+    log.info(f'==> Service initialized. Loaded models: {registry.loaded()}')
+
+
+def complete_service() -> None:
+    """
+    Load models that were not loaded before fork and warm up all models. Models loaded later are loaded completely
+    """
+    registry.load = lambda name: load_model(model_settings[name])
+    for name in registry.loaded():
+        model = registry.slot(name).model
+        if model.predictor.model is None:
+            model.predictor.model = load_inference_backend(model.service_setting)
+        model.predictor.warm_up(model.preprocessor_setting, model.service_setting.top_n_predictions)
+    log.info(f'==> Service worker {os.getpid()} is ready. Loaded models: {registry.loaded()}')
+
+
+def after_fork() -> None:
+    """
+    Prepare worker forked from process with preloaded models before it accepts requests: restart threads
+    (fork copies no threads), load models that were not loaded before fork and warm models up
+    """
+    global service_state
+    logger_utils.after_fork()
+    for name in registry.loaded():
+        batcher = registry.slot(name).model.batcher
+        if batcher is not None:
+            batcher.after_fork()
+    complete_service()
+    service_state = STATE_UP
+
+
+def start_service(init: Callable[[], None]) -> threading.Thread:
+    """
+    Initialize service in background thread. Until initialization is finished
+    '/health' responds 503 with status STARTING and other endpoints respond 503
+    """
+
+    def run():
+        global service_state
+        try:
+            init()
+            service_state = STATE_UP
+        except Exception as e:
+            service_state = STATE_DOWN
+            log.error(f'Service initialization failed: {e}', exc_info=True)
+
+    thread = threading.Thread(target=run, name="service-init", daemon=True)
+    thread.start()
+    return thread
 
 
 if len(sys.argv) == 2:
@@ -110,13 +358,22 @@ elif os.getenv(SERVICE_CONFIG) != "":
     setting_path = os.getenv(SERVICE_CONFIG)
 else:
     raise ValueError(f'Can not find service setting')
-service_settings: ServiceSetting = get_setting(setting_path, SettingType.service)
-preprocessor_settings: PreprocessorSetting = get_setting(service_settings.preprocessor_settings_path,
-                                                         SettingType.cleaner)
-logger_utils.init_logging(service_settings.log_path + "\\" + service_settings.name)
+service_settings, preprocessor_settings = load_settings(setting_path)
+logger_utils.init_logging(os.path.join(service_settings.log_path, service_settings.name),
+                          use_queue=service_settings.use_async_logging,
+                          queue_size=service_settings.async_logging_setting.queue_size)
+if service_settings.use_payload_logging:
+    payload_sampler = logger_utils.PayloadSampler(service_settings.payload_logging_setting.sample_rate,
+                                                  service_settings.payload_logging_setting.max_length)
+metrics.REGISTRY.enabled = service_settings.use_metrics
 log.info(f'Using service:\n{json.dumps(service_settings.__dict__, default=lambda x: x.__dict__)}')
 log.info(f'Using preprocessor:\n{json.dumps(preprocessor_settings.__dict__, default=lambda x: x.__dict__)}')
-init_service(service_settings, preprocessor_settings)
+if os.getenv(PREFORK_SERVER):
+    # Models are shared by workers copy-on-write, worker threads start after fork
+    init_service(service_settings, before_fork=True)
+    init_thread = None
+else:
+    init_thread = start_service(lambda: init_service(service_settings))
 atexit.register(on_exit_app)
 
 if __name__ == "__main__":
@@ -1,58 +1,191 @@
+import hashlib
+import json
 import logging
-from typing import Union
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Optional, Union, TYPE_CHECKING
 
 import numpy as np
 import pandas as pd
-from tensorflow.keras.models import load_model, Sequential
-from tensorflow.keras.preprocessing.text import Tokenizer
 
+from preprocessor import language_detector as lang
+from utils.inference_backends import InferenceBackend, KerasBackend, TFLiteBackend, NumpyBackend
+from utils.inference_backends import BACKEND_KERAS, BACKEND_TFLITE, BACKEND_NUMPY
 from settings import ServiceSetting, PreprocessorSetting
-from trainer.train import prep_bag_of_words
-from utils import text_utils
-from utils.file_utils import deserialize_dict, read_dataset, process_path
+from utils import metrics, text_utils
+from utils.cache_utils import LRUCache
+from utils.file_utils import deserialize_dict, deserialize_vocabulary, read_dataset, process_path, class_index_path
+from utils.sequence_utils import prep_bag_of_words
 from utils.stop_words_utils import StopWordsCleaner
-from utils.text_utils import clean_text_with_setting
+from utils.text_utils import TextNormalizer
+from utils.vocabulary import Vocabulary
+
+if TYPE_CHECKING:
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.preprocessing.text import Tokenizer
 
 log = logging.getLogger("model_initializer")
+WARM_UP_TEXTS = ["warm up", "розігрів моделі", "прогрев модели"]
+# Stop words shared by predictors with the same stop words settings and files: key -> StopWordsCleaner.
+# Cleaner is removed when the last predictor using it is unloaded
+_stop_words_cleaners = weakref.WeakValueDictionary()
+_stop_words_lock = threading.Lock()
+# TensorFlow is imported lazily by resources loaded concurrently (Keras model, pickled tokenizer),
+# and its lazy loaded modules are broken if the first import runs in several threads at once
+_tensorflow_import_lock = threading.Lock()
+PREDICTION_STAGES = metrics.REGISTRY.stages("prediction_stage_seconds",
+                                            "Time of prediction stages of one model call, seconds",
+                                            ["vectorize", "inference", "postprocess"])
+PREDICTION_BATCH_SIZE = metrics.REGISTRY.histogram("prediction_batch_texts", "Number of texts in one model call",
+                                                   buckets=metrics.SIZE_BUCKETS)
 
 
 class ServiceParameterPredictor:
-    def __init__(self, classes=None, stop_words_cleaner=None, words_dict=None, model=None) -> None:
+    def __init__(self, classes=None, stop_words_cleaner=None, words_dict=None, model=None, version="",
+                 prediction_cache: LRUCache = None) -> None:
         self.classes = classes
         self.stop_words_cleaner: StopWordsCleaner = stop_words_cleaner
         self.words_dict = words_dict
-        self.model = model
-        self.preprocessed_text = ""
-        self.text_sequence = None
+        self.model: InferenceBackend = model
+        self.version = version
+        # (version, top_n, preprocessed text) -> json response
+        self.prediction_cache = prediction_cache
+        self.class_fragments = None
+        # (preprocessor setting, normalizer) built on the first preprocessed text
+        self._normalizer: Tuple[PreprocessorSetting, TextNormalizer] = (None, None)
+        if classes is not None:
+            self.class_fragments = encode_class_fragments(classes)
 
     def preprocess_text(self, text: str, preprocessor_settings: PreprocessorSetting) -> str:
-        return clean_text_with_setting(text, preprocessor_settings, self.stop_words_cleaner.processor,
-                                       self.stop_words_cleaner.default_stop_words)
+        return self.get_normalizer(preprocessor_settings)(text)
 
-    def _preprocess_prediction(self, prediction: np.ndarray, top_n=5) -> Union[pd.DataFrame, None]:
-        if prediction.shape[0] == 0:
-            log.info('There are no predictions!')
-            return None
+    def get_normalizer(self, preprocessor_settings: PreprocessorSetting) -> TextNormalizer:
+        setting, normalizer = self._normalizer
+        if setting is not preprocessor_settings:
+            if self.stop_words_cleaner is None:
+                normalizer = TextNormalizer.from_setting(preprocessor_settings, None, set())
+            else:
+                normalizer = TextNormalizer.from_setting(preprocessor_settings, self.stop_words_cleaner.processor,
+                                                         self.stop_words_cleaner.default_stop_words)
+            self._normalizer = (preprocessor_settings, normalizer)
+        return normalizer
+
+    def _preprocess_prediction(self, prediction: np.ndarray, top_n=5) -> List[str]:
+        """
+        Build json response for every row of predictions matrix from pre-encoded class fragments
+
+        :return: json strings {"predictions": [{class_id, class_name, probability}]}
+        """
+        if prediction.shape[1] != len(self.class_fragments):
+            raise ValueError(
+                f'Different shapes! Predictions: {prediction.shape[1]}, classes{len(self.class_fragments)}')
+        indices, probabilities = select_top_n(prediction, top_n)
+        probabilities = (probabilities * 100).astype(int)
+        fragments = self.class_fragments
+        return ['{"predictions": [' + ", ".join([fragments[i] + str(p) + "}" for i, p in zip(row_indices, row)]) + ']}'
+                for row_indices, row in zip(indices.tolist(), probabilities.tolist())]
+
+    def warm_up(self, preprocessor_settings: PreprocessorSetting, top_n_predictions: int,
+                texts: List[str] = None) -> None:
+        """
+        Build text normalizer and run model on dummy texts, so the first requests do not pay for lazy initialization.
+        Prediction cache is not used
+        """
+        texts = [self.preprocess_text(text, preprocessor_settings) for text in (texts or WARM_UP_TEXTS)]
+        self._predict(texts, top_n_predictions)
+        log.info(f'Predictor {self.version} warmed up on {len(texts)} text(s)')
+
+    def get_prediction(self, text: str, top_n_predictions: int) -> str:
+        return self.get_predictions([text], top_n_predictions)[0]
+
+    def get_predictions(self, texts: list, top_n_predictions: int, lookup_cache=True) -> List[str]:
+        """
+        Predict classes for batch of preprocessed texts with one model call.
+        If prediction cache is used, only texts missing in cache are predicted
+
+        :param texts: preprocessed texts
+        :param top_n_predictions: number of predictions for every text
+        :param lookup_cache: search texts in cache before prediction (results are cached anyway)
+        :return: json responses in the same order as texts
+        """
+        if self.prediction_cache is None:
+            return self._predict(texts, top_n_predictions)
+        if lookup_cache:
+            results = [self.get_cached_prediction(text, top_n_predictions) for text in texts]
         else:
-            if prediction.shape[1] != self.classes.shape[0]:
-                raise ValueError(
-                    f'Different shapes! Predictions: {prediction.shape[1]}, classes{self.classes.shape[0]}')
-            result = pd.DataFrame()
-            result['class_id'] = self.classes['class_id']
-            result['class_name'] = self.classes['class_name']
-            result['probability'] = prediction[0] * 100
-            result['probability'] = result['probability'].astype(int)
-            return result.sort_values(by=['probability'], ascending=False).head(top_n)
-
-    def get_prediction(self, text: str, top_n_predictions: int) -> Union[pd.DataFrame, None]:
-        self.text_sequence = prep_bag_of_words([text], self.words_dict, self.model.input_shape[1])
-        return self._preprocess_prediction(self.model.predict(self.text_sequence), top_n=top_n_predictions)
-
-
-def load_keras_model(model_path: str) -> Sequential:
+            results = [None] * len(texts)
+        missed = [i for i, result in enumerate(results) if result is None]
+        if len(missed) > 0:
+            predictions = self._predict([texts[i] for i in missed], top_n_predictions)
+            for i, prediction in zip(missed, predictions):
+                results[i] = prediction
+                self.prediction_cache.put((self.version, top_n_predictions, texts[i]), prediction)
+        return results
+
+    def get_cached_prediction(self, text: str, top_n_predictions: int) -> Optional[str]:
+        if self.prediction_cache is None:
+            return None
+        return self.prediction_cache.get((self.version, top_n_predictions, text))
+
+    def clear_cache(self) -> None:
+        if self.prediction_cache is not None:
+            self.prediction_cache.clear()
+
+    def _predict(self, texts: list, top_n_predictions: int) -> List[str]:
+        timer = PREDICTION_STAGES.start()
+        text_sequences = prep_bag_of_words(texts, self.words_dict, self.model.input_length)
+        timer.lap("vectorize")
+        prediction = self.model.predict(text_sequences)
+        timer.lap("inference")
+        results = self._preprocess_prediction(prediction, top_n=top_n_predictions)
+        timer.lap("postprocess")
+        if metrics.REGISTRY.enabled:
+            PREDICTION_BATCH_SIZE.observe(len(texts))
+        return results
+
+
+def encode_class_fragments(classes: pd.DataFrame) -> List[str]:
+    """
+    Pre-encode json of every class without closing brace and probability value:
+    '{"class_id": 1, "class_name": "name", "probability": '
+
+    :param classes: classes DataFrame (class_id, class_name) in model output order
+    :return: json fragments in model output order
+    """
+    return [json.dumps({"class_id": int(class_id), "class_name": class_name})[:-1] + ', "probability": '
+            for class_id, class_name in zip(classes['class_id'].tolist(), classes['class_name'].tolist())]
+
+
+def select_top_n(predictions: np.ndarray, top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Select top N classes for every row of predictions matrix without sorting all classes
+
+    :param predictions: matrix (texts x classes) of probabilities
+    :param top_n: number of classes
+    :return: (class indices, probabilities) matrices (texts x top_n) sorted by probability descending
+    """
+    top_n = min(top_n, predictions.shape[1])
+    if top_n < predictions.shape[1]:
+        indices = np.argpartition(-predictions, top_n - 1, axis=1)[:, :top_n]
+    else:
+        indices = np.tile(np.arange(predictions.shape[1]), (predictions.shape[0], 1))
+    probabilities = np.take_along_axis(predictions, indices, axis=1)
+    order = np.argsort(-probabilities, axis=1, kind='stable')
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(probabilities, order, axis=1)
+
+
+def load_keras_model(model_path: str) -> 'Sequential':
+    # TensorFlow is imported only if service runs Keras model
+    with _tensorflow_import_lock:
+        from tensorflow.keras.models import load_model
     import trainer.models as models
     dependencies = {
-        "f1": models.f1
+        "f1": models.f1,
+        "SparseF1": models.SparseF1,
+        "SparsePrecision": models.SparsePrecision,
+        "SparseRecall": models.SparseRecall
     }
     model = load_model(filepath=model_path, custom_objects=dependencies)
     log.info(f'Model {model.name} loaded!')
@@ -60,16 +193,62 @@ def load_keras_model(model_path: str) -> Sequential:
     return model
 
 
-def load_dictionary(file_path: str) -> Tokenizer:
-    words_dict = deserialize_dict(file_path)
+def load_inference_backend(service_setting: ServiceSetting, fork_safe=False) -> Optional[InferenceBackend]:
+    """
+    Load model for the configured inference backend. Falls back to Keras model if backend can not be loaded
+
+    :param fork_safe: load model only if it can be used by processes forked after loading. TensorFlow runtime
+        started by Keras model loading does not work in forked processes, so None is returned instead of Keras model
+    """
+    if service_setting.inference_backend == BACKEND_TFLITE:
+        try:
+            return TFLiteBackend(process_path(service_setting.tflite_model_path))
+        except Exception as e:
+            log.warning(f'Can not load TFLite model: {e}. Fallback to Keras model', exc_info=True)
+    elif service_setting.inference_backend == BACKEND_NUMPY:
+        try:
+            model = NumpyBackend(process_path(service_setting.model_path))
+            model.summary(print_fn=log.info)
+            return model
+        except NotImplementedError as e:
+            log.warning(f'Model can not be run by NumPy backend: {e}. Fallback to Keras model')
+    elif service_setting.inference_backend != BACKEND_KERAS:
+        raise ValueError(f'Unknown inference backend: {service_setting.inference_backend}')
+    if fork_safe:
+        log.info("Keras model is not loaded before fork")
+        return None
+    return KerasBackend(load_keras_model(service_setting.model_path))
+
+
+def load_dictionary(service_setting: ServiceSetting) -> Union['Tokenizer', Vocabulary]:
+    """
+    Load vocabulary if 'vocab_path' is set, otherwise pickled tokenizer from 'dict_path'
+    """
+    if service_setting.vocab_path != "":
+        vocabulary = deserialize_vocabulary(service_setting.vocab_path)
+        log.info(f'Vocabulary loaded ({len(vocabulary)} tokens)')
+        return vocabulary
+    # Unpickling of tokenizer imports TensorFlow
+    with _tensorflow_import_lock:
+        words_dict = deserialize_dict(service_setting.dict_path)
     log.info(f'Dictionary loaded (Found {len(words_dict.word_index)} unique tokens)')
     return words_dict
 
 
 def load_classes(file_path: str) -> pd.DataFrame:
+    """
+    Load classes in model outputs order. If class index file saved by trainer is next to classes file,
+    classes are ordered by it
+    """
     file_path = process_path(file_path)
-    classes = read_dataset(file_path)
-    classes = classes[['class_id', 'class_name']]
+    classes = read_dataset(file_path, columns=['class_id', 'class_name'])
+    index_path = class_index_path(file_path)
+    if os.path.exists(index_path):
+        class_index = read_dataset(index_path)
+        if sorted(class_index['class_id'].tolist()) != sorted(classes['class_id'].tolist()):
+            raise ValueError(f'Classes of {file_path} do not match class index {index_path}')
+        classes = class_index.sort_values('class_index').merge(classes, on='class_id', how='left')
+        classes = classes[['class_id', 'class_name']]
     log.info(f'Classes loaded: {classes.shape[0]}')
     return classes
 
@@ -102,14 +281,97 @@ def load_stop_words(preprocessor_setting: PreprocessorSetting) -> StopWordsClean
     return cleaner
 
 
-def init_predictor(service_setting: ServiceSetting,
-                   preprocessor_setting: PreprocessorSetting) -> ServiceParameterPredictor:
+def get_stop_words(preprocessor_setting: PreprocessorSetting) -> StopWordsCleaner:
+    """
+    Stop words cleaner shared between predictors. Loaded again if settings or stop words files are changed
+    """
+    key = stop_words_key(preprocessor_setting)
+    with _stop_words_lock:
+        cleaner = _stop_words_cleaners.get(key)
+        if cleaner is None:
+            cleaner = load_stop_words(preprocessor_setting)
+            _stop_words_cleaners[key] = cleaner
+        else:
+            log.info("Stop words are shared with loaded model")
+    return cleaner
+
+
+def stop_words_key(preprocessor_setting: PreprocessorSetting) -> str:
+    """
+    Hash of stop words and lemmatization settings and paths, sizes and modification times of stop words files
+    """
+    stop_words_setting = preprocessor_setting.stop_words_settings
+    key = hashlib.sha1(json.dumps([stop_words_setting.__dict__, preprocessor_setting.use_words_lemmatization,
+                                   preprocessor_setting.words_lemmatization_setting.russian,
+                                   preprocessor_setting.words_lemmatization_setting.ukrainian]).encode("utf-8"))
+    paths = []
+    if stop_words_setting.alt_stop_words_file != "":
+        paths.append(process_path(stop_words_setting.alt_stop_words_file))
+    if stop_words_setting.custom_stop_words_path != "":
+        custom_path = process_path(stop_words_setting.custom_stop_words_path)
+        paths.extend(os.path.join(custom_path, name) for name in sorted(os.listdir(custom_path)))
+    for path in paths:
+        key.update(f'{path}|{os.path.getsize(path)}|{os.path.getmtime(path)}\n'.encode("utf-8"))
+    return key.hexdigest()
+
+
+def init_predictor(service_setting: ServiceSetting, preprocessor_setting: PreprocessorSetting,
+                   fork_safe=False) -> ServiceParameterPredictor:
+    """
+    Load all predictor resources concurrently: classes, stop words, dictionary, model
+    and language models (only if words lemmatization is used)
+
+    :param fork_safe: see load_inference_backend
+    """
     log.info("==> Service parameter predictor initialization")
-    classes = load_classes(service_setting.classes_path)
-    stop_words = None
-    if preprocessor_setting.clean_stop_words:
-        stop_words = load_stop_words(preprocessor_setting)
-    word_dict = load_dictionary(service_setting.dict_path)
-    model = load_keras_model(service_setting.model_path)
-    log.info("==> Service parameter predictor initialized")
-    return ServiceParameterPredictor(classes=classes, stop_words_cleaner=stop_words, words_dict=word_dict, model=model)
+    with ThreadPoolExecutor(max_workers=5, thread_name_prefix="init") as executor:
+        if preprocessor_setting.use_words_lemmatization:
+            language_future = executor.submit(load_language_models, preprocessor_setting)
+        classes_future = executor.submit(load_classes, service_setting.classes_path)
+        stop_words_future = None
+        if preprocessor_setting.clean_stop_words:
+            stop_words_future = executor.submit(get_stop_words, preprocessor_setting)
+        word_dict_future = executor.submit(load_dictionary, service_setting)
+        model_future = executor.submit(load_inference_backend, service_setting, fork_safe)
+
+        classes = classes_future.result()
+        stop_words = stop_words_future.result() if stop_words_future is not None else None
+        word_dict = word_dict_future.result()
+        model = model_future.result()
+        if preprocessor_setting.use_words_lemmatization:
+            language_future.result()
+    version = get_model_version(service_setting)
+    prediction_cache = None
+    if service_setting.use_prediction_cache:
+        cache_setting = service_setting.prediction_cache_setting
+        prediction_cache = LRUCache(max_size=cache_setting.max_size,
+                                    ttl=cache_setting.ttl_seconds if cache_setting.ttl_seconds > 0 else None)
+    log.info(f'==> Service parameter predictor initialized. Version: {version}')
+    return ServiceParameterPredictor(classes=classes, stop_words_cleaner=stop_words, words_dict=word_dict, model=model,
+                                     version=version, prediction_cache=prediction_cache)
+
+
+def load_language_models(preprocessor_setting: PreprocessorSetting) -> None:
+    lemmatization_setting = preprocessor_setting.words_lemmatization_setting
+    lang.load_models(russian=lemmatization_setting.russian, ukrainian=lemmatization_setting.ukrainian)
+    log.info("Language models loaded")
+    text_utils.init_lemma_cache(lemmatization_setting)
+
+
+def get_model_version(service_setting: ServiceSetting) -> str:
+    """
+    Version of model files: hash of model, dictionary (or vocabulary) and classes paths, sizes and modification times
+    """
+    version = hashlib.sha1()
+    if service_setting.vocab_path != "":
+        dict_paths = Vocabulary.files(process_path(service_setting.vocab_path))
+    else:
+        dict_paths = [service_setting.dict_path]
+    paths = [service_setting.model_path, *dict_paths, service_setting.classes_path]
+    index_path = class_index_path(process_path(service_setting.classes_path))
+    if os.path.exists(index_path):
+        paths.append(index_path)
+    for path in paths:
+        path = process_path(path)
+        version.update(f'{path}|{os.path.getsize(path)}|{os.path.getmtime(path)}\n'.encode("utf-8"))
+    return version.hexdigest()[:12]
@@ -0,0 +1,107 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Any
+
+from utils import metrics
+
+log = logging.getLogger("request_batcher")
+_STOP = object()
+WAIT_TIME = metrics.REGISTRY.histogram("request_batcher_wait_seconds",
+                                       "Time from request submit to prediction of its batch, seconds")
+BATCH_SIZE = metrics.REGISTRY.histogram("request_batcher_batch_size", "Number of requests in one batch",
+                                        buckets=metrics.SIZE_BUCKETS)
+
+
+class RequestBatcher:
+    """
+    Collects concurrent prediction requests into micro-batches processed by a background thread.
+    The thread takes the first waiting request, adds all requests already in queue and waits
+    up to 'max_wait_ms' for more until 'max_batch_size' is reached.
+    The whole batch is passed to 'predict_batch' in one call and every caller gets its own result
+    """
+
+    def __init__(self, predict_batch: Callable[[list], list], max_batch_size=32, max_wait_ms=2.0) -> None:
+        if max_batch_size <= 0:
+            raise ValueError(f'max_batch_size must be > 0. Got: {max_batch_size}')
+        if max_wait_ms < 0:
+            raise ValueError(f'max_wait_ms must be >= 0. Got: {max_wait_ms}')
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._start()
+        log.info(f'Request batcher started (max batch size: {max_batch_size}, max wait: {max_wait_ms} ms)')
+
+    def _start(self) -> None:
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="request-batcher", daemon=True)
+        self._thread.start()
+
+    def after_fork(self) -> None:
+        """
+        Start background thread in process forked from the one that created batcher (fork copies no threads)
+        """
+        self._start()
+
+    def submit(self, item: Any) -> Future:
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def predict(self, item: Any, timeout: float = None) -> Any:
+        return self.submit(item).result(timeout)
+
+    def close(self) -> None:
+        """
+        Stop background thread after all submitted requests are processed
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+        log.info("Request batcher stopped")
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if item is _STOP:
+                    stopped = True
+                    break
+                batch.append(item)
+            self._process(batch)
+
+    def _process(self, batch: list) -> None:
+        if metrics.REGISTRY.enabled:
+            now = time.perf_counter()
+            for _, _, submitted in batch:
+                WAIT_TIME.observe(now - submitted)
+            BATCH_SIZE.observe(len(batch))
+        # Skip requests cancelled by the caller while waiting in queue
+        batch = [(item, future) for item, future, _ in batch if future.set_running_or_notify_cancel()]
+        if len(batch) == 0:
+            return
+        try:
+            results = self.predict_batch([item for item, _ in batch])
+        except Exception as e:
+            log.error(f'Batch of {len(batch)} request(s) failed: {e}', exc_info=True)
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,293 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from model_initializer import init_predictor
+from request_batcher import RequestBatcher
+from settings import get_setting, SettingType, PreprocessorSetting, ServiceSetting
+from utils import metrics, text_utils
+
+log = logging.getLogger("serving_model")
+# Reload states: IDLE -> LOADING -> IDLE (new model is served) or FAILED (old model is served)
+RELOAD_IDLE = "IDLE"
+RELOAD_LOADING = "LOADING"
+RELOAD_FAILED = "FAILED"
+
+
+class ServingModel:
+    """
+    Predictor with the settings it was loaded with and its request batcher.
+    Counts requests in progress, so the model replaced by reload is closed only after they are finished
+    """
+
+    def __init__(self, predictor, service_setting, preprocessor_setting, batcher=None) -> None:
+        self.predictor = predictor
+        self.service_setting = service_setting
+        self.preprocessor_setting = preprocessor_setting
+        self.batcher = batcher
+        self.active_requests = 0
+        self._idle = threading.Condition()
+
+    @property
+    def version(self) -> str:
+        return self.predictor.version
+
+    def acquire(self) -> 'ServingModel':
+        with self._idle:
+            self.active_requests += 1
+        return self
+
+    def release(self) -> None:
+        with self._idle:
+            self.active_requests -= 1
+            if self.active_requests == 0:
+                self._idle.notify_all()
+
+    def close(self, timeout: float = None) -> None:
+        """
+        Wait until all acquired requests are released and stop request batcher
+
+        :param timeout: max seconds to wait for requests (wait forever if None)
+        """
+        with self._idle:
+            if not self._idle.wait_for(lambda: self.active_requests == 0, timeout):
+                log.warning(f'Model {self.version} closed with {self.active_requests} request(s) in progress')
+        if self.batcher is not None:
+            self.batcher.close()
+        log.info(f'Model {self.version} closed')
+
+
+def load_model(service_setting: ServiceSetting, before_fork=False) -> ServingModel:
+    """
+    Load predictor and request batcher of model setting and warm predictor up
+
+    :param before_fork: load only resources that work in forked processes and do not run model
+        (see load_inference_backend). Model is completed by workers after fork
+    """
+    preprocessor_setting: PreprocessorSetting = get_setting(service_setting.preprocessor_settings_path,
+                                                            SettingType.cleaner)
+    predictor = init_predictor(service_setting, preprocessor_setting, fork_safe=before_fork)
+    batcher = None
+    if service_setting.use_request_batching:
+        batching_setting = service_setting.request_batching_setting
+        batcher = RequestBatcher(lambda texts: predictor.get_predictions(texts, service_setting.top_n_predictions,
+                                                                         lookup_cache=False),
+                                 max_batch_size=batching_setting.max_batch_size,
+                                 max_wait_ms=batching_setting.max_wait_ms)
+    if not before_fork:
+        predictor.warm_up(preprocessor_setting, service_setting.top_n_predictions)
+    return ServingModel(predictor, service_setting, preprocessor_setting, batcher)
+
+
+class ModelSlot:
+    """
+    Holder of the current serving model. Request takes the model with 'acquire' and releases it when response is
+    sent, so 'swap' never closes model while a request between acquire and release uses it
+    """
+
+    def __init__(self, model: ServingModel = None) -> None:
+        self._model = model
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        # Status of the last reload: state, version, error
+        self.reload_status = {"state": RELOAD_IDLE, "version": None, "error": None}
+
+    @property
+    def model(self) -> ServingModel:
+        return self._model
+
+    def acquire(self) -> ServingModel:
+        with self._lock:
+            if self._model is None:
+                raise RuntimeError("Model is not loaded")
+            return self._model.acquire()
+
+    def swap(self, model: ServingModel, close_timeout: float = None) -> None:
+        """
+        Replace current model. Old model is closed after its requests in progress are finished
+        """
+        old_model = self._replace(model)
+        if old_model is not None:
+            old_model.close(close_timeout)
+
+    def unload(self, close_timeout: float = None) -> None:
+        """
+        Remove current model. It is closed after its requests in progress are finished
+        """
+        with self._lock:
+            old_model, self._model = self._model, None
+        if old_model is not None:
+            log.info(f'Unloading model {old_model.version}')
+            old_model.close(close_timeout)
+
+    def _replace(self, model: ServingModel) -> ServingModel:
+        with self._lock:
+            old_model, self._model = self._model, model
+        log.info(f'Serving model {model.version}' + (f' instead of {old_model.version}' if old_model else ''))
+        return old_model
+
+    def reload(self, load: Callable[[], ServingModel], warm_up: Callable[[ServingModel], Any] = None,
+               close_timeout: float = None) -> bool:
+        """
+        Load new model in background thread, warm it up and swap it with the current one.
+        Requests are served by the current model until the new one is ready
+
+        :param load: function that loads new model
+        :param warm_up: function called with the new model before swap
+        :param close_timeout: max seconds to wait for requests of the old model before it is closed
+        :return: False if another reload is in progress
+        """
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        self.reload_status = {"state": RELOAD_LOADING, "version": None, "error": None}
+
+        def run():
+            model = None
+            try:
+                model = load()
+                if warm_up is not None:
+                    warm_up(model)
+            except Exception as e:
+                log.error(f'Model reload failed: {e}', exc_info=True)
+                self.reload_status = {"state": RELOAD_FAILED, "version": None, "error": str(e)}
+                if model is not None:
+                    model.close(0)
+            else:
+                old_model = self._replace(model)
+                self.reload_status = {"state": RELOAD_IDLE, "version": model.version, "error": None}
+                if old_model is not None:
+                    old_model.close(close_timeout)
+            finally:
+                self._reload_lock.release()
+
+        threading.Thread(target=run, name="model-reload", daemon=True).start()
+        return True
+
+
+class ModelRegistry:
+    """
+    Serving models by name. Model is loaded on the first request to it. If more than 'max_loaded' models are loaded,
+    the least recently used ones are unloaded (pinned models are never unloaded)
+    """
+
+    def __init__(self, load: Callable[[str], ServingModel], names: List[str], max_loaded=0, pinned: List[str] = None,
+                 close_timeout: float = None) -> None:
+        """
+        :param load: function that loads model by name
+        :param names: names of all models
+        :param max_loaded: max number of loaded models. 0 - unlimited
+        :param pinned: names of models that are never unloaded
+        :param close_timeout: max seconds to wait for requests of unloaded model
+        """
+        if max_loaded < 0:
+            raise ValueError(f'max_loaded must be >= 0. Got: {max_loaded}')
+        self.load = load
+        self.slots: Dict[str, ModelSlot] = {name: ModelSlot() for name in names}
+        self.max_loaded = max_loaded
+        self.pinned = set(pinned or [])
+        self.close_timeout = close_timeout
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in names}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.slots
+
+    def slot(self, name: str) -> ModelSlot:
+        return self.slots[name]
+
+    def loaded(self) -> List[str]:
+        return [name for name, slot in self.slots.items() if slot.model is not None]
+
+    def acquire(self, name: str) -> ServingModel:
+        """
+        Take model for request (load it if needed). Caller must release model when response is sent
+        """
+        while True:
+            model = self.try_acquire(name)
+            if model is not None:
+                return model
+            self.ensure_loaded(name)
+
+    def try_acquire(self, name: str) -> Optional[ServingModel]:
+        """
+        Take model for request if it is loaded, otherwise None. Caller must release model when response is sent
+        """
+        try:
+            model = self.slots[name].acquire()
+        except RuntimeError:
+            return None
+        self._last_used[name] = time.monotonic()
+        return model
+
+    def ensure_loaded(self, name: str) -> None:
+        slot = self.slots[name]
+        with self._load_locks[name]:
+            if slot.model is not None:
+                return
+            log.info(f'Loading model: {name}')
+            slot.swap(self.load(name))
+        self._last_used[name] = time.monotonic()
+        self._evict(keep=name)
+
+    def reload(self, name: str, load: Callable[[], ServingModel],
+               warm_up: Callable[[ServingModel], Any] = None) -> bool:
+        """
+        Reload model in background (see ModelSlot.reload). Not loaded model is loaded
+        """
+        def load_and_touch() -> ServingModel:
+            model = load()
+            self._last_used[name] = time.monotonic()
+            # Make room for model that was not loaded before
+            self._evict(keep=name, loading=self.slots[name].model is None)
+            return model
+
+        return self.slots[name].reload(load_and_touch, warm_up, self.close_timeout)
+
+    def close(self) -> None:
+        for slot in self.slots.values():
+            slot.unload(0)
+
+    def _evict(self, keep: str, loading=False) -> None:
+        """
+        :param keep: name of model that is not evicted
+        :param loading: count one more loaded model (which is being loaded)
+        """
+        if self.max_loaded == 0:
+            return
+        with self._lock:
+            loaded = [name for name in self.loaded() if name != keep and name not in self.pinned]
+            loaded.sort(key=lambda name: self._last_used.get(name, 0))
+            evicted = loaded[:max(0, len(self.loaded()) + int(loading) - self.max_loaded)]
+        for name in evicted:
+            log.info(f'Evicting least recently used model: {name}')
+            # Unloaded model waits for its requests in background
+            threading.Thread(target=self.slots[name].unload, args=(self.close_timeout,), name="model-unload",
+                             daemon=True).start()
+
+
+def register_metrics(registry: ModelRegistry) -> None:
+    """
+    Export number of loaded models and counters of lemma cache and prediction caches of loaded models
+    """
+
+    def caches():
+        result = [({"cache": "lemma"}, text_utils.LEMMA_CACHE)]
+        for name in registry.loaded():
+            model = registry.slot(name).model
+            if model is not None and model.predictor.prediction_cache is not None:
+                result.append(({"cache": "prediction", "model": name}, model.predictor.prediction_cache))
+        return result
+
+    metrics_registry = metrics.REGISTRY
+    metrics_registry.callback("loaded_models", metrics.GAUGE, "Number of loaded models",
+                              lambda: [({}, len(registry.loaded()))])
+    metrics_registry.callback("cache_hits_total", metrics.COUNTER, "Cache hits",
+                              lambda: [(labels, cache.hits) for labels, cache in caches()])
+    metrics_registry.callback("cache_misses_total", metrics.COUNTER, "Cache misses",
+                              lambda: [(labels, cache.misses) for labels, cache in caches()])
+    metrics_registry.callback("cache_hit_rate", metrics.GAUGE, "Cache hits / lookups",
+                              lambda: [(labels, cache.hit_rate()) for labels, cache in caches()])
+    metrics_registry.callback("cache_entries", metrics.GAUGE, "Number of cache entries",
+                              lambda: [(labels, len(cache)) for labels, cache in caches()])
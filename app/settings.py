@@ -1,9 +1,11 @@
 import enum
 import json
 import logging
-from typing import Union
+from typing import Union, List
 
 log = logging.getLogger("settings")
+# Name of the model described by top level service setting
+DEFAULT_MODEL = "default"
 
 
 class SettingType(enum.Enum):
@@ -20,9 +22,12 @@ class DataBalancingSetting:
 
 
 class WordLemmatizationSetting:
-    def __init__(self, russian, ukrainian) -> None:
+    def __init__(self, russian, ukrainian, cache_size=100000, cache_warm_up_dict_path="") -> None:
         self.russian = russian
         self.ukrainian = ukrainian
+        if cache_size < 0: raise ValueError("cache_size must be >= 0")
+        self.cache_size = cache_size
+        self.cache_warm_up_dict_path = cache_warm_up_dict_path
 
 
 class EmailSetting:
@@ -44,6 +49,92 @@ class StopWordsSettings:
         self.use_file_cleanup = use_file_cleanup
 
 
+class ParallelCleaningSetting:
+    def __init__(self, workers=0, chunk_size=10000) -> None:
+        if workers < 0: raise ValueError("workers must be >= 0")
+        self.workers = workers
+        if chunk_size <= 0: raise ValueError("chunk_size must be > 0")
+        self.chunk_size = chunk_size
+
+
+class StreamingSetting:
+    def __init__(self, chunk_size=100000, resume=True) -> None:
+        if chunk_size <= 0: raise ValueError("chunk_size must be > 0")
+        self.chunk_size = chunk_size
+        self.resume = resume
+
+
+class TrainerStreamingSetting:
+    def __init__(self, chunk_size=100000, shuffle_buffer_size=100000, seed=42) -> None:
+        if chunk_size <= 0: raise ValueError("chunk_size must be > 0")
+        self.chunk_size = chunk_size
+        if shuffle_buffer_size <= 0: raise ValueError("shuffle_buffer_size must be > 0")
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+
+
+class RequestBatchingSetting:
+    def __init__(self, max_batch_size=32, max_wait_ms=2) -> None:
+        if max_batch_size <= 0: raise ValueError("max_batch_size must be > 0")
+        self.max_batch_size = max_batch_size
+        if max_wait_ms < 0: raise ValueError("max_wait_ms must be >= 0")
+        self.max_wait_ms = max_wait_ms
+
+
+class AsyncLoggingSetting:
+    def __init__(self, queue_size=10000) -> None:
+        if queue_size <= 0: raise ValueError("queue_size must be > 0")
+        self.queue_size = queue_size
+
+
+class PayloadLoggingSetting:
+    def __init__(self, sample_rate=1.0, max_length=1000) -> None:
+        if not 0 <= sample_rate <= 1: raise ValueError("sample_rate must be in [0, 1]")
+        self.sample_rate = sample_rate
+        if max_length < 0: raise ValueError("max_length must be >= 0")
+        self.max_length = max_length
+
+
+class ServerSetting:
+    def __init__(self, bind="0.0.0.0:5000", workers=0, threads=4, preload=True, max_requests=0,
+                 max_requests_jitter=0, timeout=120, graceful_timeout=60) -> None:
+        self.bind = bind
+        if workers < 0: raise ValueError("workers must be >= 0")
+        self.workers = workers
+        if threads <= 0: raise ValueError("threads must be > 0")
+        self.threads = threads
+        self.preload = preload
+        if max_requests < 0: raise ValueError("max_requests must be >= 0")
+        self.max_requests = max_requests
+        if max_requests_jitter < 0: raise ValueError("max_requests_jitter must be >= 0")
+        self.max_requests_jitter = max_requests_jitter
+        if timeout < 0: raise ValueError("timeout must be >= 0")
+        self.timeout = timeout
+        if graceful_timeout < 0: raise ValueError("graceful_timeout must be >= 0")
+        self.graceful_timeout = graceful_timeout
+
+
+class AsyncServiceSetting:
+    def __init__(self, executor_workers=0, max_pending_requests=64, request_timeout_ms=1000,
+                 retry_after_seconds=1) -> None:
+        if executor_workers < 0: raise ValueError("executor_workers must be >= 0")
+        self.executor_workers = executor_workers
+        if max_pending_requests <= 0: raise ValueError("max_pending_requests must be > 0")
+        self.max_pending_requests = max_pending_requests
+        if request_timeout_ms < 0: raise ValueError("request_timeout_ms must be >= 0")
+        self.request_timeout_ms = request_timeout_ms
+        if retry_after_seconds < 0: raise ValueError("retry_after_seconds must be >= 0")
+        self.retry_after_seconds = retry_after_seconds
+
+
+class PredictionCacheSetting:
+    def __init__(self, max_size=10000, ttl_seconds=0) -> None:
+        if max_size < 0: raise ValueError("max_size must be >= 0")
+        self.max_size = max_size
+        if ttl_seconds < 0: raise ValueError("ttl_seconds must be >= 0")
+        self.ttl_seconds = ttl_seconds
+
+
 class BaseSetting:
     def __init__(self, **kwargs) -> None:
         if kwargs['name'] == "": raise ValueError("name is empty")
@@ -78,6 +169,11 @@ class PreprocessorSetting(BaseSetting):
         self.clean_urls = kwargs['clean_urls']
         self.use_words_lemmatization = kwargs['use_words_lemmatization']
         self.words_lemmatization_setting = WordLemmatizationSetting(**kwargs['words_lemmatization_setting'])
+        self.use_parallel_cleaning = kwargs.get('use_parallel_cleaning', False)
+        self.parallel_cleaning_setting = ParallelCleaningSetting(**kwargs.get('parallel_cleaning_setting', {}))
+        self.use_streaming = kwargs.get('use_streaming', False)
+        self.streaming_setting = StreamingSetting(**kwargs.get('streaming_setting', {}))
+        self.cache_path = kwargs.get('cache_path', "")
 
 
 class TrainerSetting(BaseSetting):
@@ -95,6 +191,12 @@ class TrainerSetting(BaseSetting):
         self.max_sequence_length = kwargs['max_sequence_length']
         self.epochs = kwargs['epochs']
         self.batch_size = kwargs['batch_size']
+        self.export_tflite = kwargs.get('export_tflite', False)
+        self.use_sparse_labels = kwargs.get('use_sparse_labels', False)
+        self.dataset_format = kwargs.get('dataset_format', "csv")
+        self.use_streaming = kwargs.get('use_streaming', False)
+        self.streaming_setting = TrainerStreamingSetting(**kwargs.get('streaming_setting', {}))
+        self.cache_path = kwargs.get('cache_path', "")
 
 
 class ServiceSetting:
@@ -103,9 +205,41 @@ class ServiceSetting:
         self.log_path = kwargs['log_path']
         self.model_path = kwargs['model_path']
         self.dict_path = kwargs['dict_path']
+        self.vocab_path = kwargs.get('vocab_path', "")
         self.classes_path = kwargs['classes_path']
         self.preprocessor_settings_path = kwargs['preprocessor_settings_path']
         self.top_n_predictions = kwargs['top_n_predictions']
+        self.predict_batch_size = kwargs.get('predict_batch_size', 256)
+        if self.predict_batch_size <= 0: raise ValueError("predict_batch_size must be > 0")
+        self.use_request_batching = kwargs.get('use_request_batching', False)
+        self.request_batching_setting = RequestBatchingSetting(**kwargs.get('request_batching_setting', {}))
+        self.use_prediction_cache = kwargs.get('use_prediction_cache', False)
+        self.prediction_cache_setting = PredictionCacheSetting(**kwargs.get('prediction_cache_setting', {}))
+        self.inference_backend = kwargs.get('inference_backend', "keras")
+        self.tflite_model_path = kwargs.get('tflite_model_path', "")
+        self.use_async_logging = kwargs.get('use_async_logging', False)
+        self.async_logging_setting = AsyncLoggingSetting(**kwargs.get('async_logging_setting', {}))
+        self.use_payload_logging = kwargs.get('use_payload_logging', False)
+        self.use_metrics = kwargs.get('use_metrics', False)
+        self.payload_logging_setting = PayloadLoggingSetting(**kwargs.get('payload_logging_setting', {}))
+        self.server_setting = ServerSetting(**kwargs.get('server_setting', {}))
+        self.async_service_setting = AsyncServiceSetting(**kwargs.get('async_service_setting', {}))
+        self.max_loaded_models = kwargs.get('max_loaded_models', 0)
+        if self.max_loaded_models < 0: raise ValueError("max_loaded_models must be >= 0")
+        # Additional models: name -> setting with keys of this setting overridden by keys of the model
+        base = {key: value for key, value in kwargs.items() if key != 'models'}
+        models = kwargs.get('models', {})
+        if DEFAULT_MODEL in models: raise ValueError(f'models can not contain "{DEFAULT_MODEL}" model')
+        self.models = {name: ServiceSetting(**{**base, **model}) for name, model in models.items()}
+
+    def model_setting(self, name: str) -> 'ServiceSetting':
+        """
+        :raises KeyError if there is no such model
+        """
+        return self if name == DEFAULT_MODEL else self.models[name]
+
+    def model_names(self) -> List[str]:
+        return [DEFAULT_MODEL, *self.models.keys()]
 
 
 def get_setting(path: str, setting_type: SettingType) -> Union[PreprocessorSetting, TrainerSetting, ServiceSetting]:
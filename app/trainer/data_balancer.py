@@ -19,15 +19,13 @@ def trim_minor_classes(data: pd.DataFrame, min_class_data: int) -> pd.DataFrame:
     :return: trimmed data
     """
     log.info("Trimming classes shape")
-    classes = data['class_id'].unique()
-
-    for class_id in classes:
-        class_shape = data[data['class_id'] == class_id].shape[0]
-        if class_shape < min_class_data:
-            print(f'Deleting under shape class [{class_id}]')
-            data = data.drop(data[data['class_id'] == class_id].index)
-            data.reset_index(drop=True)
-    return data
+    class_ids = data['class_id']
+    class_shapes = class_ids.value_counts()
+    minor_classes = [class_id for class_id in class_ids.unique() if class_shapes.get(class_id, 0) < min_class_data]
+    for class_id in minor_classes:
+        log.info(f'Deleting under shape class [{class_id}]')
+    # Rows without class_id are never deleted
+    return data[~class_ids.isin(minor_classes) | class_ids.isna()]
 
 
 def over_sample_data(x: pd.DataFrame, y: pd.DataFrame, sample_ratio: dict) -> Tuple[pd.DataFrame, pd.DataFrame]:
@@ -47,9 +45,5 @@ def get_sample_ratio(y: pd.DataFrame, sample_value: int, strategy: str) -> Dict[
     if strategy == "undersample":
         raise NotImplementedError("'undersample' strategy not implemented yet")
     if strategy == "oversample":
-        classes = y.unique()
-        ratio = {}
-        for clazz in classes:
-            if y[y.values == clazz].count() < sample_value:
-                ratio[int(clazz)] = sample_value
-        return ratio
+        class_shapes = y.value_counts()
+        return {int(clazz): sample_value for clazz in y.unique() if class_shapes.get(clazz, 0) < sample_value}
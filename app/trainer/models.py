@@ -1,7 +1,8 @@
+import tensorflow as tf
 import tensorflow.keras.backend as k
 from tensorflow.keras.layers import Embedding, SpatialDropout1D, LSTM, Dense, Conv1D
 from tensorflow.keras.layers import GlobalMaxPool1D
-from tensorflow.keras.metrics import Recall, Precision
+from tensorflow.keras.metrics import Recall, Precision, MeanMetricWrapper
 from tensorflow.keras.models import Sequential
 
 
@@ -15,6 +16,52 @@ def f1(y_true, y_pred):
     return f1_val
 
 
+def sparse_f1(y_true, y_pred):
+    return f1(_one_hot(y_true, y_pred), y_pred)
+
+
+def _one_hot(y_true, y_pred):
+    # Sparse labels (class indices) to the shape of predictions
+    return tf.one_hot(tf.cast(tf.reshape(y_true, [-1]), tf.int32), depth=tf.shape(y_pred)[-1], dtype=y_pred.dtype)
+
+
+class SparseF1(MeanMetricWrapper):
+    """
+    f1 for sparse labels (class indices)
+    """
+
+    def __init__(self, name='f1', dtype=None):
+        super().__init__(sparse_f1, name=name, dtype=dtype)
+
+
+class SparsePrecision(Precision):
+    """
+    Precision for sparse labels (class indices)
+    """
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        return super().update_state(_one_hot(y_true, y_pred), y_pred, sample_weight)
+
+
+class SparseRecall(Recall):
+    """
+    Recall for sparse labels (class indices)
+    """
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        return super().update_state(_one_hot(y_true, y_pred), y_pred, sample_weight)
+
+
+def get_metrics(sparse_labels=False) -> list:
+    if sparse_labels:
+        return ['accuracy', SparsePrecision(name='precision'), SparseRecall(name='recall'), SparseF1()]
+    return ['accuracy', Precision(), Recall(), f1]
+
+
+def get_loss(sparse_labels=False) -> str:
+    return 'sparse_categorical_crossentropy' if sparse_labels else 'categorical_crossentropy'
+
+
 def custom_recall(y_true, y_pred):
     y_true = k.ones_like(y_true)
     true_positives = k.sum(k.round(k.clip(y_true * y_pred, 0, 1)))
@@ -38,39 +85,52 @@ def f1_score(y_true, y_pred):
 
 
 def create_lstm(x, y, model_name: str, num_words: int):
-    metrics = ['accuracy', Precision(), Recall(), f1]
+    return build_lstm(x.shape[1], y.shape[1], model_name, num_words)
+
 
+def build_lstm(input_length: int, num_classes: int, model_name: str, num_words: int, sparse_labels=False):
     model = Sequential(name=model_name)
-    model.add(Embedding(input_dim=num_words, output_dim=100, input_length=x.shape[1]))
+    model.add(Embedding(input_dim=num_words, output_dim=100, input_length=input_length))
     model.add(SpatialDropout1D(0.2))
     model.add(LSTM(100, dropout=0.2, recurrent_dropout=0.2))
-    model.add(Dense(y.shape[1], activation='softmax'))
-    model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=metrics)
+    model.add(Dense(num_classes, activation='softmax'))
+    model.compile(loss=get_loss(sparse_labels), optimizer='adam', metrics=get_metrics(sparse_labels))
     return model
 
 
 def create_embed_model(x, y, model_name: str, num_words: int):
-    metrics = ['accuracy', Precision(), Recall(), f1]
+    return build_embed_model(x.shape[1], y.shape[1], model_name, num_words)
 
+
+def build_embed_model(input_length: int, num_classes: int, model_name: str, num_words: int, sparse_labels=False):
     model = Sequential(name=model_name)
-    model.add(Embedding(input_dim=num_words, output_dim=100, input_length=x.shape[1]))
+    model.add(Embedding(input_dim=num_words, output_dim=100, input_length=input_length))
     model.add(GlobalMaxPool1D())
     model.add(Dense(10, activation='relu'))
-    model.add(Dense(y.shape[1], activation='softmax'))
-    model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=metrics)
+    model.add(Dense(num_classes, activation='softmax'))
+    model.compile(loss=get_loss(sparse_labels), optimizer='adam', metrics=get_metrics(sparse_labels))
     return model
 
 
 # CNNs work best with large training sets where they are able to find generalizations where a simple model like
 # logistic regression won’t be able.
 def create_cnn(x, y, model_name: str, num_words: int):
-    metrics = ['accuracy', Precision(), Recall(), f1]
+    return build_cnn(x.shape[1], y.shape[1], model_name, num_words)
+
 
+def build_cnn(input_length: int, num_classes: int, model_name: str, num_words: int, sparse_labels=False):
+    """
+    :param input_length: sequence length
+    :param num_classes: number of classes (model outputs)
+    :param model_name: model name
+    :param num_words: dictionary size
+    :param sparse_labels: labels are class indices instead of one-hot vectors
+    """
     model = Sequential(name=model_name)
-    model.add(Embedding(input_dim=num_words, output_dim=100, input_length=x.shape[1]))
+    model.add(Embedding(input_dim=num_words, output_dim=100, input_length=input_length))
     model.add(Conv1D(128, 5, activation='relu'))
     model.add(GlobalMaxPool1D())
     model.add(Dense(10, activation='relu'))
-    model.add(Dense(y.shape[1], activation='softmax'))
-    model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=metrics)
+    model.add(Dense(num_classes, activation='softmax'))
+    model.compile(loss=get_loss(sparse_labels), optimizer='adam', metrics=get_metrics(sparse_labels))
     return model
@@ -0,0 +1,266 @@
+import itertools
+import logging
+import math
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras.callbacks import EarlyStopping
+from tensorflow.keras.preprocessing.text import Tokenizer
+
+from settings import TrainerSetting
+from trainer.models import build_cnn
+from trainer.train import log_evaluation, save_trained_model, save_classes, save_class_index, PARITY_SAMPLES
+from trainer.train import dataset_file, DATASET_COLUMNS
+from trainer.visualization import build_graphs
+from utils import logger_utils, text_utils
+from utils.file_utils import read_dataset_chunks, serialize_dict, serialize_vocabulary, DatasetWriter
+from utils.file_utils import process_path
+from utils.vocabulary import Vocabulary
+
+log = logging.getLogger("streaming_trainer")
+
+TRAIN, VALIDATION, TEST = 0, 1, 2
+SPLIT_NAMES = {TRAIN: "train", VALIDATION: "val", TEST: "test"}
+
+
+class StreamingDataset:
+    """
+    Training data read from csv by chunks on every pass.
+    Rows are assigned to train/validation/test by hash of the row number, so splits are the same on every pass.
+    Only dictionary, class statistics and one chunk are kept in memory
+    """
+
+    def __init__(self, setting: TrainerSetting) -> None:
+        self.setting = setting
+        self.chunk_size = setting.streaming_setting.chunk_size
+        self.seed = setting.streaming_setting.seed
+        self.train_fraction = _split_fraction(setting.train_data_size, "train_data_size")
+        self.validation_fraction = _split_fraction(setting.validation_data_size, "validation_data_size")
+        # class_id -> rows count of every split
+        self.class_counts: pd.DataFrame = None
+        self.class_names: pd.DataFrame = None
+        self.class_ids: np.ndarray = None
+        self.vocabulary: Vocabulary = None
+        # class index -> expected number of samples of the class per epoch / number of samples in train split
+        self.sample_ratio: np.ndarray = None
+        # class index -> weight of train samples
+        self.sample_weights: np.ndarray = None
+        # Expected number of train samples per epoch
+        self.train_size = 0
+
+    def chunks(self) -> Iterator[Tuple[pd.DataFrame, np.ndarray]]:
+        """
+        :return: iterator over (chunk, split of every row)
+        """
+        start = 0
+        for chunk in read_dataset_chunks(self.setting.input_data_path, self.chunk_size, columns=DATASET_COLUMNS):
+            splits = self._assign_splits(np.arange(start, start + chunk.shape[0], dtype=np.uint64))
+            start += chunk.shape[0]
+            labelled = chunk['class_id'].notna().values
+            yield chunk[labelled], splits[labelled]
+
+    def _assign_splits(self, rows: np.ndarray) -> np.ndarray:
+        position = _hash_to_unit(rows + np.uint64(self.seed))
+        splits = np.full(rows.shape[0], TEST, dtype=np.int8)
+        validation_threshold = self.train_fraction + (1 - self.train_fraction) * self.validation_fraction
+        splits[position < validation_threshold] = VALIDATION
+        splits[position < self.train_fraction] = TRAIN
+        return splits
+
+    def scan(self) -> None:
+        """
+        First pass: count rows of every class in every split and collect class names
+        """
+        log.info("Counting classes")
+        counts = []
+        names = []
+        for chunk, splits in self.chunks():
+            counts.append(pd.crosstab(chunk['class_id'].values, splits))
+            names.append(chunk[['class_id', 'class_name']].drop_duplicates('class_id'))
+        class_counts = pd.concat(counts).groupby(level=0).sum() if len(counts) > 0 else pd.DataFrame()
+        self.class_counts = class_counts.reindex(columns=[TRAIN, VALIDATION, TEST], fill_value=0).astype(np.int64)
+        self.class_names = pd.concat(names).drop_duplicates('class_id') if len(names) > 0 else None
+        log.info(f'Train/test/validation dataset split: {self.class_counts[TRAIN].sum()}, '
+                 f'{self.class_counts[TEST].sum()}, {self.class_counts[VALIDATION].sum()}')
+
+    def trim_minor_classes(self, min_class_data: int) -> None:
+        log.info("Trimming classes shape")
+        total = self.class_counts.sum(axis=1)
+        for class_id in total[total < min_class_data].index:
+            log.info(f'Deleting under shape class [{class_id}]')
+        self.class_counts = self.class_counts[total >= min_class_data]
+
+    def fit_dictionary(self, num_words: int) -> Tokenizer:
+        """
+        Second pass: fit dictionary on texts of all kept classes by chunks.
+        Splits are saved to intermediate_data_path if it is set
+        """
+        log.info("Creating vocabulary")
+        self.class_ids = np.sort(self.class_counts.index.values)
+        tokenizer = Tokenizer(num_words=num_words if num_words > 0 else None, filters=text_utils.TOKEN_FILTER)
+        writers = {}
+        if self.setting.intermediate_data_path != "":
+            path = process_path(self.setting.intermediate_data_path, make_dirs=True)
+            writers = {split: DatasetWriter(dataset_file(path, name, self.setting), DATASET_COLUMNS)
+                       for split, name in SPLIT_NAMES.items()}
+        try:
+            for chunk, splits in self.chunks():
+                kept = np.isin(chunk['class_id'].values, self.class_ids)
+                tokenizer.fit_on_texts(chunk['text'].values[kept])
+                for split, writer in writers.items():
+                    writer.write(chunk[kept & (splits == split)])
+        finally:
+            for writer in writers.values():
+                writer.close()
+        log.info(f'Found {len(tokenizer.word_index) + 1} unique tokens')
+        self.vocabulary = Vocabulary.from_tokenizer(tokenizer)
+        return tokenizer
+
+    def init_sampling(self, sample_ratio: Dict[int, int]) -> np.ndarray:
+        """
+        Over sampling by expected number of repeats of every train row instead of copies of rows
+
+        :param sample_ratio: class_id -> number of train samples after over sampling
+        :return: balanced weight of every class index for the over sampled train split
+        """
+        train_counts = self.class_counts[TRAIN].reindex(self.class_ids, fill_value=0).values.astype(np.float64)
+        targets = train_counts.copy()
+        for class_id, value in sample_ratio.items():
+            index = np.searchsorted(self.class_ids, int(class_id))
+            if index < len(self.class_ids) and self.class_ids[index] == int(class_id):
+                if value < train_counts[index]:
+                    raise ValueError(f'Over sampling value {value} of class {class_id} is less than number of '
+                                     f'train samples {int(train_counts[index])}')
+                targets[index] = value
+        targets[train_counts == 0] = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.sample_ratio = np.where(train_counts > 0, targets / train_counts, 0.0)
+            weights = np.where(targets > 0, targets.sum() / (np.count_nonzero(targets) * targets), 0.0)
+        log.info(f'Dataset size before oversampling: {int(train_counts.sum())}')
+        log.info(f'Dataset size after oversampling: {int(targets.sum())}')
+        self.train_size = int(targets.sum())
+        return weights
+
+    def batches(self, split: int, sample_weight=False, epoch=0) -> Iterator[tuple]:
+        """
+        Encoded chunks of the split: (sequences, class indices[, sample weights]).
+        Train chunks are over sampled and shuffled with seed of the epoch
+        """
+        random = np.random.default_rng([self.seed, epoch])
+        for chunk, splits in self.chunks():
+            class_ids = chunk['class_id'].values
+            kept = (splits == split) & np.isin(class_ids, self.class_ids)
+            if not kept.any():
+                continue
+            labels = np.searchsorted(self.class_ids, class_ids[kept]).astype(np.int32)
+            rows = np.arange(labels.shape[0])
+            if split == TRAIN:
+                ratio = self.sample_ratio[labels]
+                repeats = np.floor(ratio).astype(np.int64)
+                repeats += random.random(ratio.shape[0]) < ratio - repeats
+                rows = random.permutation(np.repeat(rows, repeats))
+            x = self.vocabulary.encode(chunk['text'].values[kept][rows], self.setting.max_sequence_length)
+            if sample_weight:
+                yield x, labels[rows], self.sample_weights[labels[rows]]
+            else:
+                yield x, labels[rows]
+
+    def to_tf_dataset(self, split: int, batch_size: int, sample_weight=False) -> tf.data.Dataset:
+        """
+        Train dataset is repeated infinitely, because over sampled epochs have different size
+        (use steps_per_epoch), validation and test datasets are read once per iteration
+        """
+        signature = (tf.TensorSpec(shape=(None, self.setting.max_sequence_length), dtype=tf.int32),
+                     tf.TensorSpec(shape=(None,), dtype=tf.int32))
+        if sample_weight:
+            signature = signature + (tf.TensorSpec(shape=(None,), dtype=tf.float32),)
+        epochs = itertools.count()
+        dataset = tf.data.Dataset.from_generator(lambda: self.batches(split, sample_weight, next(epochs)),
+                                                 output_signature=signature).unbatch()
+        if split == TRAIN:
+            dataset = dataset.shuffle(self.setting.streaming_setting.shuffle_buffer_size, seed=self.seed,
+                                      reshuffle_each_iteration=True).repeat()
+        return dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+    def sample(self, split: int, size: int) -> np.ndarray:
+        x = [batch[0] for batch in itertools.islice(self.batches(split), 1)]
+        return x[0][:size] if len(x) > 0 else np.zeros((0, self.setting.max_sequence_length), dtype=np.int32)
+
+
+def _split_fraction(size, name: str) -> float:
+    # The same defaults as train_test_split if size is not set
+    if size is None or size == 0:
+        return 0.75
+    if not isinstance(size, float) or not 0 < size < 1:
+        raise ValueError(f'{name} must be a fraction between 0 and 1 for streaming training. Got: {size}')
+    return size
+
+
+def _hash_to_unit(values: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer -> uniform float in [0, 1)
+    z = values + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+@logger_utils.profile
+def execute_streaming_trainer(setting: TrainerSetting) -> None:
+    """
+    Train model on data streamed from csv by chunks through tf.data pipeline with sparse labels.
+    Memory usage does not depend on dataset size
+    """
+    dataset = StreamingDataset(setting)
+    dataset.scan()
+    balancer_setting = setting.data_balancing_setting
+    if setting.use_data_balancing and balancer_setting.min_class_data > 0:
+        dataset.trim_minor_classes(balancer_setting.min_class_data)
+
+    dictionary = dataset.fit_dictionary(setting.dict_num_words)
+    serialize_dict(setting.output_data_path, dictionary)
+    serialize_vocabulary(setting.output_data_path, dictionary)
+    classes_path = dataset_file(setting.output_data_path, 'classes', setting)
+    save_classes(dataset.class_names[dataset.class_names['class_id'].isin(dataset.class_ids)], None, classes_path)
+    save_class_index(dataset.class_ids, classes_path)
+
+    sample_ratio = {}
+    if setting.use_data_balancing:
+        if balancer_setting.over_sampling_value > 0:
+            train_counts = dataset.class_counts[TRAIN]
+            sample_ratio = {int(class_id): balancer_setting.over_sampling_value
+                            for class_id, count in train_counts.items() if count < balancer_setting.over_sampling_value}
+        elif len(balancer_setting.over_sampling_ratio) > 0:
+            sample_ratio = balancer_setting.over_sampling_ratio
+    weights = dataset.init_sampling(sample_ratio)
+    class_weights = None
+    if setting.use_sample_weight:
+        # Keras can not apply class weights to dataset with sample weights, so they are multiplied here
+        sample_weights = weights * weights if setting.use_class_weight else weights
+        dataset.sample_weights = sample_weights.astype(np.float32)
+    elif setting.use_class_weight:
+        class_weights = dict(enumerate(weights.tolist()))
+
+    train_data = dataset.to_tf_dataset(TRAIN, setting.batch_size, sample_weight=setting.use_sample_weight)
+    val_data = dataset.to_tf_dataset(VALIDATION, setting.batch_size)
+    test_data = dataset.to_tf_dataset(TEST, setting.batch_size)
+
+    if setting.dict_num_words == 0:
+        setting.dict_num_words = len(dictionary.word_index) + 1  # Adding 1 because of reserved 0 index
+    model = build_cnn(setting.max_sequence_length, len(dataset.class_ids), setting.model_name, setting.dict_num_words,
+                      sparse_labels=True)
+    model.summary(print_fn=log.info)
+
+    callbacks = [EarlyStopping(monitor='val_loss', patience=3, min_delta=0.0001, verbose=2)]
+
+    log.info(f'Start training model: "{model.name}" with {setting.epochs} epochs')
+    steps_per_epoch = max(1, math.ceil(dataset.train_size / setting.batch_size))
+    history = model.fit(train_data, class_weight=class_weights, epochs=setting.epochs, steps_per_epoch=steps_per_epoch,
+                        validation_data=val_data, callbacks=callbacks)
+    metrics = model.evaluate(test_data)
+    log_evaluation(metrics, history)
+
+    save_trained_model(setting, model, dataset.sample(TEST, PARITY_SAMPLES))
+    build_graphs(history, setting.output_data_path)
@@ -2,36 +2,37 @@ import json
 import logging
 import os
 import sys
+from typing import Union, Tuple
 
 import numpy as np
 import pandas as pd
 import sklearn.model_selection as model_selection
 from sklearn.utils import class_weight
 from tensorflow.keras.callbacks import EarlyStopping
-from tensorflow.keras.preprocessing import sequence
 from tensorflow.keras.preprocessing.text import Tokenizer
 
+from utils.inference_backends import KerasBackend, TFLiteBackend, NumpyBackend, check_backend_parity
 from settings import TrainerSetting, get_setting, SettingType
 from trainer.data_balancer import trim_minor_classes, over_sample_data, get_sample_ratio
-from trainer.models import create_cnn
+from trainer.models import build_cnn
 from trainer.visualization import build_graphs
 from utils import logger_utils, text_utils
-from utils.file_utils import read_dataset, save_dataset, serialize_dict, save_model
+from utils.corpus_cache import CorpusCache, make_key, texts_digest
+from utils.file_utils import read_dataset, save_dataset, serialize_dict, save_model, save_tflite_model
+from utils.file_utils import serialize_vocabulary, class_index_path
+from utils.sequence_utils import prep_bag_of_words
 
 os.environ['TF_XLA_FLAGS'] = '--tf_xla_enable_xla_devices'
 log = logging.getLogger("trainer")
+PARITY_SAMPLES = 1000
+# Columns of cleaned dataset used by trainer
+DATASET_COLUMNS = ['class_id', 'class_name', 'text']
 
 
 def prep_tfidf(text_data, tokenizer: Tokenizer) -> np.ndarray:
     return tokenizer.texts_to_matrix(text_data, mode='tfidf')
 
 
-def prep_bag_of_words(text_data, tokenizer: Tokenizer, max_sequence_length: int) -> np.ndarray:
-    # Turns text into padded sequences.
-    text_sequences = tokenizer.texts_to_sequences(text_data)
-    return sequence.pad_sequences(text_sequences, maxlen=max_sequence_length, padding='post', truncating='post')
-
-
 def create_dictionary(text_data, num_words: int) -> Tokenizer:
     log.info("Creating vocabulary")
     if num_words == 0:
@@ -42,6 +43,37 @@ def create_dictionary(text_data, num_words: int) -> Tokenizer:
     return tokenizer
 
 
+def create_cached_dictionary(texts: pd.Series, num_words: int, cache: CorpusCache = None) -> Tuple[Tokenizer, str]:
+    """
+    Fit dictionary on texts or load it from cache
+
+    :return: dictionary and its cache key (hash of texts and dictionary parameters)
+    """
+    key = make_key(texts=texts_digest(texts), num_words=num_words, filters=text_utils.TOKEN_FILTER)
+    dictionary = cache.get_dictionary(key) if cache is not None else None
+    if dictionary is None:
+        dictionary = create_dictionary(texts.values, num_words)
+        if cache is not None:
+            cache.put_dictionary(key, dictionary)
+    return dictionary, key
+
+
+def encode_cached_texts(texts: pd.Series, dictionary: Tokenizer, dictionary_key: str, max_sequence_length: int,
+                        cache: CorpusCache = None) -> np.ndarray:
+    """
+    Encode texts to padded sequences or load them from cache (memory-mapped)
+
+    :param dictionary_key: cache key of dictionary fitted on the same texts
+    """
+    key = make_key(dictionary=dictionary_key, max_sequence_length=max_sequence_length)
+    sequences = cache.get_sequences(key) if cache is not None else None
+    if sequences is None:
+        sequences = prep_bag_of_words(texts.values, dictionary, max_sequence_length)
+        if cache is not None:
+            cache.put_sequences(key, sequences)
+    return sequences
+
+
 def get_class_weights(y: np.ndarray) -> list:
     return class_weight.compute_class_weight(class_weight='balanced', classes=np.unique(y), y=y)
 
@@ -52,6 +84,45 @@ def get_sample_weight(y: np.ndarray) -> np.ndarray:
     return class_weight.compute_sample_weight(class_weight=class_weights_dict, y=y)
 
 
+def encode_labels(y: np.ndarray, class_ids: np.ndarray, sparse_labels=False) -> Union[np.ndarray, pd.DataFrame]:
+    """
+    Encode class ids with the same class order for all dataset splits
+
+    :param y: class ids
+    :param class_ids: sorted class ids of the whole dataset (model outputs order)
+    :param sparse_labels: return class indices instead of one-hot vectors
+    :return: class indices vector or one-hot DataFrame (samples x classes)
+    """
+    if sparse_labels:
+        return np.searchsorted(class_ids, y).astype(np.int32)
+    return pd.get_dummies(pd.Categorical(y, categories=class_ids))
+
+
+def get_class_weights_by_index(y: np.ndarray, class_ids: np.ndarray) -> dict:
+    """
+    Balanced class weights for Keras class_weight: {class index: weight}.
+    Classes missing in y get weight 1
+    """
+    weights = dict.fromkeys(range(len(class_ids)), 1.0)
+    weights.update(zip(np.searchsorted(class_ids, np.unique(y)).tolist(), get_class_weights(y)))
+    return weights
+
+
+def dataset_file(path: str, name: str, setting: TrainerSetting) -> str:
+    """
+    :return: path to dataset file [name].[dataset_format] in path
+    """
+    return os.path.join(path, f'{name}.{setting.dataset_format}')
+
+
+def save_class_index(class_ids: np.ndarray, classes_path: str) -> None:
+    """
+    Save class_id -> model output index mapping next to classes file
+    """
+    class_index = pd.DataFrame({'class_id': class_ids, 'class_index': np.arange(len(class_ids))})
+    save_dataset(class_index, class_index_path(classes_path))
+
+
 def save_classes(data: pd.DataFrame, weights: dict, path: str) -> None:
     classes = pd.DataFrame()
     classes['class_id'] = data['class_id']
@@ -65,15 +136,17 @@ def save_classes(data: pd.DataFrame, weights: dict, path: str) -> None:
         classes_dict['class_id'] = weights.keys()
         classes_dict['class_weight'] = weights.values()
         classes = classes.merge(classes_dict, on='class_id')
-    save_dataset(classes, os.path.join(path, 'classes.csv'))
+    save_dataset(classes, path)
 
 
 def execute_trainer(setting: TrainerSetting) -> None:
-    data = read_dataset(setting.input_data_path)
+    data = read_dataset(setting.input_data_path, columns=DATASET_COLUMNS)
 
     balancer_setting = setting.data_balancing_setting
     if setting.use_data_balancing and balancer_setting.min_class_data > 0:
         data = trim_minor_classes(data, balancer_setting.min_class_data)
+    # Row labels are positions in encoded sequences of the whole dataset
+    data = data.reset_index(drop=True)
 
     if setting.train_data_size == 0: setting.train_data_size = None
     if setting.validation_data_size == 0: setting.validation_data_size = None
@@ -88,45 +161,55 @@ def execute_trainer(setting: TrainerSetting) -> None:
     if setting.use_data_balancing:
         if balancer_setting.over_sampling_value > 0:
             sample_ratio = get_sample_ratio(y_train, balancer_setting.over_sampling_value, "oversample")
-            x_train, y_train = over_sample_data(x_train, y_train, sample_ratio)
+            x_train, y_train = over_sample_rows(x_train, y_train, sample_ratio)
         elif len(balancer_setting.over_sampling_ratio) > 0:
-            x_train, y_train = over_sample_data(x_train, y_train, balancer_setting.over_sampling_ratio)
+            x_train, y_train = over_sample_rows(x_train, y_train, balancer_setting.over_sampling_ratio)
 
     if setting.intermediate_data_path != "":
-        save_dataset(x_train, os.path.join(setting.intermediate_data_path, 'train.csv'))
-        save_dataset(x_test, os.path.join(setting.intermediate_data_path, 'test.csv'))
-        save_dataset(x_val, os.path.join(setting.intermediate_data_path, 'val.csv'))
+        save_dataset(x_train, dataset_file(setting.intermediate_data_path, 'train', setting))
+        save_dataset(x_test, dataset_file(setting.intermediate_data_path, 'test', setting))
+        save_dataset(x_val, dataset_file(setting.intermediate_data_path, 'val', setting))
 
+    # Model outputs order for all splits
+    class_ids = np.sort(data['class_id'].unique())
     class_weights = None
     if setting.use_class_weight:
-        class_weights = get_class_weights(y_train.values)
-        # Використовується dict(enumeration, class_weights) для підтримки масиву [y] з get_dummies()
-        # Використовується dict(class_label, class_weights) якщо значення [y] передаються напряму в модель
-        class_weights = dict(enumerate(class_weights))  # as {class enumeration, class}
+        # Використовується dict(class index, class_weights) для підтримки індексів класів і масиву [y] з get_dummies()
+        class_weights = get_class_weights_by_index(y_train.values, class_ids)
 
     sample_weights = None
     class_weights_dict = None
     if setting.use_sample_weight:
         sample_weights = get_sample_weight(y_train.values)
 
-    dictionary = create_dictionary(data['text'].values, setting.dict_num_words)
+    cache = CorpusCache(setting.cache_path) if setting.cache_path != "" else None
+    dictionary, dictionary_key = create_cached_dictionary(data['text'], setting.dict_num_words, cache)
     serialize_dict(setting.output_data_path, dictionary)
+    serialize_vocabulary(setting.output_data_path, dictionary)
 
-    x_train = prep_bag_of_words(x_train['text'].values, dictionary, setting.max_sequence_length)
-    x_test = prep_bag_of_words(x_test['text'].values, dictionary, setting.max_sequence_length)
-    x_val = prep_bag_of_words(x_val['text'].values, dictionary, setting.max_sequence_length)
+    # Every text is encoded once, splits (and oversampled rows) are taken by row positions
+    sequences = encode_cached_texts(data['text'], dictionary, dictionary_key, setting.max_sequence_length, cache)
+    x_train = sequences[x_train.index.values]
+    x_test = sequences[x_test.index.values]
+    x_val = sequences[x_val.index.values]
+    del sequences
 
-    y_train = pd.get_dummies(y_train.values)
-    y_test = pd.get_dummies(y_test.values)
-    y_val = pd.get_dummies(y_val.values)
+    y_train = encode_labels(y_train.values, class_ids, setting.use_sparse_labels)
+    y_test = encode_labels(y_test.values, class_ids, setting.use_sparse_labels)
+    y_val = encode_labels(y_val.values, class_ids, setting.use_sparse_labels)
 
-    save_classes(data, class_weights_dict, setting.output_data_path)
+    classes_path = dataset_file(setting.output_data_path, 'classes', setting)
+    save_classes(data, class_weights_dict, classes_path)
+    save_class_index(class_ids, classes_path)
 
     if setting.dict_num_words == 0:
         setting.dict_num_words = len(dictionary.word_index) + 1  # Adding 1 because of reserved 0 index
-    # lstm = create_lstm(x_train, y_train, setting.model_name, setting.dict_num_words)
-    # lstm = create_embed_model(x_train, y_train, setting.model_name, setting.dict_num_words)
-    lstm = create_cnn(x_train, y_train, setting.model_name, setting.dict_num_words)
+    # lstm = build_lstm(x_train.shape[1], len(class_ids), setting.model_name, setting.dict_num_words,
+    #                   sparse_labels=setting.use_sparse_labels)
+    # lstm = build_embed_model(x_train.shape[1], len(class_ids), setting.model_name, setting.dict_num_words,
+    #                          sparse_labels=setting.use_sparse_labels)
+    lstm = build_cnn(x_train.shape[1], len(class_ids), setting.model_name, setting.dict_num_words,
+                     sparse_labels=setting.use_sparse_labels)
     lstm.summary(print_fn=log.info)
 
     callbacks = [EarlyStopping(monitor='val_loss', patience=3, min_delta=0.0001, verbose=2)]
@@ -137,6 +220,21 @@ def execute_trainer(setting: TrainerSetting) -> None:
                        batch_size=setting.batch_size, validation_data=(x_val, y_val),
                        callbacks=callbacks)
     metrics = lstm.evaluate(x_test, y_test)
+    log_evaluation(metrics, history)
+
+    save_trained_model(setting, lstm, x_test[:PARITY_SAMPLES])
+    build_graphs(history, setting.output_data_path)
+
+
+def over_sample_rows(x: pd.DataFrame, y: pd.Series, sample_ratio: dict) -> Tuple[pd.DataFrame, pd.Series]:
+    """
+    Oversample data keeping row labels of x (repeated for copied rows)
+    """
+    rows, y = over_sample_data(pd.DataFrame({'row': x.index.values}), y, sample_ratio)
+    return x.loc[rows['row'].values], y
+
+
+def log_evaluation(metrics: list, history) -> None:
     log.info(f'Model evaluation:\n'
              f'Loss: {metrics[0]}\n'
              f'Accuracy: {metrics[1]}\n'
@@ -144,9 +242,21 @@ def execute_trainer(setting: TrainerSetting) -> None:
              f'Recall: {metrics[3]}\n'
              f'Actual epochs: {len(history.epoch)}')
 
-    save_model(setting.output_data_path, lstm)
 
-    build_graphs(history, setting.output_data_path)
+def save_trained_model(setting: TrainerSetting, model, x_sample: np.ndarray) -> None:
+    """
+    Save model (and TFLite model if 'export_tflite' is set) and check predictions of serving backends on x_sample
+    """
+    model_path = save_model(setting.output_data_path, model)
+    try:
+        numpy_model = NumpyBackend(model_path)
+    except NotImplementedError as e:
+        log.info(f'Model can not be served by NumPy backend: {e}')
+    else:
+        check_backend_parity(KerasBackend(model), numpy_model, x_sample)
+    if setting.export_tflite:
+        tflite_path = save_tflite_model(setting.output_data_path, model)
+        check_backend_parity(KerasBackend(model), TFLiteBackend(tflite_path, allow_tensorflow=True), x_sample)
 
 
 if __name__ == "__main__":
@@ -156,6 +266,10 @@ if __name__ == "__main__":
         trainer_settings: TrainerSetting = get_setting(str(sys.argv[1]), SettingType.trainer)
         logger_utils.init_logging(trainer_settings.log_path + "\\" + trainer_settings.name)
         log.info(f'Using settings:\n{json.dumps(trainer_settings.__dict__, default=lambda x: x.__dict__)}')
-        execute_trainer(trainer_settings)
+        if trainer_settings.use_streaming:
+            from trainer.streaming_train import execute_streaming_trainer
+            execute_streaming_trainer(trainer_settings)
+        else:
+            execute_trainer(trainer_settings)
     else:
         print("Unknown number of arguments! Exit...")
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class LRUCache:
+    """
+    Bounded thread-safe key-value cache with LRU eviction and hit/miss counters.
+    If ttl (seconds) is set, entries older than ttl are treated as missing.
+    Cache with max_size=0 stores nothing and every lookup is a miss
+    """
+
+    def __init__(self, max_size: int, ttl: float = None) -> None:
+        if max_size < 0:
+            raise ValueError(f'Cache size must be >= 0. Got: {max_size}')
+        if ttl is not None and ttl <= 0:
+            raise ValueError(f'Cache ttl must be > 0. Got: {ttl}')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and self._expires[key] <= time.monotonic():
+                del self._data[key]
+                del self._expires[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_size == 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            if len(self._data) > self.max_size:
+                self._evict()
+
+    def resize(self, max_size: int) -> None:
+        """
+        Change cache capacity. The least recently used entries are evicted if cache is bigger than new size
+        """
+        if max_size < 0:
+            raise ValueError(f'Cache size must be >= 0. Got: {max_size}')
+        with self._lock:
+            self.max_size = max_size
+            while len(self._data) > self.max_size:
+                self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _evict(self) -> None:
+        key, _ = self._data.popitem(last=False)
+        self._expires.pop(key, None)
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hit_rate(), 4)}
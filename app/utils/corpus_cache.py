@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+from utils.file_utils import process_path, serialize_dict, deserialize_dict, dataset_extension
+
+log = logging.getLogger("corpus_cache")
+
+# Part of every key. Bump when cleaning or encoding code changes its output for the same input and setting
+CACHE_VERSION = 1
+CLEANED_DIR = "cleaned"
+DICTIONARY_DIR = "dictionary"
+SEQUENCES_DIR = "sequences"
+_READ_BLOCK_SIZE = 1 << 20
+
+
+def file_digest(path: str) -> str:
+    """
+    Content hash of file. For directory - hash of names and contents of all its files
+    """
+    path = process_path(path)
+    digest = hashlib.blake2b(digest_size=16)
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, name)
+            if os.path.isfile(file_path):
+                digest.update(name.encode("utf-8"))
+                digest.update(file_digest(file_path).encode("ascii"))
+        return digest.hexdigest()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(_READ_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def texts_digest(texts: pd.Series) -> str:
+    """
+    Order sensitive hash of texts (vectorized by pandas, much faster than hashing text by text)
+    """
+    hashes = pd.util.hash_pandas_object(texts.reset_index(drop=True), index=False).values
+    return hashlib.blake2b(hashes.tobytes(), digest_size=16).hexdigest()
+
+
+def make_key(**parts: Any) -> str:
+    """
+    Cache key of named parts: strings, numbers, lists, dicts or setting objects
+    """
+    parts = json.dumps({"version": CACHE_VERSION, **parts}, sort_keys=True, default=lambda x: x.__dict__)
+    return hashlib.blake2b(parts.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class CorpusCache:
+    """
+    Content-addressed cache of intermediate training data in a directory:
+    cleaned datasets, fitted dictionaries and encoded sequences (.npy, memory-mapped on load).
+    Entries are written to temporary files and renamed, so interrupted run never leaves broken entry
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = process_path(path, make_dirs=True)
+
+    def _entry(self, directory: str, name: str) -> str:
+        return os.path.join(self.path, directory, name)
+
+    def _commit(self, tmp_path: str, path: str) -> None:
+        os.replace(tmp_path, path)
+        log.info(f'Cached: {path}')
+
+    def get_cleaned(self, key: str, output_path: str) -> bool:
+        """
+        Copy cleaned dataset from cache to output_path. Entries of different formats are stored separately
+
+        :return: False if there is no such entry
+        """
+        extension = dataset_extension(output_path)
+        path = self._entry(CLEANED_DIR, key + extension)
+        if not os.path.exists(path):
+            log.info(f'Cleaned data is not cached: {key}')
+            return False
+        output_path = process_path(output_path, make_dirs=True, file_extension=extension)
+        shutil.copyfile(path, output_path)
+        log.info(f'Cleaned data restored from cache {path} to: {output_path}')
+        return True
+
+    def put_cleaned(self, key: str, data_path: str) -> None:
+        path = self._entry(CLEANED_DIR, key + dataset_extension(data_path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(process_path(data_path), path + ".tmp")
+        self._commit(path + ".tmp", path)
+
+    def get_dictionary(self, key: str) -> Optional[Any]:
+        path = self._entry(DICTIONARY_DIR, key)
+        if not os.path.exists(path):
+            return None
+        return deserialize_dict(os.path.join(path, 'dict.bin'))
+
+    def put_dictionary(self, key: str, dictionary: Any) -> None:
+        path = self._entry(DICTIONARY_DIR, key)
+        serialize_dict(path + ".tmp", dictionary)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        self._commit(path + ".tmp", path)
+
+    def get_sequences(self, key: str) -> Optional[np.ndarray]:
+        path = self._entry(SEQUENCES_DIR, key + ".npy")
+        if not os.path.exists(path):
+            return None
+        log.info(f'Loading sequences from: {path}')
+        return np.load(path, mmap_mode="r")
+
+    def put_sequences(self, key: str, sequences: np.ndarray) -> None:
+        path = self._entry(SEQUENCES_DIR, key + ".npy")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as file:
+            np.save(file, sequences)
+        self._commit(path + ".tmp", path)
@@ -1,11 +1,20 @@
 import logging
 import os
 import pickle
-from typing import Any
+from typing import Any, Iterator, List
 
 import pandas as pd
 
+from utils.vocabulary import Vocabulary
+
 log = logging.getLogger("file_utils")
+# Dataset formats by file extension. Parquet and Feather (Arrow IPC) require pyarrow
+CSV = ".csv"
+PARQUET = ".parquet"
+FEATHER = ".feather"
+DATASET_EXTENSIONS = [CSV, PARQUET, FEATHER]
+PARQUET_ROW_GROUP_SIZE = 100000
+CLASS_INDEX_NAME = 'class_index'
 
 
 def process_path(path: str, make_dirs=False, file_extension='') -> str:
@@ -39,21 +48,149 @@ def process_path(path: str, make_dirs=False, file_extension='') -> str:
             raise ValueError(f'Unknown path: {path}. CWD: {os.getcwd()}')
 
 
-def read_dataset(file_path: str) -> pd.DataFrame:
+def dataset_extension(path: str) -> str:
+    """
+    :return: dataset format of file: '.csv', '.parquet' or '.feather'
+    :raises ValueError if extension is not supported
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in DATASET_EXTENSIONS:
+        raise ValueError(f'Unknown dataset format {extension}. Possible values: {DATASET_EXTENSIONS}. Path: {path}')
+    return extension
+
+
+def read_dataset(file_path: str, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Read dataset, format is chosen by file extension. Feather files are memory-mapped
+
+    :param file_path: path to .csv, .parquet or .feather file
+    :param columns: read only these columns (all if None)
+    """
     file_path = process_path(file_path)
+    extension = dataset_extension(file_path)
     log.info(f'Reading data from: {file_path}')
-    data = pd.read_csv(file_path, header=0, delimiter=";", encoding='utf-8')
+    if extension == PARQUET:
+        data = pd.read_parquet(file_path, columns=columns)
+    elif extension == FEATHER:
+        from pyarrow import feather
+        data = feather.read_table(file_path, columns=columns, memory_map=True).to_pandas()
+    else:
+        data = pd.read_csv(file_path, header=0, delimiter=";", encoding='utf-8', usecols=columns)
     log.info("Data shape: {}".format(data.shape))
     return data
 
 
+def read_dataset_chunks(file_path: str, chunk_size: int, columns: List[str] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read dataset lazily by chunks of chunk_size rows. Parquet file is read by batches of row groups,
+    Feather file is memory-mapped and sliced
+
+    :param file_path: path to .csv, .parquet or .feather file
+    :param chunk_size: number of rows in chunk
+    :param columns: read only these columns (all if None)
+    :return: iterator over DataFrame chunks
+    """
+    file_path = process_path(file_path)
+    extension = dataset_extension(file_path)
+    log.info(f'Reading data by {chunk_size} row(s) from: {file_path}')
+    if extension == PARQUET:
+        import pyarrow.parquet as pq
+        batches = pq.ParquetFile(file_path).iter_batches(batch_size=chunk_size, columns=columns)
+        return (batch.to_pandas() for batch in batches)
+    if extension == FEATHER:
+        from pyarrow import feather
+        table = feather.read_table(file_path, columns=columns, memory_map=True)
+        return (batch.to_pandas() for batch in table.to_batches(max_chunksize=chunk_size))
+    return pd.read_csv(file_path, header=0, delimiter=";", encoding='utf-8', chunksize=chunk_size, usecols=columns)
+
+
 def save_dataset(data: pd.DataFrame, path: str) -> None:
-    path = process_path(path, make_dirs=True, file_extension='.csv')
-    log.info("Saving to csv...")
-    data.to_csv(path, sep=';', encoding='utf-8', index=False)
+    """
+    Save dataset, format is chosen by file extension (.csv, .parquet or .feather)
+    """
+    extension = dataset_extension(path)
+    path = process_path(path, make_dirs=True, file_extension=extension)
+    log.info(f'Saving to {extension[1:]}...')
+    if extension == PARQUET:
+        data.to_parquet(path, index=False, row_group_size=PARQUET_ROW_GROUP_SIZE)
+    elif extension == FEATHER:
+        data.reset_index(drop=True).to_feather(path)
+    else:
+        data.to_csv(path, sep=';', encoding='utf-8', index=False)
     log.info(f'Saved to: {path}')
 
 
+class DatasetWriter:
+    """
+    Write dataset by chunks: csv rows are appended, every chunk is a row group of Parquet file
+    or record batch of Feather file. Schema of Parquet/Feather file is taken from the first chunk.
+    If no chunk is written, file with columns and no rows is saved on close
+    """
+
+    def __init__(self, path: str, columns: List[str]) -> None:
+        self.extension = dataset_extension(path)
+        self.path = process_path(path, make_dirs=True, file_extension=self.extension)
+        self.columns = columns
+        self.rows = 0
+        self._written = False
+        self._writer = None
+        self._schema = None
+        if self.extension == CSV:
+            open(self.path, 'w').close()
+
+    def write(self, data: pd.DataFrame) -> None:
+        self.rows += data.shape[0]
+        self._written = True
+        if self.extension == CSV:
+            append_dataset(data, self.path)
+            return
+        import pyarrow as pa
+        table = pa.Table.from_pandas(data, schema=self._schema, preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema
+            if self.extension == PARQUET:
+                import pyarrow.parquet as pq
+                self._writer = pq.ParquetWriter(self.path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self.path, self._schema)
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        if not self._written:
+            self.write(pd.DataFrame(columns=self.columns))
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        log.info(f'Saved {self.rows} row(s) to: {self.path}')
+
+    def __enter__(self) -> 'DatasetWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def append_dataset(data: pd.DataFrame, path: str) -> int:
+    """
+    Append data to csv file. Header is written only if file is empty
+
+    :param data: data
+    :param path: path to csv file
+    :return: file size in bytes after append
+    """
+    path = process_path(path, make_dirs=True, file_extension='.csv')
+    header = not os.path.exists(path) or os.path.getsize(path) == 0
+    data.to_csv(path, sep=';', encoding='utf-8', index=False, mode='a', header=header)
+    return os.path.getsize(path)
+
+
+def class_index_path(classes_path: str) -> str:
+    """
+    :return: path to class index file saved by trainer next to classes file in the same format
+    """
+    return os.path.join(os.path.dirname(classes_path), CLASS_INDEX_NAME + os.path.splitext(classes_path)[1])
+
+
 def serialize_dict(file_path: str, dictionary) -> None:
     path = process_path(file_path, make_dirs=True)
     path = os.path.join(path, 'dict.bin')
@@ -62,6 +199,21 @@ def serialize_dict(file_path: str, dictionary) -> None:
         log.info(f'Dictionary saved to: {path}')
 
 
+def serialize_vocabulary(file_path: str, dictionary) -> str:
+    """
+    Save word -> index mapping of fitted tokenizer as memory-mappable vocabulary (directory 'vocab')
+
+    :return: path to vocabulary directory
+    """
+    path = process_path(file_path, make_dirs=True)
+    return Vocabulary.from_tokenizer(dictionary).save(os.path.join(path, 'vocab'))
+
+
+def deserialize_vocabulary(file_path: str) -> Vocabulary:
+    log.info(f'Loading vocabulary from: {file_path}')
+    return Vocabulary.load(process_path(file_path))
+
+
 def deserialize_dict(file_path: str) -> Any:
     log.info(f'Loading dictionary from: {file_path}')
     file_path = process_path(file_path)
@@ -69,9 +221,32 @@ def deserialize_dict(file_path: str) -> Any:
         return pickle.load(handle)
 
 
-def save_model(file_path: str, model) -> None:
+def save_model(file_path: str, model) -> str:
+    """
+    Save Keras model as [model name].h5
+
+    :return: path to saved model
+    """
     file_path = process_path(file_path, make_dirs=True)
     file_path = os.path.join(file_path, model.name + '.h5')
     log.info("Saving model...")
     model.save(file_path, save_format='h5')
     log.info(f'Saved to: {file_path}')
+    return file_path
+
+
+def save_tflite_model(file_path: str, model) -> str:
+    """
+    Convert Keras model to TFLite flatbuffer and save it as [model name].tflite
+
+    :return: path to saved model
+    """
+    import tensorflow as tf
+    file_path = process_path(file_path, make_dirs=True)
+    file_path = os.path.join(file_path, model.name + '.tflite')
+    log.info("Converting model to TFLite...")
+    tflite_model = tf.lite.TFLiteConverter.from_keras_model(model).convert()
+    with open(file_path, 'wb') as handle:
+        handle.write(tflite_model)
+    log.info(f'Saved to: {file_path}')
+    return file_path
@@ -0,0 +1,229 @@
+import json
+import logging
+import threading
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+log = logging.getLogger("inference_backends")
+
+BACKEND_KERAS = "keras"
+BACKEND_TFLITE = "tflite"
+BACKEND_NUMPY = "numpy"
+
+
+class InferenceBackend:
+    """
+    Runs forward pass of a trained model on padded sequences matrix (texts x max_sequence_length)
+    """
+    name = ""
+
+    def __init__(self, input_length: int) -> None:
+        self.input_length = input_length
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        """
+        :param x: padded sequences matrix
+        :return: probabilities matrix (texts x classes)
+        """
+        raise NotImplementedError
+
+    def summary(self, print_fn: Callable[[str], None] = print) -> None:
+        raise NotImplementedError
+
+
+class KerasBackend(InferenceBackend):
+    name = BACKEND_KERAS
+
+    def __init__(self, model) -> None:
+        super().__init__(model.input_shape[1])
+        self.model = model
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        return np.asarray(self.model.predict_on_batch(x))
+
+    def summary(self, print_fn: Callable[[str], None] = print) -> None:
+        self.model.summary(print_fn=print_fn)
+
+
+class TFLiteBackend(InferenceBackend):
+    """
+    Serves model exported by trainer to TFLite flatbuffer with tflite_runtime interpreter.
+    Interpreter is not thread-safe, so calls are serialized
+    """
+    name = BACKEND_TFLITE
+
+    def __init__(self, model_path: str, num_threads: int = None, allow_tensorflow=False) -> None:
+        """
+        :param allow_tensorflow: use interpreter from tensorflow if tflite_runtime is not installed (e.g. in trainer,
+            where tensorflow is already imported). Service does not import tensorflow for TFLite model
+        :raises ImportError: if tflite_runtime is not installed and tensorflow is not allowed
+        """
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            if not allow_tensorflow:
+                raise ImportError("tflite_runtime package is required for TFLite backend")
+            from tensorflow.lite.python.interpreter import Interpreter
+        self.model_path = model_path
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = self._input['shape'][0]
+        self._lock = threading.Lock()
+        super().__init__(int(self._input['shape'][1]))
+        log.info(f'TFLite model loaded from: {model_path}')
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        with self._lock:
+            if x.shape[0] != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input['index'], [x.shape[0], self.input_length])
+                self.interpreter.allocate_tensors()
+                self._batch_size = x.shape[0]
+            self.interpreter.set_tensor(self._input['index'], x.astype(self._input['dtype'], copy=False))
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output['index']).copy()
+
+    def summary(self, print_fn: Callable[[str], None] = print) -> None:
+        print_fn(f'TFLite model: {self.model_path}')
+        for kind, details in [("Input", self._input), ("Output", self._output)]:
+            print_fn(f'{kind}: {details["name"]} {details["shape"].tolist()} {np.dtype(details["dtype"]).name}')
+        print_fn(f'Tensors: {len(self.interpreter.get_tensor_details())}')
+
+
+class NumpyBackend(InferenceBackend):
+    """
+    Runs Sequential model saved by trainer to h5 file with NumPy operations only (no tensorflow import).
+    Supported layers: Embedding, Conv1D (valid padding), GlobalMaxPooling1D, GlobalAveragePooling1D, Dense,
+    Flatten and dropout layers (ignored on inference). Forward pass is stateless, so calls are not serialized
+    """
+    name = BACKEND_NUMPY
+
+    ACTIVATIONS = {
+        "linear": lambda x: x,
+        "relu": lambda x: np.maximum(x, 0, out=x),
+        "tanh": np.tanh,
+        "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+        "softmax": lambda x: _softmax(x),
+    }
+    IGNORED_LAYERS = {"InputLayer", "Dropout", "SpatialDropout1D"}
+
+    def __init__(self, model_path: str) -> None:
+        import h5py
+        self.model_path = model_path
+        with h5py.File(model_path, mode="r") as file:
+            config = file.attrs["model_config"]
+            config = json.loads(config.decode("utf-8") if isinstance(config, bytes) else config)
+            if config["class_name"] != "Sequential":
+                raise NotImplementedError(f'Only Sequential models are supported. Got: {config["class_name"]}')
+            weights = file["model_weights"] if "model_weights" in file else file
+            self.model_name = config["config"].get("name", "")
+            self.layers: List[Tuple[str, dict, List[np.ndarray]]] = []
+            for layer in config["config"]["layers"]:
+                class_name, layer_config = layer["class_name"], layer["config"]
+                if class_name in self.IGNORED_LAYERS:
+                    continue
+                self._check_layer(class_name, layer_config)
+                group = weights[layer_config["name"]]
+                layer_weights = [np.asarray(group[_decode(name)], dtype=np.float32)
+                                 for name in group.attrs["weight_names"]]
+                self.layers.append((class_name, layer_config, layer_weights))
+        if len(self.layers) == 0 or self.layers[0][0] != "Embedding":
+            raise NotImplementedError("The first model layer must be Embedding")
+        embedding_config = self.layers[0][1]
+        input_length = embedding_config.get("input_length") or embedding_config["batch_input_shape"][1]
+        super().__init__(int(input_length))
+        log.info(f'Model {self.model_name} loaded from: {model_path} (NumPy backend)')
+
+    def _check_layer(self, class_name: str, config: dict) -> None:
+        if class_name == "Conv1D":
+            if config["padding"] != "valid" or config["data_format"] != "channels_last":
+                raise NotImplementedError(f'Conv1D layer {config["name"]} must use valid padding and channels_last')
+            if tuple(config["dilation_rate"]) != (1,):
+                raise NotImplementedError(f'Conv1D layer {config["name"]} must not use dilation')
+        elif class_name not in ["Embedding", "Dense", "GlobalMaxPooling1D", "GlobalAveragePooling1D", "Flatten"]:
+            raise NotImplementedError(f'Layer {config["name"]} ({class_name}) is not supported by NumPy backend')
+        if config.get("activation", "linear") not in self.ACTIVATIONS:
+            raise NotImplementedError(f'Activation {config["activation"]} of layer {config["name"]} is not supported')
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        for class_name, config, weights in self.layers:
+            if class_name == "Embedding":
+                x = weights[0][x.astype(np.intp, copy=False)]
+            elif class_name == "Conv1D":
+                x = _conv1d(x, weights[0], config["strides"][0])
+                if config["use_bias"]:
+                    x += weights[1]
+            elif class_name == "Dense":
+                x = x @ weights[0]
+                if config["use_bias"]:
+                    x += weights[1]
+            elif class_name == "GlobalMaxPooling1D":
+                x = x.max(axis=1)
+            elif class_name == "GlobalAveragePooling1D":
+                x = x.mean(axis=1)
+            elif class_name == "Flatten":
+                x = x.reshape(x.shape[0], -1)
+            x = self.ACTIVATIONS[config.get("activation", "linear")](x)
+        return x
+
+    def summary(self, print_fn: Callable[[str], None] = print) -> None:
+        print_fn(f'NumPy model: {self.model_name} ({self.model_path})')
+        for class_name, config, weights in self.layers:
+            print_fn(f'{config["name"]} ({class_name}): {[list(w.shape) for w in weights]}')
+        print_fn(f'Total params: {sum(w.size for _, _, weights in self.layers for w in weights)}')
+
+
+def _decode(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _softmax(x: np.ndarray) -> np.ndarray:
+    x = np.exp(x - x.max(axis=-1, keepdims=True))
+    return x / x.sum(axis=-1, keepdims=True)
+
+
+def _conv1d(x: np.ndarray, kernel: np.ndarray, stride: int) -> np.ndarray:
+    """
+    1D convolution with valid padding over strided view of windows (no data copy before matrix product)
+
+    :param x: batch (samples x steps x channels)
+    :param kernel: (kernel size x channels x filters)
+    :return: (samples x output steps x filters)
+    """
+    kernel_size = kernel.shape[0]
+    x = np.ascontiguousarray(x)
+    samples, steps, channels = x.shape
+    output_steps = (steps - kernel_size) // stride + 1
+    if output_steps <= 0:
+        raise ValueError(f'Input length {steps} is less than kernel size {kernel_size}')
+    windows = np.lib.stride_tricks.as_strided(
+        x, shape=(samples, output_steps, kernel_size, channels),
+        strides=(x.strides[0], x.strides[1] * stride, x.strides[1], x.strides[2]), writeable=False)
+    return np.tensordot(windows, kernel, axes=([2, 3], [0, 1]))
+
+
+def check_backend_parity(reference: InferenceBackend, candidate: InferenceBackend, x: np.ndarray,
+                         tolerance=1e-4) -> float:
+    """
+    Compare predictions of two backends on the same input
+
+    :param reference: backend with expected predictions
+    :param candidate: checked backend
+    :param x: padded sequences matrix
+    :param tolerance: maximum allowed absolute difference of probabilities
+    :return: maximum absolute difference
+    :raises ValueError: if predictions differ more than tolerance
+    """
+    expected = reference.predict(x)
+    actual = candidate.predict(x)
+    if expected.shape != actual.shape:
+        raise ValueError(f'Different shapes! {reference.name}: {expected.shape}, {candidate.name}: {actual.shape}')
+    difference = float(np.max(np.abs(expected - actual))) if expected.size > 0 else 0.0
+    log.info(f'Backends parity {reference.name}/{candidate.name} on {x.shape[0]} sample(s): '
+             f'max difference {difference}')
+    if difference > tolerance:
+        raise ValueError(f'Predictions of {candidate.name} differ from {reference.name} by {difference} '
+                         f'(tolerance {tolerance})')
+    return difference
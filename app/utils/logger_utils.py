@@ -1,15 +1,47 @@
+import json
 import logging
 import os
+import queue
+import random
 import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, List
 
 FORMATTER = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Handlers installed by init_logging and background writer of async logging
+_handlers: List[logging.Handler] = []
+_listener: QueueListener = None
 
 
-def init_logging(file_name: str) -> None:
-    """ Initialize logging settings
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records to bounded queue without blocking. Records are dropped (and counted) if queue is full.
+    Records are passed as is: message is formatted by the writer thread
+    """
+
+    def __init__(self, records_queue: queue.Queue) -> None:
+        super().__init__(records_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def init_logging(file_name: str, use_queue=False, queue_size=10000) -> None:
+    """ Initialize logging settings. Handlers of the previous call are removed
 
     :param file_name: logfile name
+    :param use_queue: write records to file and console by background thread
+    :param queue_size: max number of records waiting for background thread. New records are dropped if queue is full
     """
+    global _handlers, _listener
+    stop_logging()
     if file_name[:1] == "\\":
         file_name = file_name[1:]
     if file_name[-4:] != ".log":
@@ -30,8 +62,73 @@ def init_logging(file_name: str) -> None:
 
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
+    if use_queue:
+        queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+        _listener = QueueListener(queue_handler.queue, stream_handler, file_handler, respect_handler_level=True)
+        _listener.start()
+        _handlers = [queue_handler]
+    else:
+        _handlers = [stream_handler, file_handler]
+    for handler in _handlers:
+        logger.addHandler(handler)
+
+
+def stop_logging() -> None:
+    """
+    Write records waiting in queue (if async logging is used) and remove handlers installed by init_logging
+    """
+    global _handlers, _listener
+    logger = logging.getLogger()
+    dropped = 0
+    for handler in _handlers:
+        logger.removeHandler(handler)
+        dropped += getattr(handler, 'dropped', 0)
+        handler.close()
+    _handlers = []
+    if _listener is not None:
+        _listener.stop()
+        # Writer thread is stopped: warning about dropped records is written by its handlers directly
+        handlers, _listener = list(_listener.handlers), None
+        for handler in handlers:
+            logger.addHandler(handler)
+        if dropped > 0:
+            logger.warning(f'Dropped {dropped} log record(s) because logging queue was full')
+        for handler in handlers:
+            logger.removeHandler(handler)
+            handler.close()
+
+
+def after_fork() -> None:
+    """
+    Start background writer of async logging in forked process (fork copies no threads).
+    Records queued by parent process before fork are written by the parent
+    """
+    if _listener is None:
+        return
+    records_queue = queue.Queue(maxsize=_listener.queue.maxsize)
+    for handler in _handlers:
+        handler.queue = records_queue
+    _listener.queue = records_queue
+    _listener.start()
+
+
+class PayloadSampler:
+    """
+    Selects requests with logged payloads (each with probability sample_rate) and truncates logged payloads
+    """
+
+    def __init__(self, sample_rate=1.0, max_length=1000) -> None:
+        self.sample_rate = sample_rate
+        self.max_length = max_length
+
+    def sample(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def truncate(self, payload: Any) -> str:
+        text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+        if 0 < self.max_length < len(text):
+            return f'{text[:self.max_length]}... ({len(text)} chars)'
+        return text
 
 
 def profile(fn):
@@ -0,0 +1,217 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Seconds: 1 us .. 10 s
+DEFAULT_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def samples(self, name: str, labels: dict) -> List[Tuple[str, dict, float]]:
+        return [(name, labels, self.value)]
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets (upper bounds) and their sum.
+    Quantiles are estimated by linear interpolation inside bucket
+    """
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = sorted(buckets)
+        # The last count is for values above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        counts, count = list(self.counts), sum(self.counts)
+        if count == 0:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count > 0:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def samples(self, name: str, labels: dict) -> List[Tuple[str, dict, float]]:
+        samples = []
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets + [float("inf")], list(self.counts)):
+            cumulative += bucket_count
+            samples.append((name + "_bucket", {**labels, "le": _format_value(bucket)}, cumulative))
+        samples.append((name + "_sum", labels, self.sum))
+        samples.append((name + "_count", labels, cumulative))
+        return samples
+
+
+class StageTimer:
+    """
+    Times consecutive stages of one call: lap(stage) observes time since the previous lap (or start)
+    """
+
+    def __init__(self, histograms: Dict[str, Histogram]) -> None:
+        self.histograms = histograms
+        self.last = time.perf_counter()
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.histograms[stage].observe(now - self.last)
+        self.last = now
+
+
+class _NullTimer:
+    def lap(self, stage: str) -> None:
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class MetricsRegistry:
+    """
+    Metrics by name and labels. Metrics are created on the first use and updated only if registry is enabled,
+    so instrumented code costs one attribute check when metrics are not used.
+    Updates of counters and histograms are not locked (lock would double the cost of update). Under GIL an update
+    is lost only if threads are switched in the middle of it, which is rare enough for monitoring
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        # name -> (type, documentation, {labels: metric})
+        self._metrics: Dict[str, Tuple[str, str, dict]] = {}
+        # name -> (type, documentation, function returning [(labels, value)])
+        self._callbacks: Dict[str, Tuple[str, str, Callable[[], List[Tuple[dict, float]]]]] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, **labels: str) -> Counter:
+        return self._get(name, COUNTER, documentation, labels, Counter)
+
+    def histogram(self, name: str, documentation: str, buckets: Iterable[float] = DEFAULT_BUCKETS,
+                  **labels: str) -> Histogram:
+        return self._get(name, HISTOGRAM, documentation, labels, lambda: Histogram(buckets))
+
+    def callback(self, name: str, metric_type: str, documentation: str,
+                 function: Callable[[], List[Tuple[dict, float]]]) -> None:
+        """
+        Metric read at export time, e.g. counters of cache: function returns (labels, value) pairs
+        """
+        with self._lock:
+            self._callbacks[name] = (metric_type, documentation, function)
+
+    def stages(self, name: str, documentation: str, stages: Iterable[str]) -> 'Stages':
+        return Stages(self, name, documentation, stages)
+
+    def _get(self, name: str, metric_type: str, documentation: str, labels: dict, factory: Callable):
+        key = tuple(sorted(labels.items()))
+        metric = self._metrics.get(name, (None, None, {}))[2].get(key)
+        if metric is not None:
+            return metric
+        with self._lock:
+            _, _, children = self._metrics.setdefault(name, (metric_type, documentation, {}))
+            return children.setdefault(key, factory())
+
+    def export(self) -> str:
+        """
+        Metrics in Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            metrics = [(name, metric_type, documentation, list(children.items()))
+                       for name, (metric_type, documentation, children) in self._metrics.items()]
+            callbacks = list(self._callbacks.items())
+        for name, metric_type, documentation, children in metrics:
+            lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}']
+            for key, metric in children:
+                lines += [_format_sample(*sample) for sample in metric.samples(name, dict(key))]
+        for name, (metric_type, documentation, function) in callbacks:
+            lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}']
+            lines += [_format_sample(name, labels, value) for labels, value in function()]
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """
+        Counters, histogram statistics (count, sum, p50, p95, p99) and values of callback metrics
+        as json serializable dict
+        """
+        result = {}
+        with self._lock:
+            metrics = [(name, list(children.items())) for name, (_, _, children) in self._metrics.items()]
+            callbacks = [(name, function) for name, (_, _, function) in self._callbacks.items()]
+        for name, children in metrics:
+            result[name] = []
+            for key, metric in children:
+                if isinstance(metric, Histogram):
+                    values = {"count": metric.count, "sum": metric.sum,
+                              **{f'p{int(q * 100)}': metric.quantile(q) for q in (0.5, 0.95, 0.99)}}
+                else:
+                    values = {"value": metric.value}
+                result[name].append({"labels": dict(key), **values})
+        for name, function in callbacks:
+            result[name] = [{"labels": dict(labels), "value": value} for labels, value in function()]
+        return result
+
+
+class Stages:
+    """
+    Histograms of consecutive stages of one operation: one metric with 'stage' label
+    """
+
+    def __init__(self, registry: MetricsRegistry, name: str, documentation: str, stages: Iterable[str]) -> None:
+        self.registry = registry
+        self.histograms = {stage: registry.histogram(name, documentation, stage=stage) for stage in stages}
+
+    def start(self):
+        """
+        :return: StageTimer started now or timer that does nothing if metrics are disabled
+        """
+        if not self.registry.enabled:
+            return NULL_TIMER
+        return StageTimer(self.histograms)
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value)
+
+
+def _format_sample(name: str, labels: dict, value: float) -> str:
+    if len(labels) == 0:
+        return f'{name} {_format_value(value)}'
+    label_text = ",".join(f'{key}="{_escape(str(label))}"' for key, label in labels.items())
+    return f'{name}{{{label_text}}} {_format_value(value)}'
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# Metrics of the process
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,35 @@
+from typing import Iterable, List, Union, TYPE_CHECKING
+
+import numpy as np
+
+from utils.vocabulary import Vocabulary
+
+if TYPE_CHECKING:
+    from tensorflow.keras.preprocessing.text import Tokenizer
+
+
+def pad_sequences(sequences: List[List[int]], max_sequence_length: int) -> np.ndarray:
+    """
+    Padded sequences matrix (sequences x max_sequence_length), the same as Keras pad_sequences
+    with padding='post' and truncating='post'
+
+    :param sequences: word indices of texts
+    :param max_sequence_length: sequence length
+    """
+    result = np.zeros((len(sequences), max_sequence_length), dtype=np.int32)
+    for row, sequence in enumerate(sequences):
+        sequence = sequence[:max_sequence_length]
+        result[row, :len(sequence)] = sequence
+    return result
+
+
+def prep_bag_of_words(text_data: Iterable[str], tokenizer: Union['Tokenizer', Vocabulary],
+                      max_sequence_length: int) -> np.ndarray:
+    """
+    Turns texts into padded sequences
+
+    :param tokenizer: fitted Keras Tokenizer or Vocabulary
+    """
+    if isinstance(tokenizer, Vocabulary):
+        return tokenizer.encode(text_data, max_sequence_length)
+    return pad_sequences(tokenizer.texts_to_sequences(text_data), max_sequence_length)
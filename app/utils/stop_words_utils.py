@@ -1,6 +1,6 @@
 import logging
 import os
-from pathlib import WindowsPath
+from pathlib import Path
 
 import pandas as pd
 from flashtext import KeywordProcessor
@@ -52,8 +52,8 @@ class StopWordsCleaner:
         in '\\resources\\stop_words' path.
         Prepares for flash text (adding clean name '_EMPTY_')
         """
-        file_path = WindowsPath(os.path.dirname(os.path.abspath(__file__)))
-        file_path = str(file_path.parent.parent) + "\\resources\\stop_words\\"
+        file_path = Path(os.path.dirname(os.path.abspath(__file__)))
+        file_path = str(file_path.parent.parent / "resources" / "stop_words")
         if not os.path.exists(file_path):
             raise FileNotFoundError("Folder {} does not exist".format(file_path))
         if self.load_uk:
@@ -105,8 +105,8 @@ class StopWordsCleaner:
             self.custom_stop_words = self.custom_stop_words.reindex((-self.custom_stop_words['keywords'].str.len())
                                                                     .argsort()).reset_index(drop=True)
 
-            for index, row in self.custom_stop_words.iterrows():
-                self.processor.add_keyword(row['keywords'], row['clean_name'])
+            for keyword, clean_name in zip(self.custom_stop_words['keywords'], self.custom_stop_words['clean_name']):
+                self.processor.add_keyword(keyword, clean_name)
 
     def clean(self, text: str) -> str:
         if not self.custom_stop_words.empty:
@@ -1,23 +1,45 @@
+import itertools
 import logging
 import re
+from typing import Iterable, Optional
 
 import bs4
 from flashtext import KeywordProcessor
-from tensorflow.keras.preprocessing.text import text_to_word_sequence
 
 from preprocessor import language_detector as lang
-from settings import PreprocessorSetting
+from settings import PreprocessorSetting, WordLemmatizationSetting
+from utils import metrics
+from utils.cache_utils import LRUCache
+from utils.file_utils import deserialize_dict
 
 log = logging.getLogger("text_utils")
 TOKEN_FILTER = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n' + '’«»'
+# Replaces TOKEN_FILTER characters with spaces, as Keras text_to_word_sequence does
+TOKEN_TABLE = str.maketrans({c: " " for c in TOKEN_FILTER})
+DEFAULT_LEMMA_CACHE_SIZE = 100000
+# (word, russian, ukrainian) -> lemma
+LEMMA_CACHE = LRUCache(max_size=DEFAULT_LEMMA_CACHE_SIZE)
+_MISSING = object()
+CLEANING_STAGES = metrics.REGISTRY.stages("text_cleaning_stage_seconds", "Time of text cleaning stages, seconds",
+                                          ["signature", "html", "regex", "stop_words", "tokenize", "filter",
+                                           "lemmatize"])
 
 
 def lemmatize(word: str, russian=False, ukrainian=False):
+    key = (word, bool(russian), bool(ukrainian))
+    lemma = LEMMA_CACHE.get(key, _MISSING)
+    if lemma is _MISSING:
+        lemma = _lemmatize(word, russian, ukrainian)
+        LEMMA_CACHE.put(key, lemma)
+    return lemma
+
+
+def _lemmatize(word: str, russian=False, ukrainian=False):
     language = lang.detect_language(word)
     if language == "ru" and russian:
-        p = lang.morph_ru.parse(word)[0]
+        p = lang.get_morph_analyzer("ru").parse(word)[0]
     elif language == "uk" and ukrainian:
-        p = lang.morph_uk.parse(word)[0]
+        p = lang.get_morph_analyzer("uk").parse(word)[0]
     else:
         return word
     if ((str(p.tag) == 'LATN') | ((str(p.tag) != 'UNKN') & (
@@ -27,10 +49,128 @@ def lemmatize(word: str, russian=False, ukrainian=False):
         return ""
 
 
+def warm_up_lemma_cache(words: Iterable[str], russian=False, ukrainian=False) -> int:
+    """
+    Fill lemma cache with words (e.g. vocabulary sorted by frequency).
+    Only first 'max_size' words are used. Hit/miss counters are reset after warm up
+
+    :param words: words to lemmatize
+    :param russian: lemmatize russian words
+    :param ukrainian: lemmatize ukrainian words
+    :return: number of lemmatized words
+    """
+    count = 0
+    for word in itertools.islice(words, LEMMA_CACHE.max_size):
+        lemmatize(word, russian, ukrainian)
+        count += 1
+    LEMMA_CACHE.reset_stats()
+    log.info(f'Lemma cache warmed up with {count} word(s)')
+    return count
+
+
+def init_lemma_cache(setting: WordLemmatizationSetting) -> None:
+    """
+    Resize lemma cache and warm it up with the training vocabulary if 'cache_warm_up_dict_path' is set
+
+    :param setting: words lemmatization setting
+    """
+    LEMMA_CACHE.resize(setting.cache_size)
+    log.info(f'Lemma cache size: {setting.cache_size}')
+    if setting.cache_size > 0 and setting.cache_warm_up_dict_path != "":
+        words_dict = deserialize_dict(setting.cache_warm_up_dict_path)
+        # word_index is ordered by word frequency
+        warm_up_lemma_cache(words_dict.word_index.keys(), setting.russian, setting.ukrainian)
+
+
 def clean_html_tags(text: str) -> str:
+    """
+    Extract text from html. Plain text is returned as is, simple markup (tags without raw text content,
+    known entities) is stripped with regex. Other documents are parsed by BeautifulSoup.
+    Output is the same as BeautifulSoup get_text with ' ' separator
+    """
+    if isinstance(text, str):
+        if '<' not in text and '&' not in text:
+            return _collapse_spaces(text)
+        stripped = strip_simple_html(text)
+        if stripped is not None:
+            return stripped
+    return clean_html_tags_bs4(text)
+
+
+def clean_html_tags_bs4(text: str) -> str:
     return bs4.BeautifulSoup(text, "html.parser").get_text(separator=' ')
 
 
+_HTML_TAG_PATTERN = re.compile(r'<(?:([a-zA-Z][a-zA-Z0-9:_.-]*)'
+                               r'(?:\s+[^\s"\'<>/=]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'=<>`]+))?)*\s*/?'
+                               r'|/[a-zA-Z][a-zA-Z0-9:_.-]*\s*)>')
+_HTML_ENTITY_PATTERN = re.compile(r'&(?:#([0-9]{1,7})|#[xX]([0-9a-fA-F]{1,6})|([a-zA-Z][a-zA-Z0-9]*));|&[a-zA-Z#]')
+# Entities with the same meaning for all parser versions
+_HTML_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'nbsp': '\xa0', 'laquo': '«', 'raquo': '»',
+                  'ndash': '–', 'mdash': '—', 'hellip': '…', 'copy': '©', 'reg': '®', 'trade': '™'}
+# Elements with raw text content, which is parsed differently by parser versions, and elements preserving whitespace
+_HTML_UNSUPPORTED_TAGS = {'script', 'style', 'textarea', 'title', 'xmp', 'iframe', 'noembed', 'noframes', 'noscript',
+                          'plaintext', 'pre'}
+_HTML_SPACES = ' \n\t\f\r'
+
+
+class _UnsupportedHtml(Exception):
+    pass
+
+
+def _replace_html_entity(match) -> str:
+    decimal, hexadecimal, name = match.groups()
+    if name is not None:
+        if name in _HTML_ENTITIES:
+            return _HTML_ENTITIES[name]
+    elif decimal is not None or hexadecimal is not None:
+        code = int(decimal) if decimal is not None else int(hexadecimal, 16)
+        # Codes 128-159 are decoded as windows-1252 by BeautifulSoup
+        if 0 < code < 128 or 160 <= code < 0xD800 or 0xE000 <= code <= 0x10FFFF:
+            return chr(code)
+    raise _UnsupportedHtml()
+
+
+def strip_simple_html(text: str) -> Optional[str]:
+    """
+    Strip tags and replace entities with regex in one pass over text.
+    Text between tags is joined with ' ' like text nodes by BeautifulSoup get_text
+
+    :return: text without markup or None if html is not simple (comments, doctype, raw text elements,
+             unknown entities, '<' not starting a valid tag)
+    """
+    parts = []
+    position = 0
+    try:
+        for match in _HTML_TAG_PATTERN.finditer(text):
+            tag = match.group(1)
+            if tag is not None and tag.lower() in _HTML_UNSUPPORTED_TAGS:
+                return None
+            if match.start() > position:
+                parts.append(_unescape_text(text[position:match.start()]))
+            position = match.end()
+        if position < len(text):
+            parts.append(_unescape_text(text[position:]))
+    except _UnsupportedHtml:
+        return None
+    return ' '.join(parts)
+
+
+def _unescape_text(text: str) -> str:
+    if '<' in text:
+        raise _UnsupportedHtml()
+    if '&' in text:
+        text = _HTML_ENTITY_PATTERN.sub(_replace_html_entity, text)
+    return _collapse_spaces(text)
+
+
+def _collapse_spaces(text: str) -> str:
+    # BeautifulSoup replaces text node of ascii whitespace with one space or new line
+    if len(text) > 0 and text.strip(_HTML_SPACES) == "":
+        return '\n' if '\n' in text else ' '
+    return text
+
+
 def clean_url(text: str) -> str:
     return re.sub(r'(http|www)\S+', ' ', str(text))
 
@@ -75,6 +215,116 @@ def clean_text_with_setting(text: str, setting: PreprocessorSetting, custom_stop
                       min_words_count=setting.min_words_count)
 
 
+class TextNormalizer:
+    """
+    Compiled version of clean_text for repeated calls with the same parameters.
+    All patterns, tables and filters are prepared once, digits are removed together with tokenization filters
+    in one str.translate pass, stop words and length filters are applied in one pass over tokens.
+    Output is the same as clean_text with the same parameters
+    """
+    _EMAIL_PATTERN = re.compile(r'[a-z0-9.\-+_]+@[a-z0-9.\-+_]+\.[a-z]+')
+    _URL_PATTERN = re.compile(r'(http|www)\S+')
+    _FORMATTING_PATTERN = re.compile(r'^\s+|\n|\r|\s+$')
+    _DIGITS = str.maketrans('', '', '0123456789')
+
+    def __init__(self, email_signatures="", clean_html=False, clean_email_address=False, clean_urls=False,
+                 clean_numbers=True, custom_stop_words: KeywordProcessor = None, default_stop_words: set = None,
+                 min_word_len=0, max_word_len=0, lemmatize_russian=False, lemmatize_ukrainian=False,
+                 min_words_count=0) -> None:
+        self.signatures = []
+        if email_signatures != "":
+            signatures = list(email_signatures)
+            if len(signatures) > 0 and signatures[-1].lstrip().rstrip() == "":
+                signatures.pop()
+            self.signatures = [signature.lower() for signature in signatures]
+        self.clean_html = clean_html
+        self.clean_email_address = clean_email_address
+        self.clean_urls = clean_urls
+        if custom_stop_words is not None and len(custom_stop_words) == 0:
+            custom_stop_words = None
+        self.custom_stop_words = custom_stop_words
+        self.default_stop_words = default_stop_words if default_stop_words is not None else set()
+        self.min_word_len = int(min_word_len) if min_word_len > 0 else 0
+        self.max_word_len = int(max_word_len) if max_word_len > 0 else 0
+        self.lemmatize_russian = lemmatize_russian
+        self.lemmatize_ukrainian = lemmatize_ukrainian
+        self.min_words_count = int(min_words_count)
+        token_table = {c: " " for c in TOKEN_FILTER}
+        self._token_table = TOKEN_TABLE
+        if clean_numbers:
+            token_table.update({c: None for c in '0123456789'})
+        # Without custom stop words digits are removed in the tokenization pass
+        self._digits_token_table = str.maketrans(token_table)
+        self.clean_numbers = clean_numbers
+
+    @classmethod
+    def from_setting(cls, setting: PreprocessorSetting, custom_stop_words: KeywordProcessor,
+                     default_stop_words: set) -> 'TextNormalizer':
+        return cls(email_signatures=setting.email_setting.signatures,
+                   clean_html=setting.clean_html, clean_email_address=setting.email_setting.clean_address,
+                   clean_urls=setting.clean_urls, custom_stop_words=custom_stop_words,
+                   default_stop_words=default_stop_words, min_word_len=setting.min_word_len,
+                   max_word_len=setting.max_word_len, lemmatize_russian=setting.words_lemmatization_setting.russian,
+                   lemmatize_ukrainian=setting.words_lemmatization_setting.ukrainian,
+                   min_words_count=setting.min_words_count)
+
+    def __call__(self, text: str) -> str:
+        return self.normalize(text)
+
+    def normalize(self, text: str) -> str:
+        """
+        :return: cleaned text
+        """
+        tokens = self.tokenize(text)
+        if len(tokens) < self.min_words_count:
+            return ""
+        return " ".join([token for token in tokens if token]).strip()
+
+    def tokenize(self, text: str) -> list:
+        """
+        :return: filtered (and lemmatized) tokens. Lemmatized tokens may be empty
+        """
+        timer = CLEANING_STAGES.start()
+        for signature in self.signatures:
+            if text.find(signature) != -1:
+                text = text.split(signature, 1)[0]
+                break
+        timer.lap("signature")
+        if self.clean_html:
+            text = clean_html_tags(text)
+            timer.lap("html")
+        if self.clean_email_address:
+            text = self._EMAIL_PATTERN.sub(' ', str(text))
+        if self.clean_urls:
+            text = self._URL_PATTERN.sub(' ', str(text))
+        text = self._FORMATTING_PATTERN.sub(' ', str(text))
+        timer.lap("regex")
+        if self.custom_stop_words is not None:
+            if self.clean_numbers:
+                text = text.translate(self._DIGITS)
+            text = self.custom_stop_words.replace_keywords(text.lower()).replace("_EMPTY_", "").strip()
+            timer.lap("stop_words")
+            tokens = text.lower().translate(self._token_table).split(" ")
+        else:
+            tokens = text.lower().translate(self._digits_token_table).split(" ")
+        timer.lap("tokenize")
+
+        stop_words = self.default_stop_words
+        min_len = self.min_word_len
+        max_len = self.max_word_len
+        # No upper bound if max_word_len is 0 (length of text is not one: lower case text may be longer)
+        if max_len > 0:
+            tokens = [token for token in tokens
+                      if token and min_len <= len(token) <= max_len and token not in stop_words]
+        else:
+            tokens = [token for token in tokens if token and min_len <= len(token) and token not in stop_words]
+        timer.lap("filter")
+        if self.lemmatize_russian or self.lemmatize_ukrainian:
+            tokens = [lemmatize(token, self.lemmatize_russian, self.lemmatize_ukrainian) for token in tokens]
+            timer.lap("lemmatize")
+        return tokens
+
+
 def clean_text(text: str, email_signatures="", clean_html=False, clean_email_address=False, clean_urls=False,
                clean_numbers=True, custom_stop_words=None, default_stop_words=None, min_word_len=0, max_word_len=0,
                lemmatize_russian=False, lemmatize_ukrainian=False,
@@ -84,12 +334,15 @@ def clean_text(text: str, email_signatures="", clean_html=False, clean_email_add
 
     :return: cleaned text
     """
+    timer = CLEANING_STAGES.start()
     if default_stop_words is None:
         default_stop_words = set()
     if email_signatures != "":
         text = clean_email_signature(text, list(email_signatures))
+    timer.lap("signature")
     if clean_html:
         text = clean_html_tags(text)
+        timer.lap("html")
     if clean_email_address:
         text = clean_email_addresses(text)
     if clean_urls:
@@ -98,6 +351,7 @@ def clean_text(text: str, email_signatures="", clean_html=False, clean_email_add
     text = clean_formatting(text)
     if clean_numbers:
         text = clean_all_numbers(text)
+    timer.lap("regex")
 
     # Проблемні знаки для токенізатора
     # text = text.replace("’", "'").replace('"', "").replace("«", "").replace("»", "").replace("''", "")
@@ -105,9 +359,11 @@ def clean_text(text: str, email_signatures="", clean_html=False, clean_email_add
     # Очищення стоп слів зі списку stop_words
     if custom_stop_words is not None and len(custom_stop_words) > 0:
         text = clean_custom_stop_words(text, custom_stop_words)
+        timer.lap("stop_words")
 
     # Токенізація
-    tokens = text_to_word_sequence(text, filters=TOKEN_FILTER)
+    tokens = [token for token in text.lower().translate(TOKEN_TABLE).split(" ") if token]
+    timer.lap("tokenize")
     # Видалення стандартних стоп слів
     if len(default_stop_words) > 0:
         tokens = clean_default_stop_words(tokens, default_stop_words)
@@ -117,9 +373,11 @@ def clean_text(text: str, email_signatures="", clean_html=False, clean_email_add
     # Видалення слів > максимальної кількості символів
     if max_word_len > 0:
         tokens = [i for i in tokens if (len(i) <= int(max_word_len))]
+    timer.lap("filter")
     # Лексикологічна нормалізація слів
     if lemmatize_russian or lemmatize_ukrainian:
         tokens = [lemmatize(i, lemmatize_russian, lemmatize_ukrainian) for i in tokens]
+        timer.lap("lemmatize")
 
     # Очистити по мінімальній кількості слів
     if len(tokens) < int(min_words_count):
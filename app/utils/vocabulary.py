@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+from typing import Iterable, List
+
+import numpy as np
+
+log = logging.getLogger("vocabulary")
+
+WORDS_FILE = "words.npy"
+INDICES_FILE = "indices.npy"
+META_FILE = "vocab.json"
+
+
+class Vocabulary:
+    """
+    Word -> index mapping of trained dictionary stored as sorted table of utf-8 words (fixed width bytes)
+    and table of their indices. Tables are saved as .npy files and memory-mapped on load,
+    so processes sharing the same files share the pages.
+    Encoding gives the same sequences as Keras Tokenizer.texts_to_sequences of the source tokenizer
+    """
+
+    def __init__(self, words: np.ndarray, indices: np.ndarray, num_words: int = None, filters="", lower=True,
+                 split=" ", oov_index: int = None) -> None:
+        if words.shape != indices.shape:
+            raise ValueError(f'Different shapes! Words: {words.shape}, indices: {indices.shape}')
+        self.words = words
+        self.indices = indices
+        self.num_words = num_words
+        self.filters = filters
+        self.lower = lower
+        self.split = split
+        self.oov_index = oov_index
+        self._translate_map = str.maketrans({c: split for c in filters})
+
+    def __len__(self) -> int:
+        return self.words.shape[0]
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer) -> 'Vocabulary':
+        """
+        :param tokenizer: fitted Keras Tokenizer
+        """
+        num_words = tokenizer.num_words
+        word_index = tokenizer.word_index
+        oov_index = word_index.get(tokenizer.oov_token) if tokenizer.oov_token is not None else None
+        # Words with index >= num_words are skipped (or replaced with oov) by Tokenizer, so they are not stored
+        items = [(word.encode("utf-8"), index) for word, index in word_index.items()
+                 if not num_words or index < num_words]
+        items.sort()
+        words = np.array([word for word, _ in items], dtype=bytes)
+        indices = np.array([index for _, index in items], dtype=np.int32)
+        return cls(words, indices, num_words=num_words, filters=tokenizer.filters, lower=tokenizer.lower,
+                   split=tokenizer.split, oov_index=oov_index)
+
+    def save(self, path: str) -> str:
+        """
+        Save vocabulary files to directory
+
+        :return: path to directory
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, WORDS_FILE), self.words)
+        np.save(os.path.join(path, INDICES_FILE), self.indices)
+        meta = {"num_words": self.num_words, "filters": self.filters, "lower": self.lower, "split": self.split,
+                "oov_index": self.oov_index}
+        with open(os.path.join(path, META_FILE), "w", encoding="utf-8") as file:
+            json.dump(meta, file, ensure_ascii=False)
+        log.info(f'Vocabulary ({len(self)} words) saved to: {path}')
+        return path
+
+    @classmethod
+    def load(cls, path: str, mmap=True) -> 'Vocabulary':
+        """
+        :param path: directory with vocabulary files
+        :param mmap: memory-map tables instead of reading them
+        """
+        mmap_mode = "r" if mmap else None
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        words = np.load(os.path.join(path, WORDS_FILE), mmap_mode=mmap_mode)
+        indices = np.load(os.path.join(path, INDICES_FILE), mmap_mode=mmap_mode)
+        return cls(words, indices, **meta)
+
+    @staticmethod
+    def files(path: str) -> List[str]:
+        return [os.path.join(path, name) for name in [META_FILE, WORDS_FILE, INDICES_FILE]]
+
+    def tokenize(self, text: str) -> List[str]:
+        if self.lower:
+            text = text.lower()
+        return [token for token in text.translate(self._translate_map).split(self.split) if token]
+
+    def lookup(self, tokens: List[str]) -> np.ndarray:
+        """
+        :return: index of every token, 0 for unknown tokens (or oov index if tokenizer used oov token)
+        """
+        if len(tokens) == 0 or len(self) == 0:
+            return np.full(len(tokens), self.oov_index or 0, dtype=np.int32)
+        tokens = np.array([token.encode("utf-8") for token in tokens], dtype=bytes)
+        positions = np.searchsorted(self.words, tokens)
+        np.minimum(positions, len(self) - 1, out=positions)
+        found = self.words[positions] == tokens
+        return np.where(found, self.indices[positions], self.oov_index or 0).astype(np.int32, copy=False)
+
+    def texts_to_sequences(self, texts: Iterable[str]) -> List[List[int]]:
+        sequences = []
+        for text in texts:
+            indices = self.lookup(self.tokenize(text))
+            sequences.append(indices[indices > 0].tolist())
+        return sequences
+
+    def encode(self, texts: Iterable[str], max_sequence_length: int) -> np.ndarray:
+        """
+        Encode texts to padded sequences matrix (texts x max_sequence_length).
+        Unknown words are skipped, sequences are padded with zeros and truncated at the end
+
+        :param texts: preprocessed texts
+        :param max_sequence_length: sequence length
+        """
+        tokens = []
+        lengths = []
+        for text in texts:
+            text_tokens = self.tokenize(text)
+            tokens.extend(text_tokens)
+            lengths.append(len(text_tokens))
+        result = np.zeros((len(lengths), max_sequence_length), dtype=np.int32)
+        if len(tokens) == 0:
+            return result
+        indices = self.lookup(tokens)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        known = indices > 0
+        indices, rows = indices[known], rows[known]
+        # Position of every known word in its text
+        counts = np.bincount(rows, minlength=len(lengths))
+        positions = np.arange(indices.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+        kept = positions < max_sequence_length
+        result[rows[kept], positions[kept]] = indices[kept]
+        return result
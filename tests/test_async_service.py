@@ -0,0 +1,99 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+ROOT_PATH = Path(os.path.dirname(os.path.abspath(__file__))).parent
+sys.path.append(str(ROOT_PATH / "app"))
+sys.path.append(str(ROOT_PATH / "app" / "service"))
+
+from async_service import AsyncPredictionService, REQUEST_TIMEOUT_HEADER
+from serving_model import ModelRegistry, ServingModel
+from settings import ServiceSetting
+
+
+def service_setting(request_timeout_ms: int) -> ServiceSetting:
+    with open(ROOT_PATH / "resources" / "templates" / "service_config.json", encoding="utf-8") as file:
+        setting = json.load(file)
+    setting["async_service_setting"]["request_timeout_ms"] = request_timeout_ms
+    setting["async_service_setting"]["executor_workers"] = 1
+    return ServiceSetting(**setting)
+
+
+def request(timeout_ms: str = None) -> web.Request:
+    return make_mocked_request('POST', '/predict', headers={REQUEST_TIMEOUT_HEADER: timeout_ms} if timeout_ms else {})
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def timeout(self, service: AsyncPredictionService, timeout_ms: str = None) -> float:
+        deadline = service.deadline(request(timeout_ms))
+        return None if deadline is None else round((deadline - time.monotonic()) * 1000, -2)
+
+    def test_header_shortens_deadline(self) -> None:
+        service = AsyncPredictionService(service_setting(2000))
+        self.assertEqual(self.timeout(service), 2000)
+        self.assertEqual(self.timeout(service, "500"), 500)
+        # Setting is the upper bound
+        self.assertEqual(self.timeout(service, "5000"), 2000)
+
+    def test_header_without_setting_timeout(self) -> None:
+        service = AsyncPredictionService(service_setting(0))
+        self.assertIsNone(self.timeout(service))
+        self.assertEqual(self.timeout(service, "500"), 500)
+
+    def test_invalid_header_is_rejected(self) -> None:
+        # Header that would remove the deadline is a bad request
+        for setting_timeout in [2000, 0]:
+            service = AsyncPredictionService(service_setting(setting_timeout))
+            for header in ["0", "-5", "nan", "inf", "-inf", "soon"]:
+                with self.assertRaises(web.HTTPBadRequest, msg=header):
+                    service.deadline(request(header))
+
+
+class EvictingRegistry(ModelRegistry):
+    """
+    Registry that unloads model right after its first load, as LRU eviction by a concurrent request
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.evictions = 1
+
+    def ensure_loaded(self, name: str) -> None:
+        super().ensure_loaded(name)
+        if self.evictions > 0:
+            self.evictions -= 1
+            self.slot(name).unload(0)
+
+
+class AcquireTest(unittest.TestCase):
+
+    def test_evicted_model_is_loaded_by_executor(self) -> None:
+        load_threads = []
+
+        def load(name: str) -> ServingModel:
+            load_threads.append(threading.current_thread().name)
+            return ServingModel(SimpleNamespace(version=name), None, None)
+
+        service = AsyncPredictionService(service_setting(0))
+        service.registry = EvictingRegistry(load, ["default"])
+        model = asyncio.run(service.acquire("default"))
+        model.release()
+        service.executor.shutdown()
+        self.assertEqual(model.version, "default")
+        # Event loop thread never loads models
+        self.assertEqual(len(load_threads), 2)
+        self.assertTrue(all(name.startswith("predict") for name in load_threads), load_threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
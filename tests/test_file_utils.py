@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+APP_PATH = Path(os.path.dirname(os.path.abspath(__file__))).parent / "app"
+sys.path.append(str(APP_PATH))
+
+from utils.file_utils import DatasetWriter, read_dataset
+
+COLUMNS = ['class_id', 'class_name', 'text']
+EXTENSIONS = ['.csv', '.parquet', '.feather']
+
+
+class DatasetWriterTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_chunks(self) -> None:
+        data = pd.DataFrame({'class_id': [1, 2, 3], 'class_name': ['a', 'b', 'c'], 'text': ['x', 'y', 'z']})
+        for extension in EXTENSIONS:
+            path = os.path.join(self.directory.name, 'data' + extension)
+            with DatasetWriter(path, COLUMNS) as writer:
+                writer.write(data[:2])
+                writer.write(data[2:])
+            pd.testing.assert_frame_equal(read_dataset(path), data, obj=extension)
+
+    def test_empty_split_has_columns(self) -> None:
+        # Split without rows is saved as file with columns in every format
+        for extension in EXTENSIONS:
+            path = os.path.join(self.directory.name, 'empty' + extension)
+            DatasetWriter(path, COLUMNS).close()
+            data = read_dataset(path)
+            self.assertEqual(list(data.columns), COLUMNS, extension)
+            self.assertEqual(data.shape[0], 0, extension)
+
+
+if __name__ == '__main__':
+    unittest.main()
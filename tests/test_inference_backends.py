@@ -0,0 +1,70 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(os.path.dirname(os.path.abspath(__file__))).parent / "app"))
+
+from utils.inference_backends import KerasBackend, NumpyBackend, TFLiteBackend, check_backend_parity
+
+INPUT_LENGTH = 20
+NUM_CLASSES = 5
+NUM_WORDS = 50
+
+
+class InferenceBackendsParityTest(unittest.TestCase):
+    """
+    NumPy and TFLite backends must give the same probabilities as Keras model they are made of
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        import tensorflow as tf
+        from trainer.models import build_cnn, build_embed_model
+        cls.directory = tempfile.TemporaryDirectory()
+        tf.random.set_seed(42)
+        cls.models = [build_cnn(INPUT_LENGTH, NUM_CLASSES, "cnn", NUM_WORDS),
+                      build_embed_model(INPUT_LENGTH, NUM_CLASSES, "embed", NUM_WORDS)]
+        # Sequences padded with zeros at the end, as prep_bag_of_words makes them
+        rng = np.random.default_rng(42)
+        cls.x = rng.integers(1, NUM_WORDS, (16, INPUT_LENGTH)).astype(np.int32)
+        cls.x[::2, INPUT_LENGTH // 2:] = 0
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.directory.cleanup()
+
+    def test_numpy_backend(self) -> None:
+        from utils.file_utils import save_model
+        for model in self.models:
+            with self.subTest(model=model.name):
+                backend = NumpyBackend(save_model(self.directory.name, model))
+                self.assertEqual(backend.input_length, INPUT_LENGTH)
+                check_backend_parity(KerasBackend(model), backend, self.x)
+
+    def test_tflite_backend(self) -> None:
+        from utils.file_utils import save_tflite_model
+        for model in self.models:
+            with self.subTest(model=model.name):
+                backend = TFLiteBackend(save_tflite_model(self.directory.name, model), allow_tensorflow=True)
+                check_backend_parity(KerasBackend(model), backend, self.x)
+                # Interpreter is resized for batch of another size
+                check_backend_parity(KerasBackend(model), backend, self.x[:3])
+
+    @unittest.skipIf(importlib.util.find_spec("tflite_runtime") is not None, "tflite_runtime is installed")
+    def test_tflite_backend_requires_tflite_runtime(self) -> None:
+        with self.assertRaises(ImportError):
+            TFLiteBackend(os.path.join(self.directory.name, "cnn.tflite"))
+
+    def test_parity_check_fails_on_different_predictions(self) -> None:
+        cnn, embed = self.models
+        with self.assertRaises(ValueError):
+            check_backend_parity(KerasBackend(cnn), KerasBackend(embed), self.x)
+
+
+if __name__ == "__main__":
+    unittest.main()
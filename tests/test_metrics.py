@@ -0,0 +1,32 @@
+import json
+import os
+import sys
+import unittest
+from pathlib import Path
+
+APP_PATH = Path(os.path.dirname(os.path.abspath(__file__))).parent / "app"
+sys.path.append(str(APP_PATH))
+
+from utils import metrics
+from utils.cache_utils import LRUCache
+
+
+class MetricsSnapshotTest(unittest.TestCase):
+
+    def test_snapshot_has_callback_metrics(self) -> None:
+        registry = metrics.MetricsRegistry()
+        cache = LRUCache(max_size=10)
+        cache.put("key", "value")
+        cache.get("key")
+        cache.get("missing")
+        registry.counter("requests_total", "Requests", endpoint="/predict").inc()
+        registry.callback("cache_hit_rate", metrics.GAUGE, "Cache hits / lookups",
+                          lambda: [({"cache": "prediction"}, cache.hit_rate())])
+        snapshot = json.loads(json.dumps(registry.snapshot()))
+        self.assertEqual(snapshot["requests_total"], [{"labels": {"endpoint": "/predict"}, "value": 1}])
+        self.assertEqual(snapshot["cache_hit_rate"], [{"labels": {"cache": "prediction"}, "value": 0.5}])
+        self.assertIn("cache_hit_rate", registry.export())
+
+
+if __name__ == '__main__':
+    unittest.main()
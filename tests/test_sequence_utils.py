@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+APP_PATH = Path(os.path.dirname(os.path.abspath(__file__))).parent / "app"
+sys.path.append(str(APP_PATH))
+
+from utils import text_utils
+from utils.sequence_utils import pad_sequences, prep_bag_of_words
+from utils.vocabulary import Vocabulary
+
+TEXTS = ["перший текст заявки", "second ticket text with more words than sequence length allows", "", "невідоме",
+         "текст, text; ТЕКСТ\tзаявки"]
+
+
+class SequenceUtilsTest(unittest.TestCase):
+
+    def test_pad_sequences_as_keras(self) -> None:
+        from tensorflow.keras.preprocessing import sequence
+        sequences = [[1, 2, 3], [], list(range(1, 20)), [7]]
+        for length in [1, 5, 19, 30]:
+            with self.subTest(length=length):
+                expected = sequence.pad_sequences(sequences, maxlen=length, padding='post', truncating='post')
+                actual = pad_sequences(sequences, length)
+                self.assertEqual(actual.dtype, expected.dtype)
+                np.testing.assert_array_equal(actual, expected)
+
+    def test_prep_bag_of_words_with_tokenizer_and_vocabulary(self) -> None:
+        from tensorflow.keras.preprocessing.text import Tokenizer
+        tokenizer = Tokenizer(filters=text_utils.TOKEN_FILTER)
+        tokenizer.fit_on_texts(TEXTS[:2])
+        expected = pad_sequences(tokenizer.texts_to_sequences(TEXTS), 8)
+        np.testing.assert_array_equal(prep_bag_of_words(TEXTS, tokenizer, 8), expected)
+        np.testing.assert_array_equal(prep_bag_of_words(TEXTS, Vocabulary.from_tokenizer(tokenizer), 8), expected)
+
+    def test_clean_text_tokens_as_keras(self) -> None:
+        from tensorflow.keras.preprocessing.text import text_to_word_sequence
+        for text in TEXTS + ["a  b\xa0c", "«цитата» ’апостроф’ İstanbul"]:
+            with self.subTest(text=text):
+                self.assertEqual(text_utils.clean_text(text, clean_numbers=False),
+                                 " ".join(text_to_word_sequence(text, filters=text_utils.TOKEN_FILTER)))
+
+    def test_service_does_not_import_tensorflow(self) -> None:
+        code = ("import sys; import service.model_initializer, service.serving_model; "
+                "print(sorted({name.split('.')[0] for name in sys.modules} & {'tensorflow', 'keras', 'sklearn'}))")
+        environment = {**os.environ, "PYTHONPATH": os.pathsep.join([str(APP_PATH), str(APP_PATH / "service"),
+                                                                    os.environ.get("PYTHONPATH", "")])}
+        output = subprocess.check_output([sys.executable, "-c", code], env=environment, text=True)
+        self.assertEqual(output.strip().splitlines()[-1], "[]")
+
+
+if __name__ == "__main__":
+    unittest.main()
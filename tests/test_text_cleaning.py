@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+import unittest
+from pathlib import Path
+
+from flashtext import KeywordProcessor
+
+TESTS_PATH = Path(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(str(TESTS_PATH.parent / "app"))
+
+from utils import text_utils
+
+GOLDEN_CORPUS = TESTS_PATH / "fixtures" / "golden_corpus.json"
+
+
+class GoldenCorpusTest(unittest.TestCase):
+    """
+    clean_text and TextNormalizer must give the committed outputs of golden corpus for every options case.
+    Lemmatization is not covered: it requires language model and dictionaries of pymorphy2
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        with open(GOLDEN_CORPUS, encoding="utf-8") as file:
+            cls.corpus = json.load(file)
+        cls.custom_stop_words = KeywordProcessor()
+        for keyword, clean_name in cls.corpus["custom_stop_words"].items():
+            cls.custom_stop_words.add_keyword(keyword, clean_name)
+
+    def options(self, case: dict) -> dict:
+        options = dict(case["options"])
+        if options.pop("custom_stop_words", False):
+            options["custom_stop_words"] = self.custom_stop_words
+        if options.pop("default_stop_words", False):
+            options["default_stop_words"] = set(self.corpus["default_stop_words"])
+        return options
+
+    def assert_golden(self, clean) -> None:
+        for case in self.corpus["cases"]:
+            options = self.options(case)
+            cleaner = clean(options)
+            for text, expected in zip(self.corpus["texts"], case["expected"]):
+                with self.subTest(case=case["name"], text=text):
+                    self.assertEqual(cleaner(text), expected)
+
+    def test_clean_text(self) -> None:
+        self.assert_golden(lambda options: lambda text: text_utils.clean_text(text, **options))
+
+    def test_text_normalizer(self) -> None:
+        self.assert_golden(lambda options: text_utils.TextNormalizer(**options))
+
+    def test_no_max_word_len(self) -> None:
+        # Lower case 'İ' is 2 characters, so token is longer than the source text
+        self.assertEqual(text_utils.TextNormalizer(max_word_len=0)("İstanbul"), text_utils.clean_text("İstanbul"))
+
+
+if __name__ == "__main__":
+    unittest.main()